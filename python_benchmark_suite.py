@@ -0,0 +1,1912 @@
+# benchmark.py - Load test for the Python WhatsApp Pension Bot
+#
+# Drives the bot with synthetic WhatsApp webhook payloads against a stub Graph
+# API and reports throughput, latency percentiles and memory per simulated user.
+# Every simulated user is a fresh phone number that walks one conversation path
+# and waits for each reply before sending its next message.
+#
+#   python python_benchmark_suite.py                            # in-process (ASGI, no sockets)
+#   python python_benchmark_suite.py --mode http                # bot under uvicorn, real HTTP
+#   python python_benchmark_suite.py --save baseline.json
+#   python python_benchmark_suite.py --baseline baseline.json
+#   python python_benchmark_suite.py --baseline-app /tmp/main/python_whatsapp_pension_bot.py
+#
+# With a baseline the run exits with status 1 when throughput, reply latency or
+# memory per user regressed, so it can gate changes. Single runs of the same
+# tree differ by up to a third on a busy machine, so the load test runs
+# --repeat times (3 by default), each in a fresh process, and gates on the
+# median. A metric fails only when it is worse than the baseline median by
+# more than its tolerance in GATED_METRICS (or --tolerance) and also worse
+# than every run of the baseline, whose spread is taken as the noise band.
+#
+# A saved baseline cannot account for the machine itself getting slower in
+# the meantime; on shared hardware prefer --baseline-app with a checkout of
+# the base revision, which runs both versions in alternation.
+#
+# Focused benchmarks of single components are run by name, e.g.
+#
+#   python python_benchmark_suite.py client                     # pooled vs per-call HTTP client
+#   python python_benchmark_suite.py lanes                      # interleaved users, ordering and sessions
+#   python python_benchmark_suite.py sessions                   # session cache memory for 1M senders
+#   python python_benchmark_suite.py records                    # dict vs slotted record memory
+#   python python_benchmark_suite.py interactions               # ring buffer vs list.pop(0) per message
+#   python python_benchmark_suite.py intents                    # keyword classifier vs substring scans
+#   python python_benchmark_suite.py ratelimit                  # outbound limits against a throttling stub
+#   python python_benchmark_suite.py ids                        # id uniqueness across processes
+#   python python_benchmark_suite.py routing                    # agent assignment latency and fairness
+#   python python_benchmark_suite.py tickets                    # Power BI ticket pages at 10k-1M tickets
+#   python python_benchmark_suite.py dedup                      # seen message ids at millions of ids
+#   python python_benchmark_suite.py index                      # indexed ticket queries vs scans at 1M
+#   python python_benchmark_suite.py webhooks                   # webhook parse and dispatch per body
+#   python python_benchmark_suite.py export                     # Power BI exports: first byte and peak memory
+#   python python_benchmark_suite.py latency                    # latency histogram cost per message
+#   python python_benchmark_suite.py eventlog                   # event log group commit and replay time
+import os
+import sys
+import json
+import asyncio
+import random
+import heapq
+import time
+import gc
+import socket
+import argparse
+import logging
+import tempfile
+import importlib.util
+import subprocess
+import contextlib
+import itertools
+import tracemalloc
+import multiprocessing
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Any
+
+import httpx
+import uvicorn
+from pydantic import BaseModel
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'python_whatsapp_pension_bot.py')
+PHONE_NUMBER_ID = '100000000000001'
+WEBHOOK_HEADERS = {'Content-Type': 'application/json'}
+
+# Conversation paths, one message per entry. Each starts from a new user.
+JOURNEYS = {
+    'menu': ['hi', 'menu', 'what can you do'],
+    'pension_info': ['hi', '1', 'a', 'b', 'c', 'd'],
+    'balance': ['hi', '2', 'my member number is 4471234'],
+    'consultation': ['hi', '3', 'tuesday morning please'],
+    'contributions': ['hi', '4', 'rate', 'increase', 'history'],
+    'agent': ['hi', '5', '1', 'my balance looks wrong', 'it dropped last month', 'summary', 'end', '1'],
+    'complaint': ['hi', '5', '2', '1', '15/07/2025 around 2pm', 'my payment was taken twice', '1']
+}
+
+# Paths whose replies do not depend on generated ids or random agent answers
+DETERMINISTIC_JOURNEYS = ('menu', 'pension_info', 'balance', 'consultation', 'contributions')
+
+# Sent by the bot when a queued ticket reaches an agent, not in reply to a message
+UNSOLICITED_MARKERS = ('is now available and ready to help',)
+
+# Metric -> (+1 when higher is better, -1 when lower is better, allowed relative
+# regression). Tail latency and RSS growth are noisier than the median, so they
+# get more room.
+GATED_METRICS = {
+    'messages_per_second': (1, 0.15),
+    'reply_ms.p50': (-1, 0.20),
+    'reply_ms.p95': (-1, 0.25),
+    'reply_ms.p99': (-1, 0.35),
+    'memory_kb_per_user': (-1, 0.25)
+}
+
+def webhook_payload(phone: str, name: str, message_id: str, text: str) -> bytes:
+    return json.dumps({
+        'object': 'whatsapp_business_account',
+        'entry': [{
+            'id': '200000000000002',
+            'changes': [{
+                'field': 'messages',
+                'value': {
+                    'messaging_product': 'whatsapp',
+                    'metadata': {'display_phone_number': '15550000000', 'phone_number_id': PHONE_NUMBER_ID},
+                    'contacts': [{'profile': {'name': name}, 'wa_id': phone}],
+                    'messages': [{
+                        'from': phone,
+                        'id': message_id,
+                        'timestamp': str(int(time.time())),
+                        'type': 'text',
+                        'text': {'body': text}
+                    }]
+                }
+            }]
+        }]
+    }).encode('utf-8')
+
+def status_payload(phone: str, message_id: str, status: str = 'delivered') -> bytes:
+    return json.dumps({
+        'object': 'whatsapp_business_account',
+        'entry': [{
+            'id': '200000000000002',
+            'changes': [{
+                'field': 'messages',
+                'value': {
+                    'messaging_product': 'whatsapp',
+                    'metadata': {'display_phone_number': '15550000000', 'phone_number_id': PHONE_NUMBER_ID},
+                    'statuses': [{
+                        'id': message_id,
+                        'status': status,
+                        'timestamp': str(int(time.time())),
+                        'recipient_id': phone
+                    }]
+                }
+            }]
+        }]
+    }).encode('utf-8')
+
+class StubGraphAPI:
+    """Raw ASGI stand-in for the Graph API messages endpoint.
+    
+    Answers like Graph API does and resolves the oldest waiter registered for
+    the recipient, so the load generator can time each reply. Latency, 5xx
+    errors and 429 throttling can be injected to exercise retries, and real
+    rate limits enforced: at most rate_limit accepted sends in any second and
+    recipient_limit to one recipient in any recipient_window seconds. With
+    record=True the text of every delivered message is kept per recipient.
+    """
+    
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, throttle_rate: float = 0.0,
+                 seed: Optional[int] = None, record: bool = False, rate_limit: int = 0,
+                 recipient_limit: int = 0, recipient_window: float = 1.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit
+        self.recipient_limit = recipient_limit
+        self.recipient_window = recipient_window
+        self.accepted: deque = deque()
+        self.accepted_by_recipient: Dict[str, deque] = {}
+        self.random = random.Random(seed)
+        self.waiters: Dict[str, deque] = {}
+        self.replies: Optional[Dict[str, List[str]]] = {} if record else None
+        self.sent = 0
+        self.stats = {"requests": 0, "delivered": 0, "errors": 0, "throttled": 0, "unsolicited": 0}
+    
+    def expect(self, to: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(to, deque()).append(future)
+        return future
+    
+    def deliver(self, to: str, text: str):
+        if self.replies is not None:
+            self.replies.setdefault(to, []).append(text)
+        waiters = self.waiters.get(to)
+        if waiters and not any(marker in text for marker in UNSOLICITED_MARKERS):
+            while waiters:
+                future = waiters.popleft()
+                # Waiters that already timed out are skipped
+                if not future.done():
+                    future.set_result(time.perf_counter())
+                    self.stats["delivered"] += 1
+                    return
+        self.stats["unsolicited"] += 1
+    
+    def over_limit(self, to: str) -> bool:
+        # Sliding windows over accepted sends; refused ones do not count
+        now = time.monotonic()
+        recent = self.accepted_by_recipient.setdefault(to, deque())
+        for window, limit, times in ((1.0, self.rate_limit, self.accepted),
+                                     (self.recipient_window, self.recipient_limit, recent)):
+            while times and times[0] <= now - window:
+                times.popleft()
+            if limit and len(times) >= limit:
+                return True
+        self.accepted.append(now)
+        recent.append(now)
+        return False
+    
+    async def respond(self, body: bytes) -> tuple:
+        self.stats["requests"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        payload = json.loads(body)
+        to = payload['to']
+        roll = self.random.random()
+        if roll < self.error_rate:
+            self.stats["errors"] += 1
+            return 500, {}, {'error': {'message': 'Service temporarily unavailable', 'code': 2}}
+        if roll < self.error_rate + self.throttle_rate or self.over_limit(to):
+            self.stats["throttled"] += 1
+            return 429, {'Retry-After': '1'}, {'error': {'message': 'Rate limit hit', 'code': 130429}}
+        self.deliver(to, payload['text']['body'])
+        self.sent += 1
+        return 200, {}, {
+            'messaging_product': 'whatsapp',
+            'contacts': [{'input': to, 'wa_id': to}],
+            'messages': [{'id': f'wamid.stub{self.sent}'}]
+        }
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        status, headers, payload = await self.respond(body)
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', b'application/json')] +
+                       [(key.lower().encode(), value.encode()) for key, value in headers.items()]
+        })
+        await send({'type': 'http.response.body', 'body': json.dumps(payload).encode('utf-8')})
+
+class RunStats:
+    def __init__(self):
+        self.ack: List[float] = []
+        self.reply: List[float] = []
+        self.messages = 0
+        self.webhooks = 0
+        self.lost = 0
+        self.rejected = 0
+        self.duplicates = 0
+        self.statuses = 0
+        self.journeys: Dict[str, int] = {}
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    # Nearest-rank percentiles in milliseconds
+    if not values:
+        return {"p50": None, "p90": None, "p95": None, "p99": None, "max": None}
+    ordered = sorted(values)
+    
+    def rank(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 3)
+    
+    return {"p50": rank(0.50), "p90": rank(0.90), "p95": rank(0.95), "p99": rank(0.99), "max": round(ordered[-1] * 1000, 3)}
+
+def rss_bytes(pid: Any = 'self') -> Optional[int]:
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+def parse_mix(value: Optional[str]) -> Dict[str, float]:
+    weights = {name: 1.0 for name in JOURNEYS}
+    if value:
+        for item in value.split(','):
+            name, _, weight = item.partition('=')
+            if name.strip() not in JOURNEYS:
+                raise SystemExit(f"Unknown journey '{name.strip()}', expected one of: {', '.join(JOURNEYS)}")
+            weights[name.strip()] = float(weight or 1)
+    return weights
+
+async def post_webhook(client: httpx.AsyncClient, body: bytes, stats: RunStats) -> bool:
+    # Meta redelivers webhooks that were not acknowledged with a 200
+    for attempt in range(5):
+        started = time.perf_counter()
+        response = await client.post('/webhook', content=body, headers=WEBHOOK_HEADERS)
+        stats.ack.append(time.perf_counter() - started)
+        stats.webhooks += 1
+        if response.status_code == 200:
+            return True
+        stats.rejected += 1
+        await asyncio.sleep(0.05 * 2 ** attempt)
+    return False
+
+async def run_journey(client: httpx.AsyncClient, stub: StubGraphAPI, name: str, phone: str,
+                      options: argparse.Namespace, rng: random.Random, stats: RunStats):
+    for step, text in enumerate(JOURNEYS[name]):
+        message_id = f'wamid.{phone}.{step}'
+        body = webhook_payload(phone, 'Benchmark User', message_id, text)
+        reply = stub.expect(phone)
+        sent_at = time.perf_counter()
+        if not await post_webhook(client, body, stats):
+            reply.cancel()
+            stats.lost += 1
+            continue
+        stats.messages += 1
+        if rng.random() < options.duplicate_rate:
+            # A redelivery the bot must not answer twice
+            await post_webhook(client, body, stats)
+            stats.duplicates += 1
+        try:
+            replied_at = await asyncio.wait_for(reply, options.reply_timeout)
+            stats.reply.append(replied_at - sent_at)
+        except asyncio.TimeoutError:
+            stats.lost += 1
+        for _ in range(options.status_callbacks):
+            await post_webhook(client, status_payload(phone, f'{message_id}.reply'), stats)
+            stats.statuses += 1
+        if options.think_time:
+            await asyncio.sleep(rng.expovariate(1 / options.think_time))
+    stats.journeys[name] = stats.journeys.get(name, 0) + 1
+
+async def drive(client: httpx.AsyncClient, stub: StubGraphAPI, options: argparse.Namespace,
+                first_user: int, journeys: int, rng: random.Random, stats: RunStats) -> float:
+    weights = parse_mix(options.mix)
+    plan = rng.choices(list(weights), list(weights.values()), k=journeys)
+    work = iter(enumerate(plan, first_user))
+    
+    async def user():
+        for index, name in work:
+            await run_journey(client, stub, name, f'4470{index:08d}', options, rng, stats)
+    
+    started = time.perf_counter()
+    await asyncio.gather(*(user() for _ in range(options.users)))
+    return time.perf_counter() - started
+
+async def measure(client: httpx.AsyncClient, stub: StubGraphAPI, options: argparse.Namespace, pid: Any = 'self') -> Dict:
+    """Runs the warm-up and the measured rounds, every journey with a new user."""
+    rng = random.Random(options.seed)
+    await drive(client, stub, options, 0, options.warmup, rng, RunStats())
+    gc.collect()
+    rss_before = rss_bytes(pid)
+    stats = RunStats()
+    rates = []
+    elapsed = 0.0
+    for round_number in range(options.rounds):
+        messages = stats.messages
+        seconds = await drive(client, stub, options, options.warmup + round_number * options.journeys,
+                              options.journeys, rng, stats)
+        rates.append((stats.messages - messages) / seconds)
+        elapsed += seconds
+    gc.collect()
+    return {
+        "stats": stats,
+        "elapsed": elapsed,
+        "rates": rates,
+        "rss_before": rss_before,
+        "rss_after": rss_bytes(pid),
+        "health": (await client.get('/health')).json()
+    }
+
+def benchmark_env(options: argparse.Namespace, graph_url: str, data_dir: str) -> Dict[str, str]:
+    # Explicit environment variables win, so any bot setting can be benchmarked
+    env = {
+        'WHATSAPP_TOKEN': 'benchmark',
+        'PHONE_NUMBER_ID': PHONE_NUMBER_ID,
+        'VERIFY_TOKEN': 'benchmark',
+        'GRAPH_API_URL': graph_url,
+        'EVENT_LOG_DIR': data_dir,
+        'HTTP2_ENABLED': 'false',
+        # The stub accepts any rate; real limits are benchmarked by setting these
+        'OUTBOUND_RATE': '0',
+        'OUTBOUND_RECIPIENT_RATE': '0',
+        'ID_NODE_ID': '0'
+    }
+    env.update({key: value for key, value in os.environ.items() if key in env})
+    return env
+
+def load_bot(path: str):
+    spec = importlib.util.spec_from_file_location('pension_bot', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['pension_bot'] = module
+    spec.loader.exec_module(module)
+    return module
+
+def load_inprocess_bot(options: argparse.Namespace, stub: StubGraphAPI, data_dir: str):
+    os.environ.update(benchmark_env(options, 'http://graph.stub/v18.0', data_dir))
+    bot = load_bot(options.app)
+    # Per-request INFO logs from the bot and httpx would swamp the report
+    logging.getLogger().setLevel(logging.WARNING)
+    # Outbound requests go straight to the stub app instead of the network
+    bot.create_http_client = lambda: httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=stub),
+        timeout=httpx.Timeout(bot.HTTP_TIMEOUT, connect=bot.HTTP_CONNECT_TIMEOUT),
+        headers={'Content-Type': 'application/json'}
+    )
+    return bot
+
+async def run_inprocess(options: argparse.Namespace, stub: StubGraphAPI, data_dir: str) -> Dict:
+    bot = load_inprocess_bot(options, stub, data_dir)
+    await bot.startup()
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=bot.app), base_url='http://bot') as client:
+            return await measure(client, stub, options)
+    finally:
+        await bot.shutdown()
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+@contextlib.asynccontextmanager
+async def serve_stub(stub: StubGraphAPI):
+    """Serves the stub under uvicorn on a free local port and yields its Graph API URL."""
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(stub, host='127.0.0.1', port=port, lifespan='off', log_level='warning'))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+            raise SystemExit("Stub Graph API did not start")
+        await asyncio.sleep(0.01)
+    try:
+        yield f'http://127.0.0.1:{port}/v18.0'
+    finally:
+        server.should_exit = True
+        await task
+
+async def run_http(options: argparse.Namespace, stub: StubGraphAPI, data_dir: str) -> Dict:
+    async with serve_stub(stub) as graph_url:
+        return await run_bot_process(options, stub, graph_url, data_dir)
+
+async def run_bot_process(options: argparse.Namespace, stub: StubGraphAPI, graph_url: str, data_dir: str) -> Dict:
+    bot_port = free_port()
+    env = {**os.environ, **benchmark_env(options, graph_url, data_dir)}
+    app_dir, app_file = os.path.split(os.path.abspath(options.app))
+    # The bot logs every request at INFO; keep that out of the report
+    log_path = os.path.join(data_dir, 'bot.log')
+    log_file = open(log_path, 'wb')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', f'{os.path.splitext(app_file)[0]}:app', '--app-dir', app_dir,
+         '--host', '127.0.0.1', '--port', str(bot_port), '--log-level', 'warning'],
+        env=env,
+        stdout=log_file,
+        stderr=subprocess.STDOUT
+    )
+    limits = httpx.Limits(max_connections=options.users * 2, max_keepalive_connections=options.users * 2)
+    try:
+        async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{bot_port}', limits=limits, timeout=30) as client:
+            deadline = time.monotonic() + 30
+            while True:
+                try:
+                    if (await client.get('/')).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                if process.poll() is not None or time.monotonic() > deadline:
+                    with open(log_path, encoding='utf-8', errors='replace') as f:
+                        raise SystemExit(f"Bot did not start:\n{f.read()[-2000:]}")
+                await asyncio.sleep(0.1)
+            return await measure(client, stub, options, process.pid)
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        log_file.close()
+
+def build_report(options: argparse.Namespace, run: Dict, stub: StubGraphAPI) -> Dict:
+    stats: RunStats = run["stats"]
+    elapsed = run["elapsed"]
+    memory_kb_per_user = None
+    if run["rss_before"] is not None and run["rss_after"] is not None:
+        memory_kb_per_user = round((run["rss_after"] - run["rss_before"]) / 1024 / (options.journeys * options.rounds), 2)
+    health = run["health"]
+    return {
+        "config": {
+            "mode": options.mode,
+            "users": options.users,
+            "journeys": options.journeys,
+            "rounds": options.rounds,
+            "warmup": options.warmup,
+            "mix": options.mix or 'even',
+            "think_time": options.think_time,
+            "duplicate_rate": options.duplicate_rate,
+            "status_callbacks": options.status_callbacks,
+            "stub_latency": options.stub_latency,
+            "stub_error_rate": options.stub_error_rate,
+            "stub_throttle_rate": options.stub_throttle_rate
+        },
+        "messages": stats.messages,
+        "webhooks": stats.webhooks,
+        "elapsed_s": round(elapsed, 3),
+        # Median round, so one disturbed round does not move the gate
+        "messages_per_second": round(sorted(run["rates"])[len(run["rates"]) // 2], 1),
+        "round_messages_per_second": [round(rate, 1) for rate in run["rates"]],
+        "webhooks_per_second": round(stats.webhooks / elapsed, 1),
+        "ack_ms": percentiles(stats.ack),
+        "reply_ms": percentiles(stats.reply),
+        "lost_replies": stats.lost,
+        "rejected_webhooks": stats.rejected,
+        "duplicates_sent": stats.duplicates,
+        "status_callbacks_sent": stats.statuses,
+        "rss_mb": round(run["rss_after"] / 2 ** 20, 1) if run["rss_after"] is not None else None,
+        "memory_kb_per_user": memory_kb_per_user,
+        "journeys_completed": stats.journeys,
+        "stub": stub.stats,
+        "bot": {
+            "message_queue": health.get("message_queue"),
+            "outbound": health.get("outbound"),
+            "dead_letters": health.get("dead_letters")
+        }
+    }
+
+def metric(report: Dict, name: str) -> Optional[float]:
+    value = report
+    for key in name.split('.'):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+def gated_samples(report: Dict, name: str) -> List[float]:
+    # Repeated runs keep every run's value; a single run is its own sample
+    if "gated" in report:
+        return report["gated"][name]["samples"]
+    value = metric(report, name)
+    return [value] if value is not None else []
+
+def median(values: List[float]) -> float:
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    return ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+
+def compare(report: Dict, baseline: Dict, tolerance: Optional[float] = None) -> List[str]:
+    """Gated metrics whose median is worse than the baseline median by more than
+    the metric's tolerance and worse than every baseline run."""
+    regressions = []
+    for name, (direction, default_tolerance) in GATED_METRICS.items():
+        samples, baseline_samples = gated_samples(report, name), gated_samples(baseline, name)
+        if not samples or not baseline_samples or median(baseline_samples) <= 0:
+            continue
+        current, previous = median(samples), median(baseline_samples)
+        allowed = default_tolerance if tolerance is None else tolerance
+        change = (current - previous) / previous
+        # Worst baseline run, relative to its median
+        noise = max((value - previous) / previous * -direction for value in baseline_samples)
+        print(f"  {name:<22} {previous:>12} -> {current:<12} {change:+.1%}  "
+              f"(allowed {allowed:.0%}, baseline runs within {noise:.0%})")
+        if change * direction < -max(allowed, noise):
+            regressions.append(f"{name} {previous} -> {current} ({change:+.1%})")
+    return regressions
+
+def print_report(report: Dict):
+    config = report["config"]
+    print(f"\nMode {config['mode']}: {config['users']} concurrent users, {config['rounds']} rounds of "
+          f"{config['journeys']} journeys ({report['messages']} messages, {report['webhooks']} webhooks) "
+          f"in {report['elapsed_s']} s")
+    print(f"  throughput       {report['messages_per_second']} messages/s (median round of "
+          f"{report['round_messages_per_second']}), {report['webhooks_per_second']} webhooks/s")
+    for name in ('ack_ms', 'reply_ms'):
+        values = report[name]
+        print(f"  {name:<16} p50 {values['p50']}  p90 {values['p90']}  p95 {values['p95']}  "
+              f"p99 {values['p99']}  max {values['max']}")
+    print(f"  memory           {report['memory_kb_per_user']} KB per user, {report['rss_mb']} MB RSS")
+    print(f"  lost replies     {report['lost_replies']}, rejected webhooks {report['rejected_webhooks']}, "
+          f"unsolicited {report['stub']['unsolicited']}")
+    print(f"  journeys         {report['journeys_completed']}")
+    print(f"  stub             {report['stub']}")
+    if "gated" in report:
+        print(f"  over {len(report['runs'])} runs (the run shown above had the median throughput):")
+        for name, values in report["gated"].items():
+            print(f"    {name:<20} median {values['median']}  min {min(values['samples'])}  max {max(values['samples'])}")
+
+def print_rows(title: str, rows: List[Dict]):
+    print(f"\n{title}")
+    columns = list(rows[0])
+    widths = {name: max(len(name), *(len(str(row[name])) for row in rows)) for name in columns}
+    print("  " + "  ".join(name.ljust(widths[name]) for name in columns))
+    for row in rows:
+        print("  " + "  ".join(str(row[name]).ljust(widths[name]) for name in columns))
+
+# Focused benchmarks
+def graph_message(to: str, text: str) -> Dict:
+    return {'messaging_product': 'whatsapp', 'to': to, 'text': {'body': text}}
+
+async def send_replies(post, messages: int, concurrency: int) -> tuple:
+    """Sends messages through post(payload) from concurrent senders; returns (seconds, latencies)."""
+    work = iter(range(messages))
+    latencies: List[float] = []
+    
+    async def sender():
+        for index in work:
+            started = time.perf_counter()
+            outcome, _ = await post(graph_message(f'4471{index % 1000:08d}', 'Benchmark reply'))
+            if outcome != 'sent':
+                raise SystemExit(f"Stub refused a send ({outcome})")
+            latencies.append(time.perf_counter() - started)
+    
+    started = time.perf_counter()
+    await asyncio.gather(*(sender() for _ in range(concurrency)))
+    return time.perf_counter() - started, latencies
+
+async def run_client(options: argparse.Namespace) -> Dict:
+    """Reply throughput over real sockets with the bot's pooled client and with a
+    new client per reply, which is how send_message used to post."""
+    stub = StubGraphAPI(options.stub_latency, seed=options.seed)
+    rows = []
+    with tempfile.TemporaryDirectory(prefix='pensionbot-bench-') as data_dir:
+        async with serve_stub(stub) as graph_url:
+            os.environ.update(benchmark_env(options, graph_url, data_dir))
+            bot = load_bot(options.app)
+            logging.getLogger().setLevel(logging.WARNING)
+            url = f'{bot.GRAPH_API_URL}/{bot.PHONE_NUMBER_ID}/messages'
+            headers = bot.graph_api_headers()
+            
+            async def per_call(payload: Dict) -> tuple:
+                async with httpx.AsyncClient(headers={'Content-Type': 'application/json'}) as client:
+                    return await bot.post_message(client, url, payload, headers, payload['to'])
+            
+            async with bot.create_http_client() as pooled_client:
+                async def pooled(payload: Dict) -> tuple:
+                    return await bot.post_message(pooled_client, url, payload, headers, payload['to'])
+                
+                for name, post in (('per_call', per_call), ('pooled', pooled)):
+                    await send_replies(post, options.warmup, options.concurrency)
+                    rates, latencies = [], []
+                    for _ in range(options.rounds):
+                        seconds, round_latencies = await send_replies(post, options.messages, options.concurrency)
+                        rates.append(options.messages / seconds)
+                        latencies.extend(round_latencies)
+                    reply_ms = percentiles(latencies)
+                    rows.append({
+                        "client": name,
+                        "messages_per_second": round(sorted(rates)[len(rates) // 2], 1),
+                        "p50_ms": reply_ms["p50"],
+                        "p99_ms": reply_ms["p99"]
+                    })
+    return {
+        "config": {"messages": options.messages, "rounds": options.rounds, "concurrency": options.concurrency,
+                   "stub_latency": options.stub_latency},
+        "clients": rows
+    }
+
+def print_client_report(report: Dict):
+    config = report["config"]
+    print_rows(f"Graph API sends over HTTP/1.1: {config['rounds']} rounds of {config['messages']} messages, "
+               f"{config['concurrency']} concurrent senders (median round)", report["clients"])
+
+async def session_state(bot, phone: str) -> Optional[tuple]:
+    session = await bot.session_store.load(phone)
+    return (session.step, session.data) if session is not None else None
+
+async def run_lanes(options: argparse.Namespace) -> Dict:
+    """Posts each user's messages back to back without waiting for replies, so
+    every user's webhooks interleave with everyone else's. Each user must get
+    the same replies, in the same order, and end with the same session as a
+    reference user served one message at a time."""
+    stub = StubGraphAPI(seed=options.seed, record=True)
+    stats = RunStats()
+    failures: List[str] = []
+    # Room for every message at once, so none wait for a redelivery
+    os.environ.setdefault('QUEUE_MAX_SIZE', str(options.users * max(len(JOURNEYS[name]) for name in DETERMINISTIC_JOURNEYS)))
+    with tempfile.TemporaryDirectory(prefix='pensionbot-bench-') as data_dir:
+        bot = load_inprocess_bot(options, stub, data_dir)
+        await bot.startup()
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=bot.app), base_url='http://bot') as client:
+                expected = {}
+                for index, name in enumerate(DETERMINISTIC_JOURNEYS):
+                    phone = f'4472{index:08d}'
+                    for step, text in enumerate(JOURNEYS[name]):
+                        reply = stub.expect(phone)
+                        await post_webhook(client, webhook_payload(phone, 'Benchmark User', f'wamid.{phone}.{step}', text), stats)
+                        await asyncio.wait_for(reply, options.reply_timeout)
+                    expected[name] = (stub.replies[phone], await session_state(bot, phone))
+                
+                users = [(f'4473{index:08d}', DETERMINISTIC_JOURNEYS[index % len(DETERMINISTIC_JOURNEYS)])
+                         for index in range(options.users)]
+                replies = []
+                
+                async def fire(phone: str, name: str):
+                    for step, text in enumerate(JOURNEYS[name]):
+                        sent_at = time.perf_counter()
+                        replies.append((sent_at, stub.expect(phone)))
+                        if await post_webhook(client, webhook_payload(phone, 'Benchmark User', f'wamid.{phone}.{step}', text), stats):
+                            stats.messages += 1
+                
+                started = time.perf_counter()
+                await asyncio.gather(*(fire(phone, name) for phone, name in users))
+                done, pending = await asyncio.wait([future for _, future in replies], timeout=options.reply_timeout)
+                elapsed = time.perf_counter() - started
+                stats.lost = len(pending)
+                stats.reply = [future.result() - sent_at for sent_at, future in replies if future in done]
+                
+                for phone, name in users:
+                    expected_replies, expected_session = expected[name]
+                    if stub.replies.get(phone) != expected_replies:
+                        failures.append(f"{phone} ({name}) got replies out of order or missing")
+                    elif await session_state(bot, phone) != expected_session:
+                        failures.append(f"{phone} ({name}) ended with session {await session_state(bot, phone)}, "
+                                        f"expected {expected_session}")
+        finally:
+            await bot.shutdown()
+    return {
+        "config": {"users": options.users, "journeys": list(DETERMINISTIC_JOURNEYS)},
+        "messages": stats.messages,
+        "elapsed_s": round(elapsed, 3),
+        "messages_per_second": round(stats.messages / elapsed, 1),
+        "reply_ms": percentiles(stats.reply),
+        "lost_replies": stats.lost,
+        "failures": failures
+    }
+
+def print_lanes_report(report: Dict):
+    reply_ms = report["reply_ms"]
+    print(f"\nInterleaved lanes: {report['config']['users']} users, {report['messages']} messages "
+          f"in {report['elapsed_s']} s ({report['messages_per_second']} messages/s)")
+    print(f"  reply_ms         p50 {reply_ms['p50']}  p99 {reply_ms['p99']}  max {reply_ms['max']}")
+    print(f"  lost replies     {report['lost_replies']}")
+    print(f"  incorrect users  {len(report['failures'])}")
+    for failure in report["failures"][:10]:
+        print(f"    {failure}")
+
+async def run_ratelimit(options: argparse.Namespace) -> Dict:
+    """Replies a burst of one-off messages plus a run of replies to a few
+    recipients through the outbound dispatcher, against a stub that enforces
+    a global and a per-recipient rate limit. Without limits in the bot most
+    of the burst is refused with a 429; with them it should hardly ever be."""
+    configs = {
+        'unlimited': {'rate': 0, 'burst': 1, 'recipient_rate': 0, 'recipient_burst': 1},
+        'limited': {'rate': options.rate, 'burst': options.burst,
+                    'recipient_rate': options.recipient_rate, 'recipient_burst': options.recipient_burst}
+    }
+    sends = [(f'4475{index:08d}', 'Broadcast reply') for index in range(options.broadcast)]
+    # Interleaved so each recipient's replies are queued between everyone else's
+    sends += [(f'4476{index:08d}', f'Reply {step + 1} of {options.per_recipient}')
+              for step in range(options.per_recipient) for index in range(options.recipients)]
+    rows = []
+    for name, limits in configs.items():
+        stub = StubGraphAPI(seed=options.seed, record=True, rate_limit=options.stub_rate,
+                            recipient_limit=options.stub_recipient_limit, recipient_window=options.stub_recipient_window)
+        with tempfile.TemporaryDirectory(prefix='pensionbot-bench-') as data_dir:
+            bot = load_inprocess_bot(options, stub, data_dir)
+            # Every 429 is logged as a warning, which would bury the report
+            logging.getLogger(bot.__name__).setLevel(logging.ERROR)
+            bot.outbound_dispatcher = bot.OutboundDispatcher(**limits)
+            await bot.startup()
+            try:
+                started = time.perf_counter()
+                for to, text in sends:
+                    await bot.send_message(to, text)
+                drained = await bot.outbound_dispatcher.drain(options.timeout)
+                elapsed = time.perf_counter() - started
+                dispatcher = bot.outbound_dispatcher.get_stats()
+            finally:
+                await bot.shutdown()
+        expected: Dict[str, List[str]] = {}
+        for to, text in sends:
+            expected.setdefault(to, []).append(text)
+        rows.append({
+            "limits": name,
+            "sends": len(sends),
+            "delivered": stub.sent,
+            "http_429": stub.stats["throttled"],
+            "retries": dispatcher["retries"],
+            "dead_lettered": dispatcher["dead_lettered"],
+            "out_of_order": sum(1 for to, texts in expected.items() if stub.replies.get(to, []) != texts),
+            "seconds": round(elapsed, 2) if drained else f">{options.timeout}"
+        })
+    return {
+        "config": {"broadcast": options.broadcast, "recipients": options.recipients,
+                   "per_recipient": options.per_recipient, "stub_rate": options.stub_rate,
+                   "stub_recipient_limit": options.stub_recipient_limit,
+                   "stub_recipient_window": options.stub_recipient_window, "limited": configs['limited']},
+        "runs": rows
+    }
+
+def print_ratelimit_report(report: Dict):
+    config = report["config"]
+    print_rows(f"{config['broadcast']} one-off replies plus {config['recipients']} recipients x {config['per_recipient']}, "
+               f"stub allows {config['stub_rate']}/s and {config['stub_recipient_limit']} per recipient per "
+               f"{config['stub_recipient_window']} s; limited = {config['limited']}", report["runs"])
+
+# node id, replicas share one pid, ids expected to be unique
+ID_SETUPS = {
+    'ID_NODE_ID=0': (0, False, True),
+    'ID_NODE_ID=0, same pid': (0, True, False),
+    'ID_NODE_ID unset, same pid': (None, True, True)
+}
+
+def id_worker(bot, node_id: Optional[int], same_pid: bool, count: int, connection):
+    # Runs in a forked child
+    if same_pid:
+        # Replicas in separate containers all run as pid 1
+        os.getpid = lambda: 1
+    generator = bot.IdGenerator(node_id)
+    started = time.perf_counter()
+    ids = [generator.generate('TK') for _ in range(count)]
+    seconds = time.perf_counter() - started
+    increasing = all(earlier < later for earlier, later in zip(ids, ids[1:]))
+    connection.send((seconds, increasing, '\n'.join(ids)))
+    connection.close()
+
+async def run_ids(options: argparse.Namespace) -> Dict:
+    """Generates --ids ticket ids in each of --processes forked processes at
+    once and counts duplicates across all of them, for each way the node
+    field can be set up."""
+    bot = load_standalone_bot(options)
+    context = multiprocessing.get_context('fork')
+    rows, failures = [], []
+    for name, (node_id, same_pid, expect_unique) in ID_SETUPS.items():
+        pipes = [context.Pipe(duplex=False) for _ in range(options.processes)]
+        workers = [context.Process(target=id_worker, args=(bot, node_id, same_pid, options.ids, sender))
+                   for _, sender in pipes]
+        for worker in workers:
+            worker.start()
+        results = [receiver.recv() for receiver, _ in pipes]
+        for worker in workers:
+            worker.join()
+        
+        seen = set()
+        for _, _, ids in results:
+            seen.update(ids.split('\n'))
+        total = options.processes * options.ids
+        duplicates = total - len(seen)
+        increasing = all(result[1] for result in results)
+        if expect_unique and (duplicates or not increasing):
+            failures.append(f"{name}: {duplicates} duplicate ids, increasing per process: {increasing}")
+        rows.append({
+            "setup": name,
+            "ids": total,
+            "duplicates": duplicates,
+            "increasing": increasing,
+            "us_per_id": round(sum(result[0] for result in results) / total * 1e6, 2),
+            "expected": 'unique' if expect_unique else 'collisions'
+        })
+        del seen, results
+    return {"config": {"processes": options.processes, "ids": options.ids}, "setups": rows, "failures": failures}
+
+def print_ids_report(report: Dict):
+    config = report["config"]
+    print_rows(f"Ticket ids from {config['processes']} concurrent processes x {config['ids']}", report["setups"])
+    for failure in report["failures"]:
+        print(f"  FAILED {failure}")
+
+def load_standalone_bot(options: argparse.Namespace):
+    # For benchmarks of single components; startup() is never run
+    with tempfile.TemporaryDirectory(prefix='pensionbot-bench-') as data_dir:
+        os.environ.update(benchmark_env(options, 'http://graph.stub/v18.0', data_dir))
+        bot = load_bot(options.app)
+    logging.getLogger().setLevel(logging.WARNING)
+    return bot
+
+async def run_sessions(options: argparse.Namespace) -> Dict:
+    """Saves a session for each of --senders distinct numbers, as if each had
+    messaged once, and traces the session cache's memory for every cap."""
+    bot = load_standalone_bot(options)
+    rows = []
+    for cap in options.caps:
+        gc.collect()
+        tracemalloc.start()
+        store = bot.MemorySessionStore(ttl=bot.SESSION_TTL, max_entries=cap or options.senders)
+        started = time.perf_counter()
+        for index in range(options.senders):
+            session = bot.UserSession(step='main_menu', name='Benchmark User', data={'verification': f'member {index}'})
+            await store.save(f'4474{index:08d}', session)
+        seconds = time.perf_counter() - started
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        sessions = await store.count()
+        # Cost of the sweeper once every cached session has gone idle
+        store.ttl = 1e-9
+        started = time.perf_counter()
+        expired = await store.sweep()
+        rows.append({
+            "cap": cap or 'none',
+            "sessions": sessions,
+            "evicted": store.stats["evicted"],
+            "peak_mb": round(peak / 2 ** 20, 1),
+            "retained_mb": round(current / 2 ** 20, 1),
+            "bytes_per_session": round(current / sessions),
+            "us_per_save": round(seconds / options.senders * 1e6, 2),
+            "sweep_ms": round((time.perf_counter() - started) * 1000, 1),
+            "expired": expired
+        })
+        del store
+    return {"config": {"senders": options.senders, "caps": options.caps}, "caches": rows}
+
+def print_sessions_report(report: Dict):
+    print_rows(f"Session cache after {report['config']['senders']} distinct senders "
+               f"(tracemalloc; save times include tracing overhead)", report["caches"])
+
+class LegacySession:
+    # UserSession as it was before it became a slotted dataclass
+    def __init__(self, step: str = 'welcome', name: str = 'there', data: Dict = None):
+        self.step = step
+        self.name = name
+        self.data = data or {}
+        self.ticket_id = None
+        self.complaint = None
+
+def legacy_record(bot, kind: str, index: int, now: float) -> Any:
+    """The dict (or plain object) the bot kept for each record type, with ISO timestamps."""
+    created = datetime.fromtimestamp(now + index)
+    if kind == 'session':
+        session = LegacySession('main_menu', f'User {index}', {'verification': f'member {index}'})
+        session.ticket_id = f'TK{index:016d}'
+        return session
+    if kind == 'ticket':
+        return {
+            'id': f'TK{index:016d}',
+            'customer_id': f'4475{index:08d}',
+            'customer_name': f'User {index}',
+            'status': 'assigned',
+            'priority': 'high',
+            'created_at': created.isoformat(),
+            'initial_message': f'my balance looks wrong {index}',
+            'category': 'account_issues',
+            'assigned_agent': 'AG001',
+            'agent_name': 'Sarah Mitchell',
+            'department': 'Account Services Team',
+            'messages': [
+                {'sender': 'customer' if turn % 2 == 0 else 'agent', 'message': f'message {turn} of {index}',
+                 'timestamp': (created + timedelta(seconds=turn)).isoformat(),
+                 **({'agent_id': 'AG001'} if turn % 2 else {})}
+                for turn in range(4)
+            ]
+        }
+    if kind == 'complaint':
+        return {
+            'id': f'CP{index:016d}',
+            'customer_id': f'4475{index:08d}',
+            'type': 'Service Issue',
+            'date_time': f'15/07/2025 around 2pm {index}',
+            'details': f'my payment was taken twice {index}',
+            'severity': 'medium',
+            'status': 'open',
+            'created_at': created.isoformat(),
+            'assigned_to': 'complaints_team',
+            'follow_up_date': (created + timedelta(hours=48)).isoformat()
+        }
+    return {
+        'timestamp': created.isoformat(),
+        'user_id': f'4475{index:08d}',
+        'user_message': f'what is my balance {index}',
+        'bot_response': f'Your balance request {index} has been received',
+        'conversation_step': 'main_menu',
+        'message_type': 'account_inquiry',
+        'response_time': 850,
+        'session_id': f'SS{index:016d}'
+    }
+
+def slotted_record(bot, kind: str, index: int, now: float) -> Any:
+    """The same record as the bot's slotted dataclass, with epoch timestamps."""
+    created = now + index
+    if kind == 'session':
+        return bot.UserSession('main_menu', f'User {index}', {'verification': f'member {index}'}, f'TK{index:016d}')
+    if kind == 'ticket':
+        ticket = bot.Ticket(
+            id=f'TK{index:016d}',
+            customer_id=f'4475{index:08d}',
+            customer_name=f'User {index}',
+            initial_message=f'my balance looks wrong {index}',
+            created_at=created,
+            status='assigned',
+            priority='high',
+            category='account_issues',
+            department='Account Services Team',
+            assigned_agent='AG001',
+            agent_name='Sarah Mitchell',
+            assigned_at=created
+        )
+        ticket.messages = [
+            bot.TicketMessage('customer' if turn % 2 == 0 else 'agent', f'message {turn} of {index}',
+                              created + turn, 'AG001' if turn % 2 else None)
+            for turn in range(4)
+        ]
+        return ticket
+    if kind == 'complaint':
+        return bot.ComplaintTicket(
+            id=f'CP{index:016d}',
+            customer_id=f'4475{index:08d}',
+            type='Service Issue',
+            date_time=f'15/07/2025 around 2pm {index}',
+            details=f'my payment was taken twice {index}',
+            created_at=created,
+            follow_up_date=created + 48 * 3600
+        )
+    return bot.Interaction(
+        timestamp=created,
+        user_id=f'4475{index:08d}',
+        user_message=f'what is my balance {index}',
+        bot_response=f'Your balance request {index} has been received',
+        conversation_step='main_menu',
+        message_type='account_inquiry',
+        response_time=850,
+        session_id=f'SS{index:016d}'
+    )
+
+RECORD_KINDS = ('session', 'ticket', 'complaint', 'interaction')
+
+def trace_records(build, bot, kind: str, count: int) -> tuple:
+    """Bytes and allocations still held once count records are built."""
+    now = time.time()
+    gc.collect()
+    tracemalloc.start()
+    records = [build(bot, kind, index, now) for index in range(count)]
+    current, _ = tracemalloc.get_traced_memory()
+    blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    tracemalloc.stop()
+    del records
+    return current, blocks
+
+async def run_records(options: argparse.Namespace) -> Dict:
+    bot = load_standalone_bot(options)
+    rows = []
+    for kind in RECORD_KINDS:
+        legacy_bytes, legacy_blocks = trace_records(legacy_record, bot, kind, options.records)
+        slotted_bytes, slotted_blocks = trace_records(slotted_record, bot, kind, options.records)
+        rows.append({
+            "record": kind,
+            "dict_bytes": round(legacy_bytes / options.records),
+            "slotted_bytes": round(slotted_bytes / options.records),
+            "saved": f"{1 - slotted_bytes / legacy_bytes:.0%}",
+            "dict_allocations": round(legacy_blocks / options.records, 1),
+            "slotted_allocations": round(slotted_blocks / options.records, 1),
+            "dict_mb": round(legacy_bytes / 2 ** 20, 1),
+            "slotted_mb": round(slotted_bytes / 2 ** 20, 1)
+        })
+    return {"config": {"records": options.records}, "records": rows}
+
+def print_records_report(report: Dict):
+    print_rows(f"Memory per record at {report['config']['records']} records (tracemalloc, "
+               f"dicts with ISO timestamps vs slotted dataclasses with epoch floats)", report["records"])
+
+def time_per_call(call, count: int) -> float:
+    started = time.perf_counter()
+    for _ in range(count):
+        call()
+    return (time.perf_counter() - started) / count * 1e6
+
+async def run_interactions(options: argparse.Namespace) -> Dict:
+    """Per-message cost of logging an interaction once the log is full, with the
+    ring buffer and with the list the bot used to append to and pop(0) from."""
+    bot = load_standalone_bot(options)
+    now = time.time()
+    # A pool of records reused round-robin keeps a 1M-entry log from costing gigabytes
+    pool = [slotted_record(bot, 'interaction', index, now) for index in range(1000)]
+    rows = []
+    for capacity in options.capacities:
+        records = itertools.cycle(pool)
+        log = bot.InteractionLog(capacity)
+        for _ in range(capacity):
+            log.append(next(records))
+        ring_us = time_per_call(lambda: log.append(next(records)), options.appends)
+        since_us = time_per_call(lambda: log.since(log.next_seq - 101), 1000)
+        
+        legacy = [next(records) for _ in range(capacity)]
+        
+        def legacy_append():
+            legacy.append(next(records))
+            if len(legacy) > capacity:
+                legacy.pop(0)
+        
+        # The shift dominates at large capacities, so fewer calls are enough
+        list_us = time_per_call(legacy_append, max(100, min(options.appends, options.appends * 1000 // capacity)))
+        rows.append({
+            "capacity": capacity,
+            "ring_append_us": round(ring_us, 3),
+            "list_pop_us": round(list_us, 3),
+            "since_100_us": round(since_us, 2)
+        })
+        del log, legacy
+    return {"config": {"capacities": options.capacities, "appends": options.appends}, "logs": rows}
+
+def print_interactions_report(report: Dict):
+    print_rows(f"Interaction log cost per message once full ({report['config']['appends']} appends)", report["logs"])
+
+# Messages customers send at each menu step
+INTENT_CORPUS = {
+    'main_menu': [
+        '1', '2', '5', 'hi there', 'i need some general information about my pension',
+        'what is my account balance', 'can i book an appointment for next week', 'how do payments work',
+        'i want to speak to a human please', 'my employer stopped paying in', 'hello, is anyone there?',
+        'can you help me understand my options before i retire in 10 years'
+    ],
+    'pension_info': [
+        'a', 'b', 'd', 'what are the contribution rates', 'tell me about investment options',
+        'what retirement benefits do i get', 'is there a tax break on pension savings',
+        'what about a lump sum at 55'
+    ],
+    'contribution_help': [
+        'how much should i pay in each month', 'i want to increase my contribution',
+        'show me my payment history for the past year', 'what rate does my employer match', 'thanks'
+    ],
+    'agent_selection': [
+        '1', '2', '4', 'my account is locked', 'i want to make a complaint',
+        'the app keeps crashing, technical issue', 'i need help planning retirement', 'contribution question'
+    ],
+    'message_type': [
+        'what is my balance', 'i have a problem with a payment', 'book a consultation',
+        'i want to change my contribution', 'let me talk to an agent', 'good morning', 'thanks for your help'
+    ]
+}
+
+def substring_classify(table: Dict, step: str, message_text: str) -> Optional[str]:
+    # The chains of any(word in message_text ...) checks the classifier replaced
+    for intent, keywords in table.get(step, ()):
+        if any(word in message_text for word in keywords):
+            return intent
+    return None
+
+async def run_intents(options: argparse.Namespace) -> Dict:
+    bot = load_standalone_bot(options)
+    classifier = bot.IntentClassifier(bot.INTENT_KEYWORDS)
+    corpus = [(step, message) for step, messages in INTENT_CORPUS.items() for message in messages]
+    rows = []
+    for name, classify in (('substring', lambda step, text: substring_classify(bot.INTENT_KEYWORDS, step, text)),
+                           ('classifier', classifier.classify)):
+        started = time.perf_counter()
+        for _ in range(options.repeat):
+            for step, message in corpus:
+                classify(step, message)
+        rows.append({
+            "engine": name,
+            "us_per_message": round((time.perf_counter() - started) / (options.repeat * len(corpus)) * 1e6, 3)
+        })
+    # Messages the two disagree on, which is mostly the substring scan misfiring
+    differences = [
+        {"step": step, "message": message, "substring": substring_classify(bot.INTENT_KEYWORDS, step, message),
+         "classifier": classifier.classify(step, message)}
+        for step, message in corpus
+        if substring_classify(bot.INTENT_KEYWORDS, step, message) != classifier.classify(step, message)
+    ]
+    return {"config": {"messages": len(corpus), "repeat": options.repeat}, "engines": rows, "differences": differences}
+
+def print_intents_report(report: Dict):
+    print_rows(f"Intent classification over {report['config']['messages']} corpus messages "
+               f"x {report['config']['repeat']}", report["engines"])
+    if report["differences"]:
+        print_rows("Messages classified differently", report["differences"])
+
+def call_percentiles(seconds: List[float]) -> Dict[str, Optional[float]]:
+    # Like percentiles(), in microseconds, for single calls
+    if not seconds:
+        return {"p50": None, "p99": None, "max": None}
+    ordered = sorted(seconds)
+    return {
+        "p50": round(ordered[len(ordered) // 2] * 1e6, 2),
+        "p99": round(ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))] * 1e6, 2),
+        "max": round(ordered[-1] * 1e6, 2)
+    }
+
+def timed(call, *args) -> tuple:
+    started = time.perf_counter()
+    result = call(*args)
+    return result, time.perf_counter() - started
+
+ROUTING_PRIORITIES = (('urgent', 0.05), ('high', 0.15), ('normal', 0.7), ('low', 0.1))
+
+async def run_routing(options: argparse.Namespace) -> Dict:
+    """Simulates --tickets agent requests against --agents agents through AgentRouter,
+    arriving faster than they are served so queues build, and times every router call.
+    
+    Simulated time is an event heap; only the router calls themselves are timed.
+    """
+    bot = load_standalone_bot(options)
+    rng = random.Random(options.seed)
+    categories = list(bot.AGENT_ROSTER)
+    roster = {category: [] for category in categories}
+    for index in range(options.agents):
+        roster[categories[index % len(categories)]].append({'id': f'AG{index:04d}', 'name': f'Agent {index}'})
+    router = bot.AgentRouter(roster, options.capacity)
+    slots = options.agents * options.capacity
+    arrival_rate = options.load * slots / options.service_time
+    
+    events = []
+    arrival = 0.0
+    for index in range(options.tickets):
+        arrival += rng.expovariate(arrival_rate)
+        ticket = bot.Ticket(
+            id=f'TKBENCH{index:08d}', customer_id=f'4475{index:08d}', customer_name='Benchmark User',
+            initial_message='help', created_at=arrival, category=rng.choice(categories),
+            priority=rng.choices([name for name, _ in ROUTING_PRIORITIES], [share for _, share in ROUTING_PRIORITIES])[0]
+        )
+        bot.agents_data['tickets'][ticket.id] = ticket
+        heapq.heappush(events, (arrival, index, 'arrive', ticket))
+    sequence = itertools.count(options.tickets)
+    
+    calls = {"assign": [], "release": [], "queue_position": [], "position_scan": []}
+    waits: Dict[str, List[float]] = {name: [] for name, _ in ROUTING_PRIORITIES}
+    handled = {agent['id']: 0 for agents in roster.values() for agent in agents}
+    max_depth = 0
+    
+    def start(ticket, agent, now):
+        ticket.status, ticket.assigned_agent, ticket.assigned_at = 'assigned', agent['id'], now
+        handled[agent['id']] += 1
+        waits[ticket.priority].append(now - ticket.created_at)
+        heapq.heappush(events, (now + rng.expovariate(1 / options.service_time), next(sequence), 'finish', ticket))
+    
+    while events:
+        now, _, kind, ticket = heapq.heappop(events)
+        if kind == 'arrive':
+            agent, seconds = timed(router.assign, ticket)
+            calls["assign"].append(seconds)
+            if agent is not None:
+                start(ticket, agent, now)
+                continue
+            ticket.status = 'queued'
+            queue = router.ticket_queues[router.route_category(ticket.category)]
+            max_depth = max(max_depth, len(queue))
+            # What every message from a waiting customer pays, and the scan it replaced
+            position, seconds = timed(router.queue_position, ticket.id)
+            calls["queue_position"].append(seconds)
+            entry = router.queued[ticket.id]
+            scanned, seconds = timed(lambda: sum(1 for other in queue if other < entry) + 1)
+            calls["position_scan"].append(seconds)
+            assert scanned == position
+            if rng.random() < options.abandon_rate:
+                heapq.heappush(events, (now + rng.expovariate(1 / options.patience), next(sequence), 'abandon', ticket))
+        elif kind == 'abandon':
+            if ticket.status == 'queued':
+                ticket.status = 'cancelled'
+                _, seconds = timed(router.release, ticket)
+                calls["release"].append(seconds)
+        else:
+            ticket.status = 'resolved'
+            promoted, seconds = timed(router.release, ticket)
+            calls["release"].append(seconds)
+            if promoted is not None:
+                start(promoted[0], promoted[1], now)
+    
+    counts = list(handled.values())
+    return {
+        "config": {"tickets": options.tickets, "agents": options.agents, "capacity": options.capacity,
+                   "load": options.load, "service_time": options.service_time, "abandon_rate": options.abandon_rate},
+        "calls": [dict(call=name, calls=len(seconds), **call_percentiles(seconds)) for name, seconds in calls.items()],
+        "waits": [
+            {"priority": name, "tickets": len(values), **{f"{key}_min": None if value is None else round(value / 60000, 1)
+                                                          for key, value in percentiles(values).items()}}
+            for name, values in waits.items()
+        ],
+        "fairness": {
+            "max_queue_depth": max_depth,
+            "handled_min": min(counts),
+            "handled_max": max(counts),
+            # Jain's index: 1.0 when every agent handled the same number of tickets
+            "jain_index": round(sum(counts) ** 2 / (len(counts) * sum(count * count for count in counts)), 4)
+        }
+    }
+
+def print_routing_report(report: Dict):
+    config = report["config"]
+    print_rows(f"Router calls for {config['tickets']} tickets, {config['agents']} agents x {config['capacity']} "
+               f"slots at {config['load']:.0%} load (microseconds)", report["calls"])
+    print_rows("Simulated wait for an agent by priority (minutes)", report["waits"])
+    print(f"\nFairness: {report['fairness']}")
+
+TICKET_STATUSES = (('resolved', 0.8), ('assigned', 0.1), ('queued', 0.05), ('open', 0.05))
+
+def tickets_customer(index: int) -> str:
+    # Customers come back: 200,000 of them share the synthetic tickets
+    return f'4476{index % 200000:08d}'
+
+def synthetic_tickets(bot, count: int, now: float, seed: int):
+    """count tickets over the last 90 days, oldest first, sharing one short transcript."""
+    rng = random.Random(seed)
+    messages = [bot.TicketMessage(sender='customer', message='My statement looks wrong', timestamp=now),
+                bot.TicketMessage(sender='agent', message='Let me check that for you', timestamp=now)]
+    categories = list(bot.AGENT_ROSTER)
+    statuses = [name for name, _ in TICKET_STATUSES]
+    weights = [share for _, share in TICKET_STATUSES]
+    for index in range(count):
+        created = now - 90 * 86400 * (1 - index / count)
+        status = rng.choices(statuses, weights)[0]
+        category = rng.choice(categories)
+        yield bot.Ticket(
+            id=f'TKBENCH{index:09d}', customer_id=tickets_customer(index), customer_name='Benchmark User',
+            initial_message='help', created_at=created, status=status, category=category,
+            assigned_agent=rng.choice(bot.AGENT_ROSTER[category])['id'] if status != 'queued' else None,
+            assigned_at=created + 60,
+            first_response_at=created + 120, closed_at=created + 3600 if status == 'resolved' else None,
+            rating=rng.randint(1, 5) if status == 'resolved' else None, messages=messages
+        )
+
+def full_scan_tickets(bot) -> bytes:
+    # What the endpoint did before paging: every ticket, with the summary counted over them all
+    tickets = [ticket.to_dict() for ticket in bot.agents_data['tickets'].values()]
+    summary = {
+        "total": len(tickets),
+        "open": len([ticket for ticket in tickets if ticket['status'] in bot.OPEN_TICKET_STATUSES]),
+        "resolved": len([ticket for ticket in tickets if ticket['status'] == 'resolved'])
+    }
+    return json.dumps({"data": tickets, "summary": summary}).encode('utf-8')
+
+async def run_tickets(options: argparse.Namespace) -> Dict:
+    """Times /api/powerbi/tickets pages and the summary at each ticket count,
+    against building and encoding the whole list as the endpoint used to."""
+    bot = load_standalone_bot(options)
+    now = time.time()
+    rows = []
+    for size in options.sizes:
+        bot.agents_data['tickets'].clear()
+        bot.ticket_aggregates = bot.TicketAggregates()
+        gc.collect()
+        for ticket in synthetic_tickets(bot, size, now, options.seed):
+            bot.agents_data['tickets'][ticket.id] = ticket
+            bot.ticket_aggregates.add(ticket)
+        
+        timings = {}
+        for name, query in (('first', {}), ('middle', {'cursor': str(size // 2)}),
+                            ('since_24h', {'since': str(now - 86400)})):
+            started = time.perf_counter()
+            for _ in range(options.repeat):
+                response = await bot.get_tickets(limit=options.page_size, **query)
+            timings[f"page_{name}_ms"] = round((time.perf_counter() - started) / options.repeat * 1000, 2)
+            timings.setdefault("page_kb", round(len(response.body) / 1024))
+        rows.append({
+            "tickets": size,
+            **timings,
+            "summary_us": round(time_per_call(bot.ticket_aggregates.summary, 1000), 2),
+            "full_scan_ms": None,
+            "full_scan_mb": None
+        })
+        if size <= options.scan_max:
+            gc.collect()
+            started = time.perf_counter()
+            body = full_scan_tickets(bot)
+            rows[-1]["full_scan_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            rows[-1]["full_scan_mb"] = round(len(body) / 2 ** 20, 1)
+            del body
+    bot.agents_data['tickets'].clear()
+    return {"config": {"sizes": options.sizes, "page_size": options.page_size, "repeat": options.repeat}, "sizes": rows}
+
+def print_tickets_report(report: Dict):
+    print_rows(f"/api/powerbi/tickets with {report['config']['page_size']}-ticket pages "
+               f"vs the whole list as one response", report["sizes"])
+
+def message_id(index: int) -> str:
+    # Shaped like a WhatsApp wamid, which runs to about 60 characters
+    return f'wamid.HBgLMjc4MjAwMDAwMDAVAgASGBQz{index:016X}QTRBMEQ5RjE4RjI1QjJCMkU2QQA='
+
+async def run_dedup(options: argparse.Namespace) -> Dict:
+    """Memory and claim cost of the de-duplication set after --sizes message ids,
+    against keeping the id strings themselves in a set."""
+    bot = load_standalone_bot(options)
+    rows = []
+    for size in options.sizes:
+        for name in ('generations', 'string_set'):
+            gc.collect()
+            tracemalloc.start()
+            if name == 'generations':
+                seen = bot.SeenMessageSet(ttl=bot.DEDUP_TTL, max_entries=size)
+                claim = seen.claim
+            else:
+                seen = set()
+                
+                def claim(message: str) -> bool:
+                    if message in seen:
+                        return False
+                    seen.add(message)
+                    return True
+            for index in range(size):
+                claim(message_id(index))
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            held = len(seen)
+            # Timed untraced: ids not seen before, then redeliveries of recent ones
+            fresh = [message_id(index) for index in range(size, size + options.claims)]
+            repeats = [message_id(index) for index in range(size - options.claims, size)]
+            new_us = time_per_call(lambda ids=iter(fresh): claim(next(ids)), options.claims)
+            duplicate_us = time_per_call(lambda ids=iter(repeats): claim(next(ids)), options.claims)
+            rows.append({
+                "ids": size,
+                "store": name,
+                "held": held,
+                "mb": round(current / 2 ** 20, 1),
+                "bytes_per_id": round(current / held, 1),
+                "new_us": round(new_us, 3),
+                "duplicate_us": round(duplicate_us, 3)
+            })
+            del seen, claim, fresh, repeats
+    return {"config": {"sizes": options.sizes, "claims": options.claims}, "stores": rows}
+
+def print_dedup_report(report: Dict):
+    print_rows(f"Seen message ids (tracemalloc; claim times untraced, {report['config']['claims']} claims each)",
+               report["stores"])
+
+def scan_tickets(bot, filters: Dict[str, List]) -> List:
+    # The linear filter the indexes replaced
+    return [
+        ticket for ticket in bot.agents_data['tickets'].values()
+        if all(getattr(ticket, name) in values for name, values in filters.items())
+    ]
+
+async def run_index(options: argparse.Namespace) -> Dict:
+    """Times TicketIndex queries over --tickets tickets against scanning them all."""
+    bot = load_standalone_bot(options)
+    now = time.time()
+    bot.agents_data['tickets'].clear()
+    bot.ticket_index = bot.TicketIndex()
+    tickets = list(synthetic_tickets(bot, options.tickets, now, options.seed))
+    started = time.perf_counter()
+    for ticket in tickets:
+        bot.agents_data['tickets'][ticket.id] = ticket
+        bot.ticket_index.add_ticket(ticket)
+    build_seconds = time.perf_counter() - started
+    del tickets
+    
+    queries = {
+        "customer": {'customer_id': [tickets_customer(options.tickets // 2)]},
+        "agent_open": {'assigned_agent': ['AG003'], 'status': list(bot.OPEN_TICKET_STATUSES)},
+        "category_queued": {'category': ['technical'], 'status': ['queued']},
+        "open": {'status': list(bot.OPEN_TICKET_STATUSES)}
+    }
+    rows = []
+    for name, filters in queries.items():
+        found = bot.ticket_index.find_tickets(**filters)
+        scanned = scan_tickets(bot, filters)
+        assert [ticket.id for ticket in found] == [ticket.id for ticket in scanned]
+        index_ms = time_per_call(lambda: bot.ticket_index.find_tickets(**filters), options.repeat) / 1000
+        scan_ms = time_per_call(lambda: scan_tickets(bot, filters), max(1, options.repeat // 10)) / 1000
+        rows.append({
+            "query": name,
+            "matches": len(found),
+            "index_ms": round(index_ms, 3),
+            "scan_ms": round(scan_ms, 1),
+            "speedup": round(scan_ms / index_ms)
+        })
+    bot.agents_data['tickets'].clear()
+    return {
+        "config": {"tickets": options.tickets, "repeat": options.repeat},
+        "build_us_per_ticket": round(build_seconds / options.tickets * 1e6, 2),
+        "queries": rows
+    }
+
+def print_index_report(report: Dict):
+    print_rows(f"Ticket queries over {report['config']['tickets']} tickets, indexed vs scanned", report["queries"])
+    print(f"\nIndexing on insert: {report['build_us_per_ticket']} us per ticket")
+
+class LegacyWhatsAppMessage(BaseModel):
+    # The request model the webhook endpoint declared before it parsed raw bodies
+    object: str
+    entry: List[Dict[str, Any]]
+
+def legacy_parse_webhook(body: bytes) -> List[tuple]:
+    message = LegacyWhatsAppMessage(**json.loads(body))
+    batch = []
+    for entry in message.entry:
+        for change in entry.get('changes', []):
+            if change.get('field') == 'messages':
+                messages = change.get('value', {}).get('messages', [])
+                contacts = change.get('value', {}).get('contacts', [])
+                for msg in messages:
+                    batch.append((msg, contacts[0] if contacts else {}))
+    return batch
+
+def dict_parse_webhook(body: bytes) -> List[tuple]:
+    # Plain json.loads and dict access, validating nothing
+    payload = json.loads(body)
+    batch = []
+    for entry in payload.get('entry', ()):
+        for change in entry.get('changes', ()):
+            value = change.get('value')
+            if change.get('field') == 'messages' and value:
+                contacts = value.get('contacts')
+                contact = contacts[0] if contacts else {}
+                for msg in value.get('messages', ()):
+                    batch.append((msg, contact))
+    return batch
+
+async def run_webhooks(options: argparse.Namespace) -> Dict:
+    """Parse and dispatch cost per webhook body: the bot's parse_webhook (orjson and
+    a TypeAdapter) against json.loads with dict access and the original model."""
+    bot = load_standalone_bot(options)
+    bodies = {
+        "message": webhook_payload('447000000001', 'Benchmark User', 'wamid.bench.1', 'what is my balance'),
+        "status": status_payload('447000000001', 'wamid.bench.1.reply')
+    }
+    parsers = {"model": legacy_parse_webhook, "json_dict": dict_parse_webhook, "parse_webhook": bot.parse_webhook}
+    message = dict_parse_webhook(bodies["message"])[0]
+    for name, parse in parsers.items():
+        (msg, contact), = parse(bodies["message"])
+        # The TypeAdapter keeps only the declared fields, so compare those
+        assert (msg['from'], msg['text'], contact['profile']) == (message[0]['from'], message[0]['text'], message[1]['profile']), name
+    rows = []
+    for kind, body in bodies.items():
+        row = {"webhook": kind, "bytes": len(body)}
+        for name, parse in parsers.items():
+            row[f"{name}_us"] = round(time_per_call(lambda: parse(body), options.webhooks), 2)
+        rows.append(row)
+    return {"config": {"webhooks": options.webhooks, "orjson": bot.orjson is not None}, "webhooks": rows}
+
+def print_webhooks_report(report: Dict):
+    print_rows(f"Parse and dispatch per webhook ({report['config']['webhooks']} each, "
+               f"orjson {'on' if report['config']['orjson'] else 'off'})", report["webhooks"])
+
+async def read_export(call) -> tuple:
+    """(seconds to the first body chunk, seconds to the last, body bytes) of one
+    export request, calling the endpoint directly."""
+    started = time.perf_counter()
+    response = await call()
+    first = None
+    size = 0
+    async for chunk in response.body_iterator:
+        if first is None:
+            first = time.perf_counter() - started
+        size += len(chunk)
+    return first, time.perf_counter() - started, size
+
+async def read_list(call, paged: bool) -> tuple:
+    # The same for a JSON list endpoint; a paged one is followed to its last page
+    started = time.perf_counter()
+    response = await call(None)
+    first = time.perf_counter() - started
+    size = len(response.body)
+    while paged and (cursor := json.loads(response.body)["nextCursor"]):
+        response = await call(cursor)
+        size += len(response.body)
+    return first, time.perf_counter() - started, size
+
+async def trace_peak(read, call, *args) -> float:
+    # Peak traced allocation of one request, in MB; a separate pass as tracing slows it down
+    gc.collect()
+    tracemalloc.start()
+    try:
+        await read(call, *args)
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+async def run_export(options: argparse.Namespace) -> Dict:
+    """Time to first byte, total time and peak memory of the streaming exports,
+    against fetching the same records from the JSON list endpoints."""
+    bot = load_standalone_bot(options)
+    now = time.time() - options.rows
+    log = bot.collections_data['customer_interactions'] = bot.InteractionLog(options.rows)
+    for index in range(options.rows):
+        log.append(slotted_record(bot, 'interaction', index, now))
+    for ticket in synthetic_tickets(bot, options.rows, now, options.seed):
+        bot.agents_data['tickets'][ticket.id] = ticket
+        bot.ticket_aggregates.add(ticket)
+    headers = [(b'accept-encoding', b'gzip')] if options.gzip else []
+    request = bot.Request({'type': 'http', 'method': 'GET', 'path': '/', 'headers': headers})
+    requests = {
+        "interactions": (
+            (read_export, lambda: bot.export_interactions(request, format=options.format)),
+            (read_list, lambda cursor: bot.get_interactions(), False)
+        ),
+        "tickets": (
+            (read_export, lambda: bot.export_tickets(request, format=options.format)),
+            (read_list, lambda cursor: bot.get_tickets(limit=bot.POWERBI_MAX_PAGE_SIZE, cursor=cursor), True)
+        )
+    }
+    rows = []
+    for records, endpoints in requests.items():
+        for endpoint, (read, *args) in zip(('export', 'list'), endpoints):
+            first, total, size = await read(*args)
+            rows.append({
+                "records": records,
+                "endpoint": endpoint,
+                "ttfb_ms": round(first * 1000, 1),
+                "total_ms": round(total * 1000, 1),
+                "mb": round(size / 2 ** 20, 1),
+                "peak_mb": round(await trace_peak(read, *args), 1)
+            })
+    return {"config": {"rows": options.rows, "format": options.format, "gzip": options.gzip,
+                       "chunk_rows": bot.EXPORT_CHUNK_ROWS}, "endpoints": rows}
+
+def print_export_report(report: Dict):
+    config = report["config"]
+    print_rows(f"{config['rows']} records exported as {config['format']}{' (gzip)' if config['gzip'] else ''} "
+               f"in {config['chunk_rows']}-row chunks vs the JSON list endpoints", report["endpoints"])
+
+async def run_latency(options: argparse.Namespace) -> Dict:
+    """Per-message cost of the latency instrumentation in handle_message, and how
+    far the histogram quantiles are from exact ones over lognormal samples."""
+    bot = load_standalone_bot(options)
+    rng = random.Random(options.seed)
+    samples = [rng.lognormvariate(-3, 1) for _ in range(options.samples)]
+    values = itertools.cycle(samples)
+    steps = itertools.cycle([f'step_{index}' for index in range(options.steps)])
+    metrics = bot.LatencyMetrics()
+    histogram = bot.LatencyHistogram()
+    
+    def instrument():
+        # What handle_message adds per message: four clock reads, the callback and observe()
+        received_at = time.monotonic()
+        started_at = time.monotonic()
+        step = next(steps)
+        handled_at = time.monotonic()
+        
+        def on_sent(sent_at: float, sent: bool):
+            metrics.observe(step, received_at, started_at, handled_at, sent_at)
+        
+        on_sent(time.monotonic(), True)
+    
+    calls = {
+        "clock_read": time.monotonic,
+        "record": lambda: histogram.record(next(values)),
+        "observe": lambda: metrics.observe(next(steps), 0.0, next(values), 0.2, 0.5),
+        "per_message": instrument
+    }
+    rows = [{"call": name, "us": round(time_per_call(call, options.calls), 3)} for name, call in calls.items()]
+    
+    exact = sorted(samples)
+    histogram = bot.LatencyHistogram()
+    for value in samples:
+        histogram.record(value)
+    quantiles = []
+    for q in bot.LatencyMetrics.QUANTILES:
+        true = exact[min(len(exact) - 1, int(q * len(exact)))]
+        estimate = histogram.quantile(q)
+        quantiles.append({"quantile": q, "exact_ms": round(true * 1000, 3), "histogram_ms": round(estimate * 1000, 3),
+                          "error_pct": round(abs(estimate - true) / true * 100, 2)})
+    render_ms = time_per_call(lambda: metrics.render('pensionbot_message_latency_seconds'), 100) / 1000
+    return {"config": {"calls": options.calls, "steps": options.steps, "samples": options.samples},
+            "calls": rows, "quantiles": quantiles, "render_ms": round(render_ms, 3)}
+
+def print_latency_report(report: Dict):
+    print_rows(f"Latency instrumentation per call ({report['config']['steps']} steps)", report["calls"])
+    print_rows(f"Histogram quantiles over {report['config']['samples']} lognormal samples", report["quantiles"])
+    print(f"\nRendering /metrics latency series: {report['render_ms']} ms")
+
+async def run_eventlog(options: argparse.Namespace) -> Dict:
+    """Appends interaction events to the event log, flushing every --batches
+    events with one fsync each, then times replay() of the log written."""
+    bot = load_standalone_bot(options)
+    now = time.time() - options.events
+    events = [bot.asdict(slotted_record(bot, 'interaction', index, now)) for index in range(options.events)]
+    rows = []
+    for batch in options.batches:
+        # One fsync per event is slow enough that a sample of them will do
+        count = min(options.events, batch * options.max_flushes)
+        with tempfile.TemporaryDirectory(prefix='pensionbot-bench-') as directory:
+            event_log = bot.EventLog(directory)
+            event_log.open()
+            append_s = flush_s = 0.0
+            for start in range(0, count, batch):
+                started = time.perf_counter()
+                for data in events[start:start + batch]:
+                    event_log.append('interaction', data)
+                flushing = time.perf_counter()
+                await event_log.flush()
+                append_s += flushing - started
+                flush_s += time.perf_counter() - flushing
+            event_log.close()
+            size = os.path.getsize(event_log.log_path)
+            
+            bot.collections_data['customer_interactions'] = bot.InteractionLog()
+            bot.conversation_analytics = bot.ConversationAnalytics()
+            gc.collect()
+            replayed = bot.EventLog(directory)
+            replayed.open()
+            replayed.replay()
+            replayed.close()
+        rows.append({
+            "batch": batch,
+            "events": count,
+            "append_us": round(append_s / count * 1e6, 3),
+            "events_per_s": round(count / (append_s + flush_s)),
+            "fsyncs": event_log.stats["flushes"],
+            "log_mb": round(size / 2 ** 20, 1),
+            "replay_ms": replayed.stats["replay_ms"],
+            "replay_us_per_event": round(replayed.stats["replay_ms"] * 1000 / count, 2)
+        })
+        assert replayed.stats["replayed"] == count
+    return {"config": {"events": options.events, "batches": options.batches}, "batches": rows}
+
+def print_eventlog_report(report: Dict):
+    print_rows("Event log appends by group commit size, and replay of the log written", report["batches"])
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    argv = list(sys.argv[1:] if argv is None else argv)
+    # The end-to-end load test is the default benchmark
+    if not argv or argv[0] not in (*SCENARIOS, '-h', '--help'):
+        argv.insert(0, 'load')
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--app', default=BOT_PATH, help="path of the bot module")
+    common.add_argument('--seed', type=int, default=1)
+    common.add_argument('--save', help="write the report as JSON to this file")
+    parser = argparse.ArgumentParser(description="Benchmarks for the WhatsApp Pension Bot")
+    scenarios = parser.add_subparsers(dest='scenario', metavar='scenario')
+    
+    load = scenarios.add_parser('load', parents=[common], help="end-to-end webhook load test (default)")
+    load.add_argument('--mode', choices=('inprocess', 'http'), default='inprocess',
+                      help="drive the ASGI app directly or over HTTP with the bot under uvicorn")
+    load.add_argument('--users', type=int, default=50, help="concurrent simulated users")
+    load.add_argument('--journeys', type=int, default=1000, help="conversations per round, one new user each")
+    load.add_argument('--rounds', type=int, default=3, help="measured rounds; throughput is the median round")
+    load.add_argument('--warmup', type=int, default=200, help="unmeasured journeys run first")
+    load.add_argument('--mix', help=f"journey weights, e.g. agent=2,menu=1 (journeys: {', '.join(JOURNEYS)})")
+    load.add_argument('--think-time', type=float, default=0.0, help="mean pause between a reply and the next message (s)")
+    load.add_argument('--reply-timeout', type=float, default=30.0, help="seconds to wait for a reply before counting it lost")
+    load.add_argument('--duplicate-rate', type=float, default=0.0, help="share of webhooks redelivered with the same id")
+    load.add_argument('--status-callbacks', type=int, default=0, help="status webhooks sent after each reply")
+    load.add_argument('--stub-latency', type=float, default=0.0, help="Graph API response time (s)")
+    load.add_argument('--stub-error-rate', type=float, default=0.0, help="share of sends answered with a 500")
+    load.add_argument('--stub-throttle-rate', type=float, default=0.0, help="share of sends answered with a 429")
+    load.add_argument('--baseline', help="JSON report of an earlier run to compare against")
+    load.add_argument('--baseline-app', help="another version of the bot module to run in alternation and compare against")
+    load.add_argument('--tolerance', type=float, help="allowed relative regression of every gated metric, "
+                                                      "instead of each metric's own (see GATED_METRICS)")
+    load.add_argument('--repeat', type=int, default=3, help="runs, each in a new process; metrics are gated on their median")
+    load.add_argument('--run-timeout', type=float, default=600.0, help="seconds before a repeated run is given up on")
+    
+    client = scenarios.add_parser('client', parents=[common], help="pooled vs per-call outbound HTTP client")
+    client.add_argument('--messages', type=int, default=500, help="sends per round")
+    client.add_argument('--rounds', type=int, default=3)
+    client.add_argument('--warmup', type=int, default=200, help="unmeasured sends per client first")
+    client.add_argument('--concurrency', type=int, default=20, help="concurrent senders")
+    client.add_argument('--stub-latency', type=float, default=0.0, help="Graph API response time (s)")
+    
+    lanes = scenarios.add_parser('lanes', parents=[common], help="per-user ordering and final sessions under interleaving")
+    lanes.add_argument('--users', type=int, default=1000, help="simulated users, all sending at once")
+    lanes.add_argument('--reply-timeout', type=float, default=60.0, help="seconds to wait for all replies")
+    
+    sessions = scenarios.add_parser('sessions', parents=[common], help="session cache memory for many distinct senders")
+    sessions.add_argument('--senders', type=int, default=1000000, help="distinct phone numbers")
+    sessions.add_argument('--caps', type=lambda value: [int(cap) for cap in value.split(',')], default=[100000, 0],
+                          help="comma-separated SESSION_MAX_ENTRIES values to compare, 0 for no cap")
+    
+    records = scenarios.add_parser('records', parents=[common], help="dict vs slotted record memory")
+    records.add_argument('--records', type=int, default=100000, help="records of each type")
+    
+    interactions = scenarios.add_parser('interactions', parents=[common], help="interaction log cost per message")
+    interactions.add_argument('--capacities', type=lambda value: [int(size) for size in value.split(',')],
+                              default=[1000, 100000, 1000000], help="comma-separated INTERACTION_LOG_CAPACITY values")
+    interactions.add_argument('--appends', type=int, default=200000, help="appends timed at each capacity")
+    
+    ratelimit = scenarios.add_parser('ratelimit', parents=[common], help="outbound rate limits against a throttling stub")
+    ratelimit.add_argument('--broadcast', type=int, default=300, help="one-off replies, one recipient each")
+    ratelimit.add_argument('--recipients', type=int, default=5, help="recipients sent a run of replies each")
+    ratelimit.add_argument('--per-recipient', type=int, default=10, help="replies to each of those recipients")
+    ratelimit.add_argument('--stub-rate', type=int, default=50, help="sends the stub accepts per second")
+    ratelimit.add_argument('--stub-recipient-limit', type=int, default=3, help="sends the stub accepts per recipient per window")
+    ratelimit.add_argument('--stub-recipient-window', type=float, default=3.0, help="per-recipient window (s)")
+    ratelimit.add_argument('--rate', type=float, default=40, help="OUTBOUND_RATE of the limited run")
+    ratelimit.add_argument('--burst', type=int, default=10, help="OUTBOUND_BURST of the limited run")
+    ratelimit.add_argument('--recipient-rate', type=float, default=0.5, help="OUTBOUND_RECIPIENT_RATE of the limited run")
+    ratelimit.add_argument('--recipient-burst', type=int, default=1, help="OUTBOUND_RECIPIENT_BURST of the limited run")
+    ratelimit.add_argument('--timeout', type=float, default=120.0, help="seconds to wait for the queue to drain")
+    
+    ids = scenarios.add_parser('ids', parents=[common], help="id uniqueness across concurrent processes")
+    ids.add_argument('--processes', type=int, default=4, help="forked processes generating ids at once")
+    ids.add_argument('--ids', type=int, default=1000000, help="ids per process")
+    
+    intents = scenarios.add_parser('intents', parents=[common], help="keyword classifier vs substring scans")
+    intents.add_argument('--repeat', type=int, default=2000, help="passes over the message corpus")
+    
+    routing = scenarios.add_parser('routing', parents=[common], help="agent assignment latency and fairness")
+    routing.add_argument('--tickets', type=int, default=20000, help="agent requests simulated")
+    routing.add_argument('--agents', type=int, default=40, help="agents, spread over the roster's categories")
+    routing.add_argument('--capacity', type=int, default=3, help="chats per agent (AGENT_CAPACITY)")
+    routing.add_argument('--load', type=float, default=1.2, help="arrival rate over what the agents can serve")
+    routing.add_argument('--service-time', type=float, default=600.0, help="mean simulated chat length (s)")
+    routing.add_argument('--abandon-rate', type=float, default=0.2, help="share of queued customers who give up")
+    routing.add_argument('--patience', type=float, default=900.0, help="mean simulated wait before giving up (s)")
+    
+    tickets = scenarios.add_parser('tickets', parents=[common], help="Power BI ticket pages vs the whole list")
+    tickets.add_argument('--sizes', type=lambda value: [int(size) for size in value.split(',')],
+                         default=[10000, 100000, 1000000], help="comma-separated ticket counts")
+    tickets.add_argument('--page-size', type=int, default=1000, help="tickets per page (POWERBI_PAGE_SIZE)")
+    tickets.add_argument('--repeat', type=int, default=20, help="requests timed per page")
+    tickets.add_argument('--scan-max', type=int, default=1000000, help="largest count the whole list is built for")
+    
+    dedup = scenarios.add_parser('dedup', parents=[common], help="de-duplication memory and claim cost")
+    dedup.add_argument('--sizes', type=lambda value: [int(size) for size in value.split(',')],
+                       default=[1000000, 2000000, 5000000], help="comma-separated DEDUP_MAX_ENTRIES values, filled")
+    dedup.add_argument('--claims', type=int, default=200000, help="claims timed of each kind")
+    
+    index = scenarios.add_parser('index', parents=[common], help="indexed ticket queries vs full scans")
+    index.add_argument('--tickets', type=int, default=1000000, help="tickets indexed")
+    index.add_argument('--repeat', type=int, default=50, help="indexed queries timed; scans run a tenth as often")
+    
+    webhooks = scenarios.add_parser('webhooks', parents=[common], help="webhook parse and dispatch cost")
+    webhooks.add_argument('--webhooks', type=int, default=100000, help="bodies parsed by each parser")
+    
+    export = scenarios.add_parser('export', parents=[common], help="streaming exports vs the JSON list endpoints")
+    export.add_argument('--rows', type=int, default=100000, help="interactions and tickets, each")
+    export.add_argument('--format', choices=('ndjson', 'csv'), default='ndjson')
+    export.add_argument('--gzip', action='store_true', help="ask for a gzipped export")
+    
+    latency = scenarios.add_parser('latency', parents=[common], help="latency histogram cost and accuracy")
+    latency.add_argument('--calls', type=int, default=500000, help="calls timed of each kind")
+    latency.add_argument('--steps', type=int, default=12, help="conversation steps observed round-robin")
+    latency.add_argument('--samples', type=int, default=200000, help="lognormal durations for the accuracy check")
+    
+    eventlog = scenarios.add_parser('eventlog', parents=[common], help="event log group commit and replay")
+    eventlog.add_argument('--events', type=int, default=200000, help="interaction events appended")
+    eventlog.add_argument('--batches', type=lambda value: [int(size) for size in value.split(',')],
+                          default=[1, 100, 1000], help="comma-separated events per flush")
+    eventlog.add_argument('--max-flushes', type=int, default=2000, help="flushes at most, for small batches")
+    return parser.parse_args(argv)
+
+# Options of the load test passed on to each repeated run
+LOAD_OPTIONS = ('app', 'seed', 'mode', 'users', 'journeys', 'rounds', 'warmup', 'mix', 'think_time', 'reply_timeout',
+                'duplicate_rate', 'status_callbacks', 'stub_latency', 'stub_error_rate', 'stub_throttle_rate')
+
+async def run_load_process(options: argparse.Namespace, app: str, path: str) -> Dict:
+    # A new process per run, so neither memory nor warm caches carry over
+    args = [sys.executable, os.path.abspath(__file__), 'load', '--repeat', '1', '--save', path]
+    for name in LOAD_OPTIONS:
+        value = app if name == 'app' else getattr(options, name)
+        if value is not None:
+            args += [f"--{name.replace('_', '-')}", str(value)]
+    process = await asyncio.create_subprocess_exec(*args, stdout=subprocess.DEVNULL)
+    try:
+        returncode = await asyncio.wait_for(process.wait(), options.run_timeout)
+    except asyncio.TimeoutError:
+        # A run that hangs, e.g. on shutdown, must fail the gate rather than stall it
+        process.kill()
+        await process.wait()
+        raise SystemExit(f"Load test of {app} did not finish within {options.run_timeout:.0f}s")
+    if returncode not in (0, 1) or not os.path.exists(path):
+        raise SystemExit(f"Load test of {app} failed")
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def summarize_runs(reports: List[Dict]) -> Dict:
+    """The run with the median throughput, plus every gated metric's median over all runs."""
+    reports = sorted(reports, key=lambda report: report["messages_per_second"])
+    report = reports[len(reports) // 2]
+    report["config"]["repeat"] = len(reports)
+    report["runs"] = [{"messages_per_second": run["messages_per_second"], "lost_replies": run["lost_replies"]}
+                      for run in reports]
+    report["lost_replies"] = sum(run["lost_replies"] for run in reports)
+    report["gated"] = {}
+    for name in GATED_METRICS:
+        samples = [value for value in (metric(run, name) for run in reports) if value is not None]
+        if samples:
+            report["gated"][name] = {"median": round(median(samples), 3), "samples": samples}
+    return report
+
+async def run_load_repeated(options: argparse.Namespace) -> Dict:
+    """Runs the load test --repeat times. With --baseline-app the baseline bot
+    is run in alternation with this one, so a machine that slows down or
+    speeds up during the comparison affects both alike."""
+    apps = [options.app] + ([options.baseline_app] if options.baseline_app else [])
+    runs: Dict[str, List[Dict]] = {app: [] for app in apps}
+    with tempfile.TemporaryDirectory(prefix='pensionbot-bench-') as report_dir:
+        for run in range(options.repeat):
+            # Alternate which goes first so neither always runs on a warmer machine
+            for index, app in enumerate(apps if run % 2 == 0 else apps[::-1]):
+                path = os.path.join(report_dir, f'run-{run}-{index}.json')
+                runs[app].append(await run_load_process(options, app, path))
+    report = summarize_runs(runs[options.app])
+    if options.baseline_app:
+        report["baseline_app"] = summarize_runs(runs[options.baseline_app])
+    return report
+
+async def run_load(options: argparse.Namespace) -> Dict:
+    if options.repeat > 1 or options.baseline_app:
+        return await run_load_repeated(options)
+    stub = StubGraphAPI(options.stub_latency, options.stub_error_rate, options.stub_throttle_rate, options.seed)
+    with tempfile.TemporaryDirectory(prefix='pensionbot-bench-') as data_dir:
+        runner = run_http if options.mode == 'http' else run_inprocess
+        return build_report(options, await runner(options, stub, data_dir), stub)
+
+# Scenario -> (runner, printer)
+SCENARIOS = {
+    'load': (run_load, print_report),
+    'client': (run_client, print_client_report),
+    'lanes': (run_lanes, print_lanes_report),
+    'sessions': (run_sessions, print_sessions_report),
+    'records': (run_records, print_records_report),
+    'interactions': (run_interactions, print_interactions_report),
+    'ratelimit': (run_ratelimit, print_ratelimit_report),
+    'ids': (run_ids, print_ids_report),
+    'intents': (run_intents, print_intents_report),
+    'routing': (run_routing, print_routing_report),
+    'tickets': (run_tickets, print_tickets_report),
+    'dedup': (run_dedup, print_dedup_report),
+    'index': (run_index, print_index_report),
+    'webhooks': (run_webhooks, print_webhooks_report),
+    'export': (run_export, print_export_report),
+    'latency': (run_latency, print_latency_report),
+    'eventlog': (run_eventlog, print_eventlog_report)
+}
+
+async def main(options: argparse.Namespace) -> int:
+    runner, printer = SCENARIOS[options.scenario]
+    report = await runner(options)
+    printer(report)
+    
+    if options.save:
+        with open(options.save, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    
+    baseline = report.get("baseline_app")
+    if baseline is not None:
+        print(f"\nCompared with {options.baseline_app}, run in alternation:")
+    elif getattr(options, 'baseline', None):
+        with open(options.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get("config") != report["config"]:
+            print("\nWarning: baseline was recorded with a different configuration")
+        print(f"\nCompared with {options.baseline}:")
+    if baseline is not None:
+        regressions = compare(report, baseline, options.tolerance)
+        if regressions:
+            print("Regressions:\n  " + "\n  ".join(regressions))
+            return 1
+        print("No regressions")
+    if report.get("failures") or report.get("lost_replies"):
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parse_args())))
@@ -1,31 +1,67 @@
 # main.py - Python WhatsApp Pension Bot
 import os
+import sys
 import json
 import asyncio
 import random
-import string
+import time
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional, Any, Callable
 import logging
+from dataclasses import dataclass, field, fields, asdict
+import re
+import zlib
+import struct
+import heapq
+import bisect
+import csv
+import io
+import itertools
+import fcntl
+import secrets
+import operator
+import weakref
+from collections import OrderedDict, deque
+from abc import ABC, abstractmethod
 
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse, StreamingResponse
 import httpx
+
+try:
+    import redis.asyncio as redis_asyncio
+except ImportError:  # Only needed when SESSION_STORE=redis
+    redis_asyncio = None
+try:
+    import orjson
+except ImportError:  # Optional; webhooks and API responses fall back to the json module
+    orjson = None
 import uvicorn
-from pydantic import BaseModel
+from pydantic import TypeAdapter, ValidationError
+from typing_extensions import TypedDict, NotRequired
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Fast JSON encoding and decoding when orjson is installed
+APIResponse = ORJSONResponse if orjson is not None else JSONResponse
+json_loads = orjson.loads if orjson is not None else json.loads
+
+def json_dumps(value) -> str:
+    # Compact and non-ASCII preserving either way
+    if orjson is not None:
+        return orjson.dumps(value).decode('utf-8')
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
 # Initialize FastAPI app
-app = FastAPI(title="WhatsApp Pension Bot", version="6.0")
+app = FastAPI(title="WhatsApp Pension Bot", version="6.0", default_response_class=APIResponse)
 
 # Global storage (in production, use a database)
-user_sessions = {}
 agents_data = {
-    "available": [],
-    "busy": {},
+    "available": {},  # agent_id -> free ticket slots
+    "busy": {},       # agent_id -> ids of tickets the agent is handling
     "tickets": {},
     "collections": []
 }
@@ -43,17 +79,1597 @@ WHATSAPP_TOKEN = os.getenv('WHATSAPP_TOKEN')
 PHONE_NUMBER_ID = os.getenv('PHONE_NUMBER_ID')
 VERIFY_TOKEN = os.getenv('VERIFY_TOKEN')
 
-class WhatsAppMessage(BaseModel):
+# Distinguishes nodes in generated ticket/complaint/session ids (0-255); give
+# every host running the bot its own value. Unset, each process picks random
+# bits instead, which is unique with high probability but not guaranteed
+ID_NODE_ID = int(os.environ['ID_NODE_ID']) if os.getenv('ID_NODE_ID') else None
+
+# Session storage: "memory" keeps sessions per process, "redis" shares them
+# between uvicorn workers and nodes
+SESSION_STORE = os.getenv('SESSION_STORE', 'memory')
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+SESSION_KEY_PREFIX = os.getenv('SESSION_KEY_PREFIX', 'pensionbot:session:')
+SESSION_TTL = int(os.getenv('SESSION_TTL', 86400))  # idle seconds, 0 disables expiry
+SESSION_MAX_ENTRIES = int(os.getenv('SESSION_MAX_ENTRIES', 100000))
+SESSION_SWEEP_INTERVAL = float(os.getenv('SESSION_SWEEP_INTERVAL', 60))
+# Redis only: a user's session is locked from load to save so two workers
+# cannot interleave their messages; a lock not released expires after this
+SESSION_LOCK_TIMEOUT = float(os.getenv('SESSION_LOCK_TIMEOUT', 30))
+
+# Webhook de-duplication: Meta redelivers messages it thinks we missed, so
+# message ids are remembered (in the session store) for at least DEDUP_TTL.
+# The memory store holds at most DEDUP_MAX_ENTRIES ids per worker, about
+# 70 bytes each; the default is a day at ~12 inbound messages a second
+DEDUP_TTL = int(os.getenv('DEDUP_TTL', 86400))
+DEDUP_MAX_ENTRIES = int(os.getenv('DEDUP_MAX_ENTRIES', 1000000))
+DEDUP_GENERATIONS = int(os.getenv('DEDUP_GENERATIONS', 4))
+DEDUP_KEY_PREFIX = os.getenv('DEDUP_KEY_PREFIX', 'pensionbot:seen:')
+
+# Optional JSON file overriding keywords, flow transitions and responses;
+# it is re-read whenever it changes, without restarting workers
+CONVERSATION_FLOW_FILE = os.getenv('CONVERSATION_FLOW_FILE')
+CONVERSATION_FLOW_RELOAD_INTERVAL = float(os.getenv('CONVERSATION_FLOW_RELOAD_INTERVAL', 5))
+
+# Number of tickets an agent can handle at the same time
+AGENT_CAPACITY = int(os.getenv('AGENT_CAPACITY', 3))
+
+# Agent chats with no messages for this long are closed and their slot freed;
+# tickets still waiting are dropped once the customer's session has expired
+AGENT_IDLE_TIMEOUT = float(os.getenv('AGENT_IDLE_TIMEOUT', 1800))  # seconds, 0 disables
+AGENT_IDLE_SWEEP_INTERVAL = float(os.getenv('AGENT_IDLE_SWEEP_INTERVAL', 60))
+
+# Smoothing factor for the service-time moving average behind wait estimates
+WAIT_EWMA_ALPHA = float(os.getenv('WAIT_EWMA_ALPHA', 0.2))
+
+# Page size for Power BI ticket exports
+POWERBI_PAGE_SIZE = int(os.getenv('POWERBI_PAGE_SIZE', 1000))
+POWERBI_MAX_PAGE_SIZE = int(os.getenv('POWERBI_MAX_PAGE_SIZE', 10000))
+EXPORT_CHUNK_ROWS = int(os.getenv('EXPORT_CHUNK_ROWS', 500))
+
+# Number of recent interactions kept for Power BI
+INTERACTION_LOG_CAPACITY = int(os.getenv('INTERACTION_LOG_CAPACITY', 1000))
+
+# Rolling windows served by the conversation analytics endpoint (s/m/h/d suffixes)
+ANALYTICS_WINDOWS = os.getenv('ANALYTICS_WINDOWS', '1h,24h,7d,30d')
+ANALYTICS_DEFAULT_WINDOW = os.getenv('ANALYTICS_DEFAULT_WINDOW', '24h')
+ANALYTICS_WINDOW_BUCKETS = int(os.getenv('ANALYTICS_WINDOW_BUCKETS', 60))
+# A user's messages belong to one conversation until they go quiet this long
+ANALYTICS_CONVERSATION_IDLE = float(os.getenv('ANALYTICS_CONVERSATION_IDLE', 1800))
+
+# Durable event log for tickets, complaints and interactions. Point
+# EVENT_LOG_DIR at a mounted volume so data survives redeploys. Every uvicorn
+# worker keeps its files in its own worker-N subdirectory, claimed on startup.
+EVENT_LOG_ENABLED = os.getenv('EVENT_LOG_ENABLED', 'true').lower() == 'true'
+EVENT_LOG_DIR = os.getenv('EVENT_LOG_DIR', 'data')
+WORKER_SLOTS = int(os.getenv('WORKER_SLOTS', 16))
+EVENT_LOG_FLUSH_INTERVAL = float(os.getenv('EVENT_LOG_FLUSH_INTERVAL', 0.2))
+EVENT_LOG_SNAPSHOT_EVERY = int(os.getenv('EVENT_LOG_SNAPSHOT_EVERY', 100000))
+
+# Ticket transcripts: open tickets keep their newest TRANSCRIPT_TAIL messages in
+# memory and spill older ones to compressed segment files once the tail has
+# doubled; resolved tickets are archived whole. Read back on demand.
+TRANSCRIPT_ARCHIVE_ENABLED = os.getenv('TRANSCRIPT_ARCHIVE_ENABLED', str(EVENT_LOG_ENABLED)).lower() == 'true'
+TRANSCRIPT_ARCHIVE_DIR = os.getenv('TRANSCRIPT_ARCHIVE_DIR', os.path.join(EVENT_LOG_DIR, 'transcripts'))
+TRANSCRIPT_TAIL = int(os.getenv('TRANSCRIPT_TAIL', 20))
+TRANSCRIPT_SEGMENT_BYTES = int(os.getenv('TRANSCRIPT_SEGMENT_BYTES', 64 * 1024 * 1024))
+GRAPH_API_URL = os.getenv('GRAPH_API_URL', 'https://graph.facebook.com/v18.0')
+
+# Outbound HTTP client configuration
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', 100))
+HTTP_MAX_KEEPALIVE = int(os.getenv('HTTP_MAX_KEEPALIVE', 20))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', 30))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', 10))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5))
+HTTP2_ENABLED = os.getenv('HTTP2_ENABLED', 'true').lower() == 'true'
+
+# Shared client, created on startup and reused for every outbound request
+http_client: Optional[httpx.AsyncClient] = None
+http_stats = {
+    "requests": 0,
+    "errors": 0,
+    "in_flight": 0
+}
+
+# Outbound send scheduling. Rates are messages per second, 0 disables a limit;
+# Graph API allows ~80/s per phone number and throttles bursts to one user.
+OUTBOUND_RATE = float(os.getenv('OUTBOUND_RATE', 80))
+OUTBOUND_BURST = int(os.getenv('OUTBOUND_BURST', 80))
+OUTBOUND_RECIPIENT_RATE = float(os.getenv('OUTBOUND_RECIPIENT_RATE', 1))
+OUTBOUND_RECIPIENT_BURST = int(os.getenv('OUTBOUND_RECIPIENT_BURST', 5))
+OUTBOUND_CONCURRENCY = int(os.getenv('OUTBOUND_CONCURRENCY', 20))
+OUTBOUND_QUEUE_MAX_SIZE = int(os.getenv('OUTBOUND_QUEUE_MAX_SIZE', 5000))
+
+# Failed sends (timeouts, 5xx, 429) are retried with exponential backoff and
+# full jitter; after SEND_RETRY_ATTEMPTS, or while the circuit breaker is open,
+# replies go to the dead-letter file and are replayed once Graph API recovers.
+SEND_RETRY_ATTEMPTS = int(os.getenv('SEND_RETRY_ATTEMPTS', 4))
+SEND_RETRY_BASE_DELAY = float(os.getenv('SEND_RETRY_BASE_DELAY', 0.5))
+SEND_RETRY_MAX_DELAY = float(os.getenv('SEND_RETRY_MAX_DELAY', 30))
+SEND_BREAKER_THRESHOLD = int(os.getenv('SEND_BREAKER_THRESHOLD', 5))  # consecutive failures
+SEND_BREAKER_RESET = float(os.getenv('SEND_BREAKER_RESET', 30))  # seconds before probing again
+DEAD_LETTER_FILE = os.getenv('DEAD_LETTER_FILE', os.path.join(EVENT_LOG_DIR, 'dead_letters.ndjson'))
+
+# Webhook processing queue configuration
+WORKER_COUNT = int(os.getenv('WORKER_COUNT', 4))
+QUEUE_MAX_SIZE = int(os.getenv('QUEUE_MAX_SIZE', 1000))
+QUEUE_OVERFLOW_POLICY = os.getenv('QUEUE_OVERFLOW_POLICY', 'reject')  # reject | drop_oldest
+QUEUE_DRAIN_TIMEOUT = float(os.getenv('QUEUE_DRAIN_TIMEOUT', 5))
+
+# Messages are acknowledged on receipt and handled by background workers.
+# Each worker owns one lane and a sender is always hashed to the same lane, so
+# a user's messages are handled in order while different users run in parallel.
+message_lanes: List[asyncio.Queue] = []
+worker_tasks: List[asyncio.Task] = []
+# Periodic housekeeping (session sweeper etc.), cancelled on shutdown
+background_tasks: List[asyncio.Task] = []
+queue_stats = {
+    "enqueued": 0,
+    "processed": 0,
+    "failed": 0,
+    "dropped": 0,
+    "rejected": 0,
+    "duplicates": 0,
+    "status_updates": 0,
+    "max_depth": 0,
+    "total_wait_ms": 0.0,
+    "max_wait_ms": 0.0
+}
+
+# Webhook payload. Only the fields the bot reads are declared; everything else
+# Meta sends is dropped by the validator, which is built once at import.
+class WebhookText(TypedDict):
+    body: str
+
+WebhookMessage = TypedDict('WebhookMessage', {'from': str, 'id': NotRequired[str], 'text': NotRequired[WebhookText]})
+
+class WebhookProfile(TypedDict):
+    name: NotRequired[str]
+
+class WebhookContact(TypedDict):
+    profile: NotRequired[WebhookProfile]
+
+class WebhookValue(TypedDict):
+    messages: NotRequired[List[WebhookMessage]]
+    contacts: NotRequired[List[WebhookContact]]
+
+class WebhookChange(TypedDict):
+    field: str
+    value: NotRequired[WebhookValue]
+
+class WebhookEntry(TypedDict):
+    changes: NotRequired[List[WebhookChange]]
+
+class WhatsAppMessage(TypedDict):
     object: str
-    entry: List[Dict[str, Any]]
+    entry: List[WebhookEntry]
 
+webhook_validator = TypeAdapter(WhatsAppMessage)
+
+# Status updates (sent, delivered, read) have no "messages" key and skip validation
+MESSAGES_KEY_PATTERN = re.compile(rb'"messages"\s*:')
+
+# Record types. Timestamps are kept as epoch seconds and only converted to
+# ISO strings when records leave the service through the API.
+def to_iso(timestamp: Optional[float]) -> Optional[str]:
+    return datetime.fromtimestamp(timestamp).isoformat() if timestamp is not None else None
+
+@dataclass(slots=True)
 class UserSession:
-    def __init__(self, step: str = 'welcome', name: str = 'there', data: Dict = None):
-        self.step = step
-        self.name = name
-        self.data = data or {}
-        self.ticket_id = None
-        self.complaint = None
+    step: str = 'welcome'
+    name: str = 'there'
+    data: Dict = field(default_factory=dict)
+    ticket_id: Optional[str] = None
+    complaint: Optional[Dict] = None
+
+@dataclass(slots=True)
+class TicketMessage:
+    sender: str
+    message: str
+    timestamp: float
+    agent_id: Optional[str] = None
+    
+    def to_dict(self) -> Dict:
+        data = {'sender': self.sender, 'message': self.message, 'timestamp': to_iso(self.timestamp)}
+        if self.sender == 'agent':
+            data['agent_id'] = self.agent_id
+        return data
+
+@dataclass(slots=True)
+class Ticket:
+    id: str
+    customer_id: str
+    customer_name: str
+    initial_message: str
+    created_at: float
+    status: str = 'new'
+    priority: str = 'normal'
+    category: str = 'general'
+    department: Optional[str] = None
+    assigned_agent: Optional[str] = None
+    agent_name: Optional[str] = None
+    assigned_at: Optional[float] = None
+    first_response_at: Optional[float] = None
+    closed_at: Optional[float] = None
+    rating: Optional[int] = None  # 1 (very poor) to 5 (excellent)
+    rated_at: Optional[float] = None
+    archived_messages: int = 0  # leading messages moved to the transcript archive
+    messages: List[TicketMessage] = field(default_factory=list)
+    
+    @property
+    def message_count(self) -> int:
+        return self.archived_messages + len(self.messages)
+    
+    def to_dict(self, messages: Optional[List[TicketMessage]] = None) -> Dict:
+        # Only the in-memory tail unless a transcript is passed in: reading archived
+        # messages blocks, so callers load it off the event loop (load_transcripts)
+        if messages is None:
+            messages = self.messages
+        return {
+            'id': self.id,
+            'customer_id': self.customer_id,
+            'customer_name': self.customer_name,
+            'status': self.status,
+            'priority': self.priority,
+            'created_at': to_iso(self.created_at),
+            'initial_message': self.initial_message,
+            'category': self.category,
+            'department': self.department,
+            'assigned_agent': self.assigned_agent,
+            'agent_name': self.agent_name,
+            'assigned_at': to_iso(self.assigned_at),
+            'closed_at': to_iso(self.closed_at),
+            'rating': self.rating,
+            'rated_at': to_iso(self.rated_at),
+            'message_count': self.message_count,
+            'messages': [message.to_dict() for message in messages]
+        }
+
+@dataclass(slots=True)
+class ComplaintTicket:
+    id: str
+    customer_id: str
+    type: str
+    date_time: str
+    details: str
+    created_at: float
+    follow_up_date: float
+    severity: str = 'medium'
+    status: str = 'open'
+    assigned_to: str = 'complaints_team'
+    
+    def to_dict(self) -> Dict:
+        return {
+            'id': self.id,
+            'customer_id': self.customer_id,
+            'type': self.type,
+            'date_time': self.date_time,
+            'details': self.details,
+            'severity': self.severity,
+            'status': self.status,
+            'created_at': to_iso(self.created_at),
+            'assigned_to': self.assigned_to,
+            'follow_up_date': to_iso(self.follow_up_date)
+        }
+
+@dataclass(slots=True)
+class Interaction:
+    timestamp: float
+    user_id: str
+    user_message: str
+    bot_response: str
+    conversation_step: str
+    message_type: str
+    response_time: int
+    session_id: str
+    seq: int = 0
+    
+    def to_dict(self) -> Dict:
+        return {
+            'seq': self.seq,
+            'timestamp': to_iso(self.timestamp),
+            'user_id': self.user_id,
+            'user_message': self.user_message,
+            'bot_response': self.bot_response,
+            'conversation_step': self.conversation_step,
+            'message_type': self.message_type,
+            'response_time': self.response_time,
+            'session_id': self.session_id
+        }
+
+class InteractionLog:
+    """Fixed-capacity ring buffer of interactions.
+    
+    Every appended interaction gets a sequence number, so consumers can ask
+    for everything after the last seq they saw without rescanning the log.
+    """
+    
+    def __init__(self, capacity: int = INTERACTION_LOG_CAPACITY):
+        self.capacity = capacity
+        self.items: List[Optional[Interaction]] = [None] * capacity
+        self.next_seq = 0
+    
+    @property
+    def first_seq(self) -> int:
+        return max(0, self.next_seq - self.capacity)
+    
+    def append(self, interaction: Interaction):
+        interaction.seq = self.next_seq
+        self.items[self.next_seq % self.capacity] = interaction
+        self.next_seq += 1
+    
+    def since(self, seq: int = -1) -> List[Interaction]:
+        # Interactions with a sequence number greater than seq, oldest first
+        start = max(seq + 1, self.first_seq)
+        return [self.items[i % self.capacity] for i in range(start, self.next_seq)]
+    
+    def seq_at(self, timestamp: float) -> int:
+        # Interactions are appended in time order, so binary search the live window
+        low, high = self.first_seq, self.next_seq
+        while low < high:
+            middle = (low + high) // 2
+            if self.items[middle % self.capacity].timestamp < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+    
+    def between(self, start: Optional[float] = None, end: Optional[float] = None):
+        """Lazily yields interactions with start <= timestamp < end, oldest first."""
+        first = self.seq_at(start) if start is not None else self.first_seq
+        last = self.seq_at(end) if end is not None else self.next_seq
+        for seq in range(first, last):
+            interaction = self.items[seq % self.capacity]
+            # Slots overwritten while a long export is running are skipped
+            if interaction.seq == seq:
+                yield interaction
+    
+    def __len__(self) -> int:
+        return self.next_seq - self.first_seq
+    
+    def __iter__(self):
+        return iter(self.since())
+
+collections_data['customer_interactions'] = InteractionLog()
+
+class TicketAggregates:
+    """Ticket counters and a creation-ordered id list, kept current on every change.
+    
+    The Power BI summary reads the counters instead of scanning all tickets,
+    and pages are sliced from the id list by position or created_at.
+    """
+    
+    def __init__(self):
+        self.by_status: Dict[str, int] = {}
+        self.by_category: Dict[str, int] = {}
+        self.by_priority: Dict[str, int] = {}
+        self.resolution_seconds = 0.0
+        self.resolved_timed = 0
+        self.ids: List[str] = []
+        self.created: List[float] = []
+    
+    def count(self, ticket: Ticket, delta: int):
+        for counts, key in ((self.by_status, ticket.status),
+                            (self.by_category, ticket.category),
+                            (self.by_priority, ticket.priority)):
+            counts[key] = counts.get(key, 0) + delta
+        if ticket.status == 'resolved' and ticket.closed_at is not None:
+            self.resolution_seconds += delta * (ticket.closed_at - ticket.created_at)
+            self.resolved_timed += delta
+    
+    def add(self, ticket: Ticket):
+        self.count(ticket, 1)
+        # Tickets normally arrive in creation order; keep the list sorted regardless
+        if self.created and ticket.created_at < self.created[-1]:
+            position = bisect.bisect_right(self.created, ticket.created_at)
+            self.created.insert(position, ticket.created_at)
+            self.ids.insert(position, ticket.id)
+        else:
+            self.created.append(ticket.created_at)
+            self.ids.append(ticket.id)
+    
+    def page(self, start: int, limit: int, since: Optional[float] = None) -> tuple:
+        if since is not None:
+            start = max(start, bisect.bisect_left(self.created, since))
+        end = min(start + limit, len(self.ids))
+        return self.ids[start:end], (end if end < len(self.ids) else None)
+    
+    def between(self, start: Optional[float] = None, end: Optional[float] = None):
+        """Lazily yields ids of tickets created in [start, end), oldest first."""
+        first = bisect.bisect_left(self.created, start) if start is not None else 0
+        last = bisect.bisect_left(self.created, end) if end is not None else len(self.ids)
+        for position in range(first, min(last, len(self.ids))):
+            yield self.ids[position]
+    
+    def summary(self) -> Dict:
+        total = len(self.ids)
+        resolved = self.by_status.get('resolved', 0)
+        return {
+            "total": total,
+            "open": sum(self.by_status.get(status, 0) for status in OPEN_TICKET_STATUSES),
+            "resolved": resolved,
+            "avgResolutionTime": round(self.resolution_seconds / self.resolved_timed / 3600, 2) if self.resolved_timed else None,  # hours
+            "byStatus": {key: value for key, value in self.by_status.items() if value},
+            "byCategory": {key: value for key, value in self.by_category.items() if value},
+            "byPriority": {key: value for key, value in self.by_priority.items() if value}
+        }
+
+ticket_aggregates = TicketAggregates()
+
+OPEN_TICKET_STATUSES = ('new', 'queued', 'assigned')
+
+class TicketIndex:
+    """Secondary indexes over tickets and complaints, kept current on every change.
+    
+    Tickets are indexed by customer, status, assigned agent and category,
+    complaints by customer and status. A query walks the narrowest matching
+    index and checks the other filters by set membership, so it costs the
+    size of that index rather than the number of tickets.
+    """
+    
+    TICKET_FIELDS = ('customer_id', 'status', 'assigned_agent', 'category')
+    COMPLAINT_FIELDS = ('customer_id', 'status')
+    
+    def __init__(self):
+        self.tickets: Dict[str, Dict[Any, set]] = {name: {} for name in self.TICKET_FIELDS}
+        self.complaints: Dict[str, Dict[Any, set]] = {name: {} for name in self.COMPLAINT_FIELDS}
+        self.complaint_records: Dict[str, ComplaintTicket] = {}
+    
+    def index(self, indexes: Dict[str, Dict[Any, set]], record, names, add: bool):
+        for name in names:
+            value = getattr(record, name)
+            if value is None:
+                continue
+            ids = indexes[name].get(value)
+            if add:
+                if ids is None:
+                    ids = indexes[name][value] = set()
+                ids.add(record.id)
+            elif ids is not None:
+                ids.discard(record.id)
+                if not ids:
+                    del indexes[name][value]
+    
+    def add_ticket(self, ticket: Ticket):
+        self.index(self.tickets, ticket, self.TICKET_FIELDS, True)
+    
+    def reindex_ticket(self, ticket: Ticket, names, add: bool):
+        # Called with add=False before indexed fields change and add=True after
+        self.index(self.tickets, ticket, [name for name in names if name in self.tickets], add)
+    
+    def add_complaint(self, complaint: ComplaintTicket):
+        self.complaint_records[complaint.id] = complaint
+        self.index(self.complaints, complaint, self.COMPLAINT_FIELDS, True)
+    
+    def find(self, indexes: Dict[str, Dict[Any, set]], records: Dict, filters: Dict[str, List]) -> List:
+        """Records matching every filter (any of its values), oldest first."""
+        matches = [[indexes[name].get(value, ()) for value in values] for name, values in filters.items()]
+        matches.sort(key=lambda sets: sum(len(ids) for ids in sets))
+        found = set().union(*matches[0])
+        for sets in matches[1:]:
+            # Set intersection runs in C and only walks the smaller side
+            found = set().union(*(found.intersection(ids) for ids in sets))
+        return sorted((records[record_id] for record_id in found), key=lambda record: record.created_at)
+    
+    def find_tickets(self, **filters) -> List[Ticket]:
+        return self.find(self.tickets, agents_data['tickets'], filters)
+    
+    def find_complaints(self, **filters) -> List[ComplaintTicket]:
+        return self.find(self.complaints, self.complaint_records, filters)
+
+ticket_index = TicketIndex()
+
+def store_ticket(ticket: Ticket):
+    agents_data['tickets'][ticket.id] = ticket
+    ticket_aggregates.add(ticket)
+    ticket_index.add_ticket(ticket)
+
+def apply_ticket_fields(ticket: Ticket, fields: Dict):
+    ticket_aggregates.count(ticket, -1)
+    ticket_index.reindex_ticket(ticket, fields, False)
+    for key, value in fields.items():
+        setattr(ticket, key, value)
+    ticket_aggregates.count(ticket, 1)
+    ticket_index.reindex_ticket(ticket, fields, True)
+
+def store_complaint(complaint: ComplaintTicket):
+    collections_data['tickets'].append(complaint)
+    ticket_index.add_complaint(complaint)
+
+def add_complaint(complaint: ComplaintTicket):
+    store_complaint(complaint)
+    record_event('complaint', asdict(complaint))
+
+def add_ticket(ticket: Ticket):
+    store_ticket(ticket)
+    record_event('ticket', asdict(ticket))
+
+def update_ticket(ticket: Ticket, **fields):
+    # Every ticket transition goes through here so aggregates and the event log stay in step
+    apply_ticket_fields(ticket, fields)
+    agent_metrics.observe_update(ticket, fields)
+    record_event('ticket_update', {'id': ticket.id, 'fields': fields})
+
+def append_ticket_message(ticket: Ticket, message: TicketMessage):
+    ticket.messages.append(message)
+    if message.sender == 'agent' and ticket.first_response_at is None:
+        ticket.first_response_at = message.timestamp
+
+def add_ticket_message(ticket: Ticket, message: TicketMessage):
+    first_response = message.sender == 'agent' and ticket.first_response_at is None
+    append_ticket_message(ticket, message)
+    if first_response:
+        agent_metrics.observe_first_response(ticket)
+    record_event('ticket_message', {'id': ticket.id, 'message': asdict(message)})
+    if len(ticket.messages) > 2 * TRANSCRIPT_TAIL:
+        spill_transcript(ticket, TRANSCRIPT_TAIL)
+
+def first_response_seconds(ticket: Ticket) -> Optional[float]:
+    # Time from assignment to the agent's first reply
+    if ticket.assigned_at is None or ticket.first_response_at is None:
+        return None
+    return ticket.first_response_at - ticket.assigned_at
+
+# Session persistence
+def serialize_session(session: UserSession) -> str:
+    # Short keys and no whitespace keep stored sessions small
+    return json.dumps({
+        's': session.step,
+        'n': session.name,
+        'd': session.data,
+        't': session.ticket_id,
+        'c': session.complaint
+    }, separators=(',', ':'), ensure_ascii=False)
+
+def deserialize_session(raw) -> UserSession:
+    values = json.loads(raw)
+    return UserSession(
+        step=values['s'],
+        name=values['n'],
+        data=values['d'],
+        ticket_id=values.get('t'),
+        complaint=values.get('c')
+    )
+
+class SessionStore(ABC):
+    """Loads and saves UserSession objects keyed by the customer's phone number.
+    
+    Sessions idle for longer than the TTL are dropped, so a returning user
+    starts again at the welcome step.
+    """
+    
+    # Whether other processes see the same sessions
+    shared = False
+    
+    def __init__(self, ttl: int = SESSION_TTL):
+        self.ttl = ttl
+        self.stats = {"expired": 0, "evicted": 0, "sweeps": 0}
+    
+    @abstractmethod
+    async def load(self, user_id: str) -> Optional[UserSession]:
+        ...
+    
+    @abstractmethod
+    async def save(self, user_id: str, session: UserSession):
+        ...
+    
+    async def unlock(self, user_id: str):
+        """Ends a load() that will not be followed by a save()."""
+    
+    @abstractmethod
+    async def delete(self, user_id: str):
+        ...
+    
+    @abstractmethod
+    async def count(self) -> int:
+        ...
+    
+    @abstractmethod
+    async def claim_messages(self, message_ids: List[str]) -> List[bool]:
+        """Marks webhook message ids as seen; True for each id not seen before."""
+    
+    @abstractmethod
+    async def release_messages(self, message_ids: List[str]):
+        """Forgets ids claimed for messages that were not accepted after all."""
+    
+    async def sweep(self) -> int:
+        return 0
+    
+    async def close(self):
+        pass
+
+class SeenMessageSet:
+    """Recently seen message ids, kept as hashes in rotating generations.
+    
+    A new generation starts every ttl / (generations - 1) seconds, or once the
+    newest one is full, and the oldest is dropped. Ids are therefore
+    remembered for at least the TTL (unless DEDUP_MAX_ENTRIES forces an early
+    rotation) and memory stays bounded without per-id expiry bookkeeping.
+    """
+    
+    def __init__(self, ttl: float = DEDUP_TTL, max_entries: int = DEDUP_MAX_ENTRIES,
+                 generations: int = DEDUP_GENERATIONS):
+        self.generation_count = max(2, generations)
+        self.period = ttl / (self.generation_count - 1)
+        self.generation_size = max(1, max_entries // self.generation_count)
+        self.generations = deque([set()])
+        self.started = time.monotonic()
+    
+    def rotate(self, now: float):
+        # Catch up on every period that passed while idle
+        elapsed = min(self.generation_count, int((now - self.started) // self.period)) if self.period else 1
+        for _ in range(max(1, elapsed)):
+            self.generations.append(set())
+            if len(self.generations) > self.generation_count:
+                self.generations.popleft()
+        self.started = now
+    
+    def claim(self, message_id: str) -> bool:
+        # Python's str hash is 64-bit and cached on the string; collisions are negligible at this size
+        key = hash(message_id)
+        for generation in self.generations:
+            if key in generation:
+                return False
+        current = self.generations[-1]
+        if len(current) >= self.generation_size or time.monotonic() - self.started >= self.period:
+            self.rotate(time.monotonic())
+            current = self.generations[-1]
+        current.add(key)
+        return True
+    
+    def release(self, message_id: str):
+        key = hash(message_id)
+        for generation in self.generations:
+            generation.discard(key)
+    
+    def __len__(self) -> int:
+        return sum(len(generation) for generation in self.generations)
+
+class MemorySessionStore(SessionStore):
+    def __init__(self, ttl: int = SESSION_TTL, max_entries: int = SESSION_MAX_ENTRIES):
+        super().__init__(ttl)
+        self.max_entries = max_entries
+        # Kept in least-recently-used first order: user_id -> (session, last_seen)
+        self.sessions: OrderedDict = OrderedDict()
+        self.seen_messages = SeenMessageSet()
+    
+    def is_expired(self, last_seen: float, now: float) -> bool:
+        return bool(self.ttl) and now - last_seen > self.ttl
+    
+    async def load(self, user_id: str) -> Optional[UserSession]:
+        entry = self.sessions.get(user_id)
+        if entry is None:
+            return None
+        if self.is_expired(entry[1], time.monotonic()):
+            del self.sessions[user_id]
+            self.stats["expired"] += 1
+            return None
+        self.sessions.move_to_end(user_id)
+        return entry[0]
+    
+    async def save(self, user_id: str, session: UserSession):
+        self.sessions[user_id] = (session, time.monotonic())
+        self.sessions.move_to_end(user_id)
+        while len(self.sessions) > self.max_entries:
+            self.sessions.popitem(last=False)
+            self.stats["evicted"] += 1
+    
+    async def delete(self, user_id: str):
+        self.sessions.pop(user_id, None)
+    
+    async def count(self) -> int:
+        return len(self.sessions)
+    
+    async def claim_messages(self, message_ids: List[str]) -> List[bool]:
+        return [self.seen_messages.claim(message_id) for message_id in message_ids]
+    
+    async def release_messages(self, message_ids: List[str]):
+        for message_id in message_ids:
+            self.seen_messages.release(message_id)
+    
+    async def sweep(self) -> int:
+        # Oldest entries sit at the front, so stop at the first live one
+        now = time.monotonic()
+        removed = 0
+        while self.sessions:
+            user_id, (_, last_seen) = next(iter(self.sessions.items()))
+            if not self.is_expired(last_seen, now):
+                break
+            del self.sessions[user_id]
+            removed += 1
+        self.stats["expired"] += removed
+        self.stats["sweeps"] += 1
+        return removed
+
+class RedisSessionStore(SessionStore):
+    """Redis expires session keys itself; the sweeper only trims the index.
+    
+    load() takes a per-user lock (SET NX PX) in the same round-trip as the read
+    and save() writes and releases it in another, so each message costs two
+    round-trips and workers sharing a user take turns. A save after more than
+    half the lock timeout only goes ahead while the lock is still held (WATCH).
+    Size-based eviction is left to the server's maxmemory-policy.
+    """
+    
+    shared = True
+    
+    def __init__(self, url: str, prefix: str = SESSION_KEY_PREFIX, client=None, ttl: int = SESSION_TTL,
+                 seen_prefix: str = DEDUP_KEY_PREFIX, seen_ttl: int = DEDUP_TTL,
+                 lock_timeout: float = SESSION_LOCK_TIMEOUT):
+        super().__init__(ttl)
+        if client is None:
+            if redis_asyncio is None:
+                raise RuntimeError("SESSION_STORE=redis requires the 'redis' package")
+            client = redis_asyncio.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self.index_key = f"{prefix}index"
+        self.seen_prefix = seen_prefix
+        self.seen_ttl = seen_ttl
+        self.lock_prefix = f"{prefix}lock:"
+        self.lock_timeout = lock_timeout
+        # user_id -> (token, taken at) for the locks this process holds
+        self.locks: Dict[str, tuple] = {}
+    
+    async def load(self, user_id: str) -> Optional[UserSession]:
+        token = secrets.token_hex(8)
+        deadline = time.monotonic() + self.lock_timeout
+        delay = 0.01
+        while True:
+            async with self.client.pipeline(transaction=False) as pipe:
+                pipe.set(self.lock_prefix + user_id, token, nx=True, px=int(self.lock_timeout * 1000))
+                pipe.get(self.prefix + user_id)
+                locked, raw = await pipe.execute()
+            if locked:
+                self.locks[user_id] = (token, time.monotonic())
+                break
+            if time.monotonic() >= deadline:
+                # The holder is stuck; its lock is expiring anyway, so go ahead unlocked
+                logger.warning(f"Session lock for {user_id} not released within {self.lock_timeout:.0f}s")
+                break
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.2)
+        return deserialize_session(raw) if raw is not None else None
+    
+    async def save(self, user_id: str, session: UserSession):
+        await self.write(user_id, session)
+    
+    async def unlock(self, user_id: str):
+        await self.write(user_id, None)
+    
+    async def write(self, user_id: str, session: Optional[UserSession]):
+        lock = self.locks.pop(user_id, None)
+        lock_key = self.lock_prefix + user_id
+        
+        def queue_writes(pipe):
+            if session is not None:
+                pipe.set(self.prefix + user_id, serialize_session(session), ex=self.ttl or None)
+                pipe.zadd(self.index_key, {user_id: time.time()})
+            if lock is not None:
+                pipe.delete(lock_key)
+        
+        if lock is None or time.monotonic() - lock[1] < self.lock_timeout / 2:
+            # The lock cannot have expired yet: write and release in one round-trip
+            async with self.client.pipeline(transaction=False) as pipe:
+                queue_writes(pipe)
+                await pipe.execute()
+            return
+        # The lock may have expired and passed on; only write while it is still ours
+        async with self.client.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(lock_key)
+                holder = await pipe.get(lock_key)
+                # Once the lock has lapsed another worker may have written since our load
+                if holder is not None and holder.decode() == lock[0]:
+                    pipe.multi()
+                    queue_writes(pipe)
+                    await pipe.execute()
+                    return
+            except redis_asyncio.WatchError:
+                pass
+        logger.warning(f"Session lock for {user_id} expired while held; the update was dropped")
+    
+    async def delete(self, user_id: str):
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.delete(self.prefix + user_id)
+            pipe.zrem(self.index_key, user_id)
+            await pipe.execute()
+    
+    async def count(self) -> int:
+        if not self.ttl:
+            return await self.client.zcard(self.index_key)
+        return await self.client.zcount(self.index_key, time.time() - self.ttl, '+inf')
+    
+    async def claim_messages(self, message_ids: List[str]) -> List[bool]:
+        # SET NX is atomic, so only one worker or node wins each id
+        async with self.client.pipeline(transaction=False) as pipe:
+            for message_id in message_ids:
+                pipe.set(self.seen_prefix + message_id, 1, nx=True, ex=self.seen_ttl or None)
+            results = await pipe.execute()
+        return [bool(result) for result in results]
+    
+    async def release_messages(self, message_ids: List[str]):
+        if message_ids:
+            await self.client.delete(*(self.seen_prefix + message_id for message_id in message_ids))
+    
+    async def sweep(self) -> int:
+        removed = 0
+        if self.ttl:
+            removed = await self.client.zremrangebyscore(self.index_key, '-inf', time.time() - self.ttl)
+        self.stats["expired"] += removed
+        self.stats["sweeps"] += 1
+        return removed
+    
+    async def close(self):
+        await self.client.aclose()
+
+async def session_sweeper():
+    while True:
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            removed = await session_store.sweep()
+            if removed:
+                logger.info(f"Expired {removed} idle sessions")
+        except Exception as e:
+            logger.error(f"Session sweep failed: {e}")
+
+def create_session_store() -> SessionStore:
+    if SESSION_STORE == 'redis':
+        return RedisSessionStore(REDIS_URL)
+    return MemorySessionStore()
+
+session_store = create_session_store()
+
+# Per-worker data directories
+worker_slot: Optional[int] = None
+worker_slot_lock = None
+
+def claim_worker_slot() -> int:
+    """Takes the lowest worker number no other live process holds.
+    
+    The lock is held until the process exits, so a restarted worker gets a
+    free number back and picks up the files its predecessor left.
+    """
+    global worker_slot, worker_slot_lock
+    if worker_slot is not None:
+        return worker_slot
+    os.makedirs(EVENT_LOG_DIR, exist_ok=True)
+    for slot in range(WORKER_SLOTS):
+        lock_file = open(os.path.join(EVENT_LOG_DIR, f'worker-{slot}.lock'), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            continue
+        worker_slot, worker_slot_lock = slot, lock_file
+        if slot == 0:
+            adopt_unslotted_files()
+        return slot
+    raise RuntimeError(f"All {WORKER_SLOTS} worker slots in {EVENT_LOG_DIR} are taken; raise WORKER_SLOTS")
+
+def worker_path(path: str, is_file: bool = False) -> str:
+    # data -> data/worker-N, data/dead_letters.ndjson -> data/worker-N/dead_letters.ndjson
+    if is_file:
+        directory, name = os.path.split(path)
+        return os.path.join(directory, f'worker-{worker_slot}', name)
+    return os.path.join(path, f'worker-{worker_slot}')
+
+def adopt_unslotted_files():
+    # Files written before workers had their own directories belong to worker 0
+    moves = [(EVENT_LOG_DIR, name) for name in ('events.ndjson', 'snapshot.json')]
+    dead_letter_dir, dead_letter_name = os.path.split(DEAD_LETTER_FILE)
+    moves += [(dead_letter_dir, name) for name in (dead_letter_name, dead_letter_name + '.replay')]
+    if os.path.isdir(TRANSCRIPT_ARCHIVE_DIR):
+        moves += [(TRANSCRIPT_ARCHIVE_DIR, name) for name in os.listdir(TRANSCRIPT_ARCHIVE_DIR)
+                  if TranscriptArchive.SEGMENT_PATTERN.match(name)]
+    for directory, name in moves:
+        source = os.path.join(directory, name)
+        target = os.path.join(worker_path(directory), name)
+        if os.path.exists(source) and not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(source, target)
+            logger.info(f"Moved {source} to {target}")
+
+# Durable event log
+class EventLog:
+    """Append-only NDJSON log with group-committed fsyncs and snapshots.
+    
+    Handlers only queue events in memory; a background task writes and fsyncs
+    them in batches off the event loop. Every event carries a sequence number
+    and snapshots record the last one they include, so replay after a crash
+    never applies an event twice.
+    """
+    
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.log_path = os.path.join(directory, 'events.ndjson')
+        self.snapshot_path = os.path.join(directory, 'snapshot.json')
+        self.lock_path = os.path.join(directory, 'events.lock')
+        self.pending: List[tuple] = []
+        self.last_seq = 0
+        self.events_since_snapshot = 0
+        self.file = None
+        self.lock_file = None
+        self.stats = {"written": 0, "flushes": 0, "snapshots": 0, "replayed": 0, "replay_ms": 0.0}
+    
+    def open(self) -> bool:
+        os.makedirs(self.directory, exist_ok=True)
+        # Only one process may own the log; other uvicorn workers run without it
+        self.lock_file = open(self.lock_path, 'w')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.lock_file.close()
+            self.lock_file = None
+            return False
+        self.file = open(self.log_path, 'ab')
+        return True
+    
+    def append(self, kind: str, data: Dict):
+        self.last_seq += 1
+        self.pending.append((self.last_seq, kind, data))
+        self.events_since_snapshot += 1
+    
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        await asyncio.to_thread(self.write_batch, batch)
+        self.stats["written"] += len(batch)
+        self.stats["flushes"] += 1
+    
+    def write_batch(self, batch: List[tuple]):
+        lines = ''.join(
+            json.dumps({'s': seq, 't': kind, 'd': data}, separators=(',', ':'), ensure_ascii=False) + '\n'
+            for seq, kind, data in batch
+        )
+        self.file.write(lines.encode('utf-8'))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+    
+    async def snapshot(self):
+        # Queued events are already reflected in the in-memory state being saved
+        self.pending = []
+        state = copy_state()
+        self.events_since_snapshot = 0
+        await asyncio.to_thread(self.write_snapshot, state, self.last_seq)
+        self.stats["snapshots"] += 1
+    
+    def write_snapshot(self, copied: Dict, seq: int):
+        state = build_snapshot(copied)
+        state['seq'] = seq
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, separators=(',', ':'), ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self.file.truncate(0)
+        os.fsync(self.file.fileno())
+    
+    def replay(self):
+        started = time.monotonic()
+        snapshot_seq = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, encoding='utf-8') as f:
+                state = json.load(f)
+            snapshot_seq = state.get('seq', 0)
+            restore_snapshot(state)
+        self.last_seq = snapshot_seq
+        
+        replayed = 0
+        if os.path.exists(self.log_path):
+            intact = 0
+            with open(self.log_path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError("no newline")
+                        event = json.loads(line)
+                    except ValueError:
+                        # Torn write from a crash, everything before it is intact
+                        break
+                    intact += len(line)
+                    if event['s'] <= snapshot_seq:
+                        continue
+                    apply_event(event['t'], event['d'])
+                    self.last_seq = event['s']
+                    replayed += 1
+            if intact < os.path.getsize(self.log_path):
+                # Cut the torn tail off, or the next event appended would be glued to it and lost
+                logger.warning("Dropping truncated event log entry")
+                os.truncate(self.log_path, intact)
+        
+        self.events_since_snapshot = replayed
+        self.stats["replayed"] = replayed
+        self.stats["replay_ms"] = round((time.monotonic() - started) * 1000, 2)
+    
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+TICKET_FIELDS = tuple(item.name for item in fields(Ticket) if item.name != 'messages')
+ticket_values = operator.attrgetter(*TICKET_FIELDS)
+COMPLAINT_FIELDS = tuple(item.name for item in fields(ComplaintTicket))
+complaint_values = operator.attrgetter(*COMPLAINT_FIELDS)
+
+def copy_state() -> tuple:
+    """Copies what a snapshot saves, cheaply enough to run on the event loop.
+    
+    Tickets and complaints become tuples of their field values. Transcript
+    lists are the only mutable values inside them and are copied too;
+    messages and interactions never change once recorded and are shared.
+    """
+    return (
+        [(ticket_values(ticket), list(ticket.messages)) for ticket in agents_data['tickets'].values()],
+        [complaint_values(complaint) for complaint in collections_data['tickets']],
+        collections_data['customer_interactions'].since(),
+        conversation_analytics.state()
+    )
+
+def build_snapshot(copied: tuple) -> Dict:
+    # Runs in a worker thread on the output of copy_state()
+    tickets, complaints, interactions, analytics = copied
+    return {
+        'tickets': [
+            {**dict(zip(TICKET_FIELDS, values)), 'messages': [asdict(message) for message in messages]}
+            for values, messages in tickets
+        ],
+        'complaints': [dict(zip(COMPLAINT_FIELDS, values)) for values in complaints],
+        'interactions': [asdict(interaction) for interaction in interactions],
+        'analytics': analytics
+    }
+
+def restore_snapshot(state: Dict):
+    for data in state.get('tickets', []):
+        apply_event('ticket', data)
+    for data in state.get('complaints', []):
+        apply_event('complaint', data)
+    if 'analytics' in state:
+        # The saved histograms already count the interactions kept alongside them
+        conversation_analytics.restore(state['analytics'])
+        for data in state.get('interactions', []):
+            collections_data['customer_interactions'].append(Interaction(**data))
+    else:
+        # Older snapshots only hold the interaction log, which is all that can be counted
+        for data in state.get('interactions', []):
+            apply_event('interaction', data)
+        conversation_analytics.observe_ratings(agents_data['tickets'].values())
+
+def apply_event(kind: str, data: Dict):
+    if kind == 'interaction':
+        interaction = Interaction(**data)
+        collections_data['customer_interactions'].append(interaction)
+        conversation_analytics.observe_interaction(interaction)
+    elif kind == 'ticket':
+        ticket = Ticket(**{**data, 'messages': []})
+        for message in data.get('messages', []):
+            append_ticket_message(ticket, TicketMessage(**message))
+        store_ticket(ticket)
+    elif kind == 'ticket_update':
+        ticket = agents_data['tickets'].get(data['id'])
+        if ticket is not None:
+            apply_ticket_fields(ticket, data['fields'])
+            if 'rating' in data['fields'] and ticket.rated_at is not None:
+                conversation_analytics.observe_rating(ticket.rating, ticket.rated_at)
+    elif kind == 'ticket_message':
+        ticket = agents_data['tickets'].get(data['id'])
+        if ticket is not None:
+            append_ticket_message(ticket, TicketMessage(**data['message']))
+    elif kind == 'ticket_archived':
+        ticket = agents_data['tickets'].get(data['id'])
+        if ticket is not None:
+            # Nothing to drop when the snapshot already reflects this spill
+            count = data['first'] + data['count'] - ticket.archived_messages
+            if count > 0:
+                del ticket.messages[:count]
+                ticket.archived_messages += count
+    elif kind == 'complaint':
+        store_complaint(ComplaintTicket(**data))
+
+# Created on startup in this worker's directory
+event_log: Optional[EventLog] = None
+
+def record_event(kind: str, data: Dict):
+    if event_log is not None and event_log.file is not None:
+        event_log.append(kind, data)
+
+async def event_log_writer():
+    while True:
+        await asyncio.sleep(EVENT_LOG_FLUSH_INTERVAL)
+        try:
+            # Archived messages must be durable before the events that drop them from memory
+            await sync_transcript_archive()
+            if event_log.events_since_snapshot >= EVENT_LOG_SNAPSHOT_EVERY:
+                await event_log.snapshot()
+            else:
+                await event_log.flush()
+        except Exception as e:
+            logger.error(f"Event log write failed: {e}")
+
+def get_event_log_stats() -> Dict:
+    if event_log is None or event_log.file is None:
+        return {"enabled": False}
+    stats = dict(event_log.stats)
+    stats["enabled"] = True
+    stats["pending"] = len(event_log.pending)
+    stats["last_seq"] = event_log.last_seq
+    stats["directory"] = event_log.directory
+    return stats
+
+# Transcript archive
+class TranscriptArchive:
+    """Append-only segment files holding ticket messages moved out of memory.
+    
+    Each record is one zlib-compressed batch of a ticket's messages, tagged
+    with the position of its first message in the transcript. Only record
+    locations stay in memory; transcripts are read back when needed. A batch
+    written again after a crash overlaps the earlier record and is merged on
+    load, so spilling is safe to repeat.
+    """
+    
+    # Payload length, position of the first message, message count, ticket id length
+    HEADER = struct.Struct('>IIIH')
+    SEGMENT_PATTERN = re.compile(r'^transcripts-(\d{6})\.seg$')
+    
+    def __init__(self, directory: str, segment_bytes: int = TRANSCRIPT_SEGMENT_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.lock_path = os.path.join(directory, 'transcripts.lock')
+        # ticket id -> [(first, count, segment, offset, length)]
+        self.records: Dict[str, List[tuple]] = {}
+        self.segment = 1
+        self.file = None
+        self.readers: Dict[int, int] = {}  # segment -> read-only file descriptor
+        self.lock_file = None
+        self.dirty = False
+        self.stats = {"archived": 0, "records": 0, "bytes": 0, "loads": 0}
+    
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f'transcripts-{segment:06d}.seg')
+    
+    def open(self) -> bool:
+        os.makedirs(self.directory, exist_ok=True)
+        # Same ownership rule as the event log: one writer per directory
+        self.lock_file = open(self.lock_path, 'w')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.lock_file.close()
+            self.lock_file = None
+            return False
+        segments = sorted(
+            int(match.group(1))
+            for match in map(self.SEGMENT_PATTERN.match, os.listdir(self.directory)) if match
+        )
+        for segment in segments:
+            self.scan(segment)
+        if segments:
+            self.segment = segments[-1]
+        self.file = open(self.segment_path(self.segment), 'ab')
+        return True
+    
+    def scan(self, segment: int):
+        # Reads record headers only, skipping over the compressed payloads
+        path = self.segment_path(segment)
+        size = os.path.getsize(path)
+        offset = 0
+        with open(path, 'rb') as f:
+            while offset + self.HEADER.size <= size:
+                length, first, count, id_length = self.HEADER.unpack(f.read(self.HEADER.size))
+                end = offset + self.HEADER.size + id_length + length
+                if end > size:
+                    break
+                ticket_id = f.read(id_length).decode('utf-8')
+                self.index(ticket_id, first, count, segment, end - length, length)
+                f.seek(end)
+                offset = end
+        if offset < size:
+            # Torn write from a crash; the event dropping those messages was never logged
+            logger.warning(f"Truncating torn record at the end of {path}")
+            os.truncate(path, offset)
+    
+    def index(self, ticket_id: str, first: int, count: int, segment: int, offset: int, length: int):
+        self.records.setdefault(ticket_id, []).append((first, count, segment, offset, length))
+        self.stats["archived"] += count
+        self.stats["records"] += 1
+        self.stats["bytes"] += length
+    
+    def append(self, ticket_id: str, first: int, messages: List[TicketMessage]):
+        payload = zlib.compress(json.dumps(
+            [asdict(message) for message in messages], separators=(',', ':'), ensure_ascii=False
+        ).encode('utf-8'))
+        if self.file.tell() >= self.segment_bytes:
+            self.sync()
+            self.file.close()
+            self.segment += 1
+            self.file = open(self.segment_path(self.segment), 'ab')
+        key = ticket_id.encode('utf-8')
+        offset = self.file.tell() + self.HEADER.size + len(key)
+        self.file.write(self.HEADER.pack(len(payload), first, len(messages), len(key)) + key + payload)
+        # Flushed to the OS so loads can read it straight away; fsynced by sync()
+        self.file.flush()
+        self.dirty = True
+        self.index(ticket_id, first, len(messages), self.segment, offset, len(payload))
+    
+    def read(self, segment: int, offset: int, length: int) -> List[Dict]:
+        reader = self.readers.get(segment)
+        if reader is None:
+            reader = self.readers[segment] = os.open(self.segment_path(segment), os.O_RDONLY)
+        return json.loads(zlib.decompress(os.pread(reader, length, offset)))
+    
+    def load(self, ticket_id: str) -> List[TicketMessage]:
+        messages: List[TicketMessage] = []
+        for first, count, segment, offset, length in sorted(self.records.get(ticket_id, ())):
+            if first + count <= len(messages):
+                continue
+            batch = self.read(segment, offset, length)
+            messages.extend(TicketMessage(**data) for data in batch[max(0, len(messages) - first):])
+        self.stats["loads"] += 1
+        return messages
+    
+    def message(self, ticket_id: str, position: int) -> Optional[TicketMessage]:
+        # One message, decompressing only the record that holds it
+        for first, count, segment, offset, length in self.records.get(ticket_id, ()):
+            if first <= position < first + count:
+                self.stats["loads"] += 1
+                return TicketMessage(**self.read(segment, offset, length)[position - first])
+        return None
+    
+    def sync(self):
+        if self.file is not None and self.dirty:
+            self.dirty = False
+            os.fsync(self.file.fileno())
+    
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+        for reader in self.readers.values():
+            os.close(reader)
+        self.readers.clear()
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+# Created on startup in this worker's directory
+transcript_archive: Optional[TranscriptArchive] = None
+
+async def sync_transcript_archive():
+    if transcript_archive is not None and transcript_archive.dirty:
+        await asyncio.to_thread(transcript_archive.sync)
+
+def spill_transcript(ticket: Ticket, keep: int):
+    """Moves all but the newest `keep` messages of a ticket to the transcript archive."""
+    count = len(ticket.messages) - keep
+    if count <= 0 or transcript_archive is None or transcript_archive.file is None:
+        return
+    first = ticket.archived_messages
+    try:
+        transcript_archive.append(ticket.id, first, ticket.messages[:count])
+    except OSError as e:
+        # The messages simply stay in memory until the next attempt
+        logger.error(f"Archiving transcript of ticket {ticket.id} failed: {e}")
+        return
+    del ticket.messages[:count]
+    ticket.archived_messages += count
+    record_event('ticket_archived', {'id': ticket.id, 'first': first, 'count': count})
+
+async def load_transcripts(tickets: List[Ticket]) -> Dict[str, List[TicketMessage]]:
+    """Full transcripts of the tickets that have archived messages, read in a thread."""
+    if transcript_archive is None:
+        return {}
+    archive = transcript_archive
+    pending = [ticket for ticket in tickets if ticket.archived_messages]
+    transcripts: Dict[str, List[TicketMessage]] = {}
+    while pending:
+        loaded = await asyncio.to_thread(lambda: {ticket.id: archive.load(ticket.id) for ticket in pending})
+        # A record written just before a crash may run past what the ticket knows it
+        # archived; one spilled while the thread read may be missing from the load
+        for ticket in pending:
+            if len(loaded[ticket.id]) >= ticket.archived_messages:
+                transcripts[ticket.id] = loaded[ticket.id][:ticket.archived_messages] + ticket.messages
+        pending = [ticket for ticket in pending if ticket.id not in transcripts]
+    return transcripts
+
+async def latest_ticket_message(ticket: Ticket) -> Optional[TicketMessage]:
+    if ticket.messages:
+        return ticket.messages[-1]
+    if not ticket.archived_messages or transcript_archive is None:
+        return None
+    return await asyncio.to_thread(transcript_archive.message, ticket.id, ticket.archived_messages - 1)
+
+def get_transcript_archive_stats() -> Dict:
+    if transcript_archive is None or transcript_archive.file is None:
+        return {"enabled": False}
+    stats = dict(transcript_archive.stats)
+    stats["enabled"] = True
+    stats["segments"] = transcript_archive.segment
+    stats["tickets"] = len(transcript_archive.records)
+    return stats
+
+def create_http_client() -> httpx.AsyncClient:
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+    )
+    timeout = httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+    return httpx.AsyncClient(
+        limits=limits,
+        timeout=timeout,
+        http2=HTTP2_ENABLED,
+        headers={"Content-Type": "application/json"}
+    )
+
+@app.on_event("startup")
+async def startup():
+    global http_client, event_log, transcript_archive, dead_letters
+    if session_store.shared:
+        logger.warning("Sessions are shared between workers, but tickets, complaints and agent queues are "
+                       "kept per process; customers whose ticket is held by another worker are asked to "
+                       "reconnect to an agent")
+    claim_worker_slot()
+    logger.info(f"Keeping this worker's data in {worker_path(EVENT_LOG_DIR)}")
+    if id_generator.node_id is None:
+        logger.warning("ID_NODE_ID is not set; ids use random process bits, so set a distinct value "
+                       "per host to guarantee they never collide")
+    if TRANSCRIPT_ARCHIVE_ENABLED:
+        transcript_archive = TranscriptArchive(worker_path(TRANSCRIPT_ARCHIVE_DIR))
+        if transcript_archive.open():
+            logger.info(f"Transcript archive holds {transcript_archive.stats['archived']} messages "
+                        f"of {len(transcript_archive.records)} tickets")
+        else:
+            logger.warning(f"Transcript archive in {transcript_archive.directory} is owned by another process, "
+                           f"keeping transcripts in memory")
+    if EVENT_LOG_ENABLED:
+        event_log = EventLog(worker_path(EVENT_LOG_DIR))
+        if event_log.open():
+            event_log.replay()
+            logger.info(f"Replayed {event_log.stats['replayed']} events in {event_log.stats['replay_ms']} ms")
+            agent_router.rebuild(agents_data['tickets'].values())
+            wait_estimator.rebuild(agents_data['tickets'].values())
+            agent_metrics.rebuild(agents_data['tickets'].values())
+            # Tickets resolved before the archive was enabled still hold their transcripts
+            for ticket in agents_data['tickets'].values():
+                if ticket.status not in OPEN_TICKET_STATUSES:
+                    spill_transcript(ticket, 0)
+            background_tasks.append(asyncio.create_task(event_log_writer()))
+        else:
+            logger.warning(f"Event log in {event_log.directory} is owned by another process, running without it")
+    
+    http_client = create_http_client()
+    logger.info(f"HTTP client ready (http2={HTTP2_ENABLED}, max_connections={HTTP_MAX_CONNECTIONS})")
+    background_tasks.append(outbound_dispatcher.start())
+    dead_letters = DeadLetterQueue(worker_path(DEAD_LETTER_FILE, is_file=True))
+    dead_letters.open()
+    background_tasks.append(asyncio.create_task(dead_letter_replayer()))
+    
+    lane_size = max(1, QUEUE_MAX_SIZE // WORKER_COUNT)
+    for i in range(WORKER_COUNT):
+        lane = asyncio.Queue(maxsize=lane_size)
+        message_lanes.append(lane)
+        worker_tasks.append(asyncio.create_task(message_worker(i, lane)))
+    logger.info(f"Started {WORKER_COUNT} message workers ({lane_size} messages per lane)")
+    
+    background_tasks.append(asyncio.create_task(session_sweeper()))
+    background_tasks.append(asyncio.create_task(agent_ticket_sweeper()))
+    if CONVERSATION_FLOW_FILE:
+        background_tasks.append(asyncio.create_task(conversation_flow_watcher()))
+
+@app.on_event("shutdown")
+async def shutdown():
+    global http_client, event_log, transcript_archive
+    if message_lanes:
+        # Give in-flight messages a chance to finish before stopping workers
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(lane.join() for lane in message_lanes)),
+                timeout=QUEUE_DRAIN_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"Shutting down with {get_queue_depth()} unprocessed messages")
+    if not await outbound_dispatcher.drain(QUEUE_DRAIN_TIMEOUT):
+        logger.warning(f"Dead-lettering {outbound_dispatcher.depth} unsent replies on shutdown")
+        await outbound_dispatcher.dead_letter_pending()
+    if not outbound_dispatcher.in_flight:
+        # Anything a replay had taken is now either sent or back in the dead-letter file
+        dead_letters.finish_replay()
+    for task in worker_tasks + background_tasks:
+        task.cancel()
+    await asyncio.gather(*worker_tasks, *background_tasks, return_exceptions=True)
+    worker_tasks.clear()
+    background_tasks.clear()
+    message_lanes.clear()
+    
+    await sync_transcript_archive()
+    if event_log is not None:
+        if event_log.file is not None:
+            await event_log.snapshot()
+        event_log.close()
+        event_log = None
+    if transcript_archive is not None:
+        transcript_archive.close()
+        transcript_archive = None
+    
+    await session_store.close()
+    
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+
+def get_pool_stats() -> Dict:
+    stats = dict(http_stats)
+    stats["http2"] = HTTP2_ENABLED
+    stats["max_connections"] = HTTP_MAX_CONNECTIONS
+    stats["max_keepalive"] = HTTP_MAX_KEEPALIVE
+    
+    # httpcore does not expose pool metrics publicly, so read them best-effort
+    pool = getattr(getattr(http_client, '_transport', None), '_pool', None)
+    connections = getattr(pool, 'connections', None)
+    if connections is not None:
+        stats["connections"] = len(connections)
+        stats["idle_connections"] = len([c for c in connections if c.is_idle()])
+    return stats
+
+# Background message processing
+async def message_worker(worker_id: int, lane: asyncio.Queue):
+    while True:
+        message, contact, enqueued_at, received_at = await lane.get()
+        wait_ms = (time.monotonic() - enqueued_at) * 1000
+        queue_stats["total_wait_ms"] += wait_ms
+        queue_stats["max_wait_ms"] = max(queue_stats["max_wait_ms"], wait_ms)
+        try:
+            await handle_message(message, contact, received_at)
+            queue_stats["processed"] += 1
+        except Exception as e:
+            queue_stats["failed"] += 1
+            logger.exception(f"Worker {worker_id} failed to handle message: {e}")
+        finally:
+            lane.task_done()
+
+def get_lane_index(from_number: str) -> int:
+    # crc32 rather than hash() so lane assignment is stable across restarts
+    return zlib.crc32(str(from_number).encode()) % len(message_lanes)
+
+def get_queue_depth() -> int:
+    return sum(lane.qsize() for lane in message_lanes)
+
+def enqueue_messages(batch: List[tuple], received_at: Optional[float] = None) -> bool:
+    by_lane: Dict[int, List[tuple]] = {}
+    for message, contact in batch:
+        by_lane.setdefault(get_lane_index(message.get('from')), []).append((message, contact))
+    
+    # Check every lane up front so a batch is either accepted or rejected whole
+    overflowing = [index for index, items in by_lane.items()
+                   if len(items) > message_lanes[index].maxsize - message_lanes[index].qsize()]
+    if overflowing and QUEUE_OVERFLOW_POLICY != 'drop_oldest':
+        queue_stats["rejected"] += len(batch)
+        return False
+    
+    now = time.monotonic()
+    received_at = received_at if received_at is not None else now
+    for index, items in by_lane.items():
+        lane = message_lanes[index]
+        if index in overflowing:
+            # Make room by discarding the oldest waiting messages in this lane
+            free = lane.maxsize - lane.qsize()
+            for _ in range(min(len(items) - free, lane.qsize())):
+                lane.get_nowait()
+                lane.task_done()
+                queue_stats["dropped"] += 1
+            if len(items) > lane.maxsize:
+                queue_stats["dropped"] += len(items) - lane.maxsize
+                items = items[-lane.maxsize:]
+        for message, contact in items:
+            lane.put_nowait((message, contact, now, received_at))
+            queue_stats["enqueued"] += 1
+    
+    queue_stats["max_depth"] = max(queue_stats["max_depth"], get_queue_depth())
+    return True
+
+def get_queue_stats() -> Dict:
+    stats = dict(queue_stats)
+    handled = stats["processed"] + stats["failed"]
+    stats["depth"] = get_queue_depth()
+    stats["lane_depths"] = [lane.qsize() for lane in message_lanes]
+    stats["capacity"] = sum(lane.maxsize for lane in message_lanes)
+    stats["workers"] = len(worker_tasks)
+    stats["overflow_policy"] = QUEUE_OVERFLOW_POLICY
+    stats["avg_wait_ms"] = round(stats.pop("total_wait_ms") / handled, 2) if handled else 0.0
+    stats["max_wait_ms"] = round(stats["max_wait_ms"], 2)
+    return stats
+
+class LatencyHistogram:
+    """Log-linear histogram of durations, recorded in microseconds.
+    
+    Each power of two is split into 16 linear buckets, so quantiles are
+    within ~6% of the true value and recording is a few integer operations.
+    """
+    
+    SUB_BUCKETS = 16
+    
+    def __init__(self):
+        self.counts: List[int] = []
+        self.count = 0
+        self.total = 0.0
+    
+    def record(self, seconds: float):
+        micros = int(seconds * 1000000) if seconds > 0 else 0
+        if micros < 2 * self.SUB_BUCKETS:
+            index = micros
+        else:
+            shift = micros.bit_length() - 5
+            index = shift * self.SUB_BUCKETS + (micros >> shift)
+        counts = self.counts
+        if index >= len(counts):
+            counts.extend([0] * (index + 1 - len(counts)))
+        counts[index] += 1
+        self.count += 1
+        self.total += seconds
+    
+    def bucket_bounds(self, index: int) -> tuple:
+        if index < 2 * self.SUB_BUCKETS:
+            return index, index + 1
+        shift = index // self.SUB_BUCKETS - 1
+        mantissa = index - shift * self.SUB_BUCKETS
+        return mantissa << shift, (mantissa + 1) << shift
+    
+    def quantile(self, q: float) -> float:
+        # Midpoint of the bucket holding the q-th value, in seconds
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                low, high = self.bucket_bounds(index)
+                return (low + high) / 2000000
+        return 0.0
+
+class LatencyMetrics:
+    """Per-message latency histograms by stage and conversation step.
+    
+    Stages: queue (webhook receipt until a worker picks the message up),
+    handling (session load, state machine and session save), send (Graph
+    API round trip) and total (receipt until the reply is sent).
+    """
+    
+    STAGES = ('queue', 'handling', 'send', 'total')
+    QUANTILES = (0.5, 0.95, 0.99)
+    
+    def __init__(self):
+        self.by_step: Dict[str, tuple] = {}  # step -> one histogram per stage
+    
+    def observe(self, step: str, received_at: float, started_at: float, handled_at: float, sent_at: float):
+        histograms = self.by_step.get(step)
+        if histograms is None:
+            histograms = self.by_step[step] = tuple(LatencyHistogram() for _ in self.STAGES)
+        queue, handling, send, total = histograms
+        queue.record(started_at - received_at)
+        handling.record(handled_at - started_at)
+        send.record(sent_at - handled_at)
+        total.record(sent_at - received_at)
+    
+    def render(self, name: str) -> List[str]:
+        lines = [
+            f"# HELP {name} Message processing latency by stage and conversation step.",
+            f"# TYPE {name} summary"
+        ]
+        series = sorted((stage, step, histogram) for step, histograms in self.by_step.items()
+                        for stage, histogram in zip(self.STAGES, histograms))
+        for stage, step, histogram in series:
+            labels = f'stage="{stage}",step="{step}"'
+            for q in self.QUANTILES:
+                lines.append(f'{name}{{{labels},quantile="{q}"}} {histogram.quantile(q):.9g}')
+            lines.append(f'{name}_sum{{{labels}}} {histogram.total:.9g}')
+            lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+        return lines
+
+latency_metrics = LatencyMetrics()
 
 # Webhook verification (required by WhatsApp)
 @app.get("/webhook")
@@ -69,41 +1685,170 @@ async def verify_webhook(request: Request):
         logger.error('Webhook verification failed')
         raise HTTPException(status_code=403, detail="Verification failed")
 
+def parse_webhook(body: bytes) -> Optional[List[tuple]]:
+    """The (message, contact) pairs of a webhook body, or None for status updates."""
+    try:
+        payload = json_loads(body)
+    except ValueError:
+        raise HTTPException(status_code=422, detail="Invalid JSON")
+    if not isinstance(payload, dict) or payload.get('object') != 'whatsapp_business_account':
+        raise HTTPException(status_code=404, detail="Not found")
+    if not MESSAGES_KEY_PATTERN.search(body):
+        return None
+    try:
+        message = webhook_validator.validate_python(payload)
+    except ValidationError:
+        raise HTTPException(status_code=422, detail="Invalid webhook payload")
+    
+    batch = []
+    for entry in message['entry']:
+        for change in entry.get('changes', ()):
+            value = change.get('value')
+            if change['field'] == 'messages' and value:
+                contacts = value.get('contacts')
+                contact = contacts[0] if contacts else {}
+                for msg in value.get('messages', ()):
+                    batch.append((msg, contact))
+    return batch
+
 # Main webhook to receive messages
 @app.post("/webhook")
-async def handle_webhook(message: WhatsAppMessage):
-    if message.object == 'whatsapp_business_account':
-        for entry in message.entry:
-            changes = entry.get('changes', [])
-            for change in changes:
-                if change.get('field') == 'messages':
-                    messages = change.get('value', {}).get('messages', [])
-                    contacts = change.get('value', {}).get('contacts', [])
-                    
-                    for msg in messages:
-                        contact = contacts[0] if contacts else {}
-                        await handle_message(msg, contact)
-        
+async def handle_webhook(request: Request):
+    received_at = time.monotonic()
+    # The raw body is parsed once, without FastAPI's generic body handling
+    batch = parse_webhook(await request.body())
+    if batch is None:
+        queue_stats["status_updates"] += 1
         return {"status": "OK"}
-    else:
-        raise HTTPException(status_code=404, detail="Not found")
+    
+    # Skip redeliveries of messages that were already accepted
+    message_ids = [msg.get('id') for msg, _ in batch]
+    claimed = iter(await session_store.claim_messages([message_id for message_id in message_ids if message_id]))
+    accepted = [item for item, message_id in zip(batch, message_ids) if not message_id or next(claimed)]
+    queue_stats["duplicates"] += len(batch) - len(accepted)
+    batch = accepted
+    
+    if not batch:
+        return {"status": "OK"}
+    
+    if not message_lanes:
+        # Workers not running (startup skipped), process inline
+        for msg, contact in batch:
+            await handle_message(msg, contact, received_at)
+    elif not enqueue_messages(batch, received_at):
+        # Let Meta redeliver once we have capacity again
+        logger.warning(f"Message queue full, rejecting {len(batch)} messages")
+        await session_store.release_messages([msg['id'] for msg, _ in batch if msg.get('id')])
+        raise HTTPException(status_code=503, detail="Queue full")
+    
+    return {"status": "OK"}
 
-# Handle incoming messages
-async def handle_message(message: Dict, contact: Dict):
-    from_number = message.get('from')
-    message_text = message.get('text', {}).get('body', '').lower().strip()
-    contact_name = contact.get('profile', {}).get('name', 'there')
+# Intent keywords per conversation step, in priority order. Keywords match
+# whole words only (so "a" no longer matches "account"); longer words also
+# match their plural.
+INTENT_KEYWORDS = {
+    'main_menu': [
+        ('pension_info', ['1', 'information', 'general']),
+        ('balance', ['2', 'balance', 'account']),
+        ('consultation', ['3', 'consultation', 'appointment']),
+        ('contributions', ['4', 'contribution', 'payment']),
+        ('agent', ['5', 'agent', 'human'])
+    ],
+    'pension_info': [
+        ('contribution_rates', ['a', 'contribution rates']),
+        ('investment', ['b', 'investment']),
+        ('retirement_benefits', ['c', 'retirement benefits']),
+        ('tax', ['d', 'tax'])
+    ],
+    'contribution_help': [
+        ('rates', ['rate', 'how much']),
+        ('increase', ['increase', 'more']),
+        ('history', ['history', 'past'])
+    ],
+    'agent_selection': [
+        ('account_issues', ['1', 'account']),
+        ('complaints', ['2', 'complaint']),
+        ('technical', ['3', 'technical']),
+        ('pension_planning', ['4', 'planning']),
+        ('contributions', ['5', 'contribution'])
+    ],
+    'message_type': [
+        ('account_inquiry', ['balance', 'account']),
+        ('complaint', ['complaint', 'problem']),
+        ('booking', ['consultation', 'appointment']),
+        ('contributions', ['contribution', 'payment']),
+        ('agent_request', ['agent', 'human'])
+    ]
+}
+
+class IntentClassifier:
+    """Resolves a message to an intent in a single pass over its words.
     
-    # Initialize user session if new
-    if from_number not in user_sessions:
-        user_sessions[from_number] = UserSession(name=contact_name)
+    The keyword table is compiled once into a word -> intent lookup per step;
+    phrases such as "how much" are indexed by their first word. When several
+    intents match, the one listed first in the table wins, as with the old
+    chain of if/elif keyword checks.
     
-    session = user_sessions[from_number]
-    response = ""
+    Single-character menu options ("1", "a") only count as the first word of
+    a message, and only when no other keyword matched, so the article in
+    "what about a tax break" does not pick option A.
+    """
     
-    # Main conversation flow
-    if session.step == 'welcome':
-        response = f"""Hello {contact_name}! 👋 Welcome to [Your Company Name] Pension Services.
+    TOKEN_PATTERN = re.compile(r'\w+')
+    
+    def __init__(self, table: Dict[str, List[tuple]]):
+        self.words: Dict[str, Dict[str, int]] = {}
+        self.phrases: Dict[str, Dict[str, List[tuple]]] = {}
+        self.options: Dict[str, Dict[str, int]] = {}
+        self.intents: Dict[str, List[str]] = {}
+        for step, intents in table.items():
+            words = {}
+            phrases = {}
+            options = {}
+            for index, (intent, keywords) in enumerate(intents):
+                for keyword in keywords:
+                    if len(keyword) == 1:
+                        options.setdefault(keyword, index)
+                        continue
+                    parts = keyword.split()
+                    variants = [parts[-1]]
+                    if len(parts[-1]) > 1:
+                        variants += [parts[-1] + 's', parts[-1] + 'es']
+                    for last in variants:
+                        if len(parts) == 1:
+                            words.setdefault(last, index)
+                        else:
+                            phrases.setdefault(parts[0], []).append((parts[1:-1] + [last], index))
+            self.words[step] = words
+            self.phrases[step] = phrases
+            self.options[step] = options
+            self.intents[step] = [intent for intent, _ in intents]
+    
+    def classify(self, step: str, message_text: str) -> Optional[str]:
+        words = self.words.get(step)
+        if words is None:
+            return None
+        phrases = self.phrases[step]
+        tokens = self.TOKEN_PATTERN.findall(message_text)
+        best = len(self.intents[step])
+        for position, token in enumerate(tokens):
+            index = words.get(token, best)
+            if token in phrases:
+                for rest, phrase_index in phrases[token]:
+                    if phrase_index < index and tokens[position + 1:position + 1 + len(rest)] == rest:
+                        index = phrase_index
+            if index < best:
+                best = index
+                if best == 0:
+                    break
+        if best == len(self.intents[step]) and tokens:
+            best = self.options[step].get(tokens[0], best)
+        return self.intents[step][best] if best < len(self.intents[step]) else None
+
+# Static response templates. Templates may use {contact_name} and
+# {message_text}; everything else is sent exactly as written.
+RESPONSES = {
+    'welcome': """Hello {contact_name}! 👋 Welcome to [Your Company Name] Pension Services.
 
 I can help you with:
 1️⃣ General pension information
@@ -112,12 +1857,9 @@ I can help you with:
 4️⃣ Contribution inquiries
 5️⃣ Speak with an agent
 
-Please reply with a number (1-5) or describe what you need help with."""
-        session.step = 'main_menu'
+Please reply with a number (1-5) or describe what you need help with.""",
     
-    elif session.step == 'main_menu':
-        if any(word in message_text for word in ['1', 'information', 'general']):
-            response = """📋 *Pension Information*
+    'pension_info': """📋 *Pension Information*
 
 Our pension plans offer:
 • Competitive returns on your investments
@@ -132,11 +1874,9 @@ B) Investment options
 C) Retirement benefits
 D) Tax advantages
 
-Reply with A, B, C, or D, or type "menu" to return to main options."""
-            session.step = 'pension_info'
-            
-        elif any(word in message_text for word in ['2', 'balance', 'account']):
-            response = """🔐 *Account Balance Inquiry*
+Reply with A, B, C, or D, or type "menu" to return to main options.""",
+    
+    'balance_verification': """🔐 *Account Balance Inquiry*
 
 To check your account balance, I'll need to verify your identity.
 
@@ -145,11 +1885,9 @@ Please provide:
 2. Date of birth (DD/MM/YYYY)
 3. Last 4 digits of your registered phone number
 
-*Note: This information is kept secure and used only for verification.*"""
-            session.step = 'balance_verification'
-            
-        elif any(word in message_text for word in ['3', 'consultation', 'appointment']):
-            response = """📅 *Schedule a Consultation*
+*Note: This information is kept secure and used only for verification.*""",
+    
+    'schedule_consultation': """📅 *Schedule a Consultation*
 
 I'd be happy to help you schedule a meeting with one of our pension advisors.
 
@@ -162,11 +1900,9 @@ Please tell me:
    - Retirement planning
    - General advice
 
-What works best for you?"""
-            session.step = 'schedule_consultation'
-            
-        elif any(word in message_text for word in ['4', 'contribution', 'payment']):
-            response = """💰 *Contribution Inquiries*
+What works best for you?""",
+    
+    'contribution_help': """💰 *Contribution Inquiries*
 
 I can help with:
 • Current contribution rates
@@ -175,15 +1911,9 @@ I can help with:
 • Payment methods
 • Contribution history
 
-What specific information do you need about contributions?"""
-            session.step = 'contribution_help'
-            
-        elif any(word in message_text for word in ['5', 'agent', 'human']):
-            response = await handle_agent_request(from_number, contact_name, message_text)
-            session.step = 'agent_selection'
-            
-        else:
-            response = """I'd be happy to help! Could you please choose from the options below or be more specific?
+What specific information do you need about contributions?""",
+    
+    'main_menu_help': """I'd be happy to help! Could you please choose from the options below or be more specific?
 
 1️⃣ General pension information
 2️⃣ Check account balance  
@@ -191,11 +1921,9 @@ What specific information do you need about contributions?"""
 4️⃣ Contribution inquiries
 5️⃣ Speak with an agent
 
-Just reply with a number or tell me what you need help with."""
+Just reply with a number or tell me what you need help with.""",
     
-    elif session.step == 'pension_info':
-        if any(word in message_text for word in ['a', 'contribution rates']):
-            response = """💵 *Contribution Rates*
+    'contribution_rates': """💵 *Contribution Rates*
 
 Our flexible contribution options:
 • Minimum: 5% of monthly salary
@@ -205,10 +1933,9 @@ Our flexible contribution options:
 
 Current rates are competitive with market standards. Would you like to discuss a personalized contribution plan?
 
-Reply "yes" to schedule a call, or "menu" for main options."""
-            
-        elif any(word in message_text for word in ['b', 'investment']):
-            response = """📈 *Investment Options*
+Reply "yes" to schedule a call, or "menu" for main options.""",
+    
+    'investment_options': """📈 *Investment Options*
 
 We offer diversified portfolios:
 • Conservative (bonds, stable income)
@@ -218,10 +1945,9 @@ We offer diversified portfolios:
 
 All funds are professionally managed with regular performance reviews.
 
-Would you like details on any specific option? Or type "menu" to return."""
-            
-        elif any(word in message_text for word in ['c', 'retirement benefits']):
-            response = """🏖️ *Retirement Benefits*
+Would you like details on any specific option? Or type "menu" to return.""",
+    
+    'retirement_benefits': """🏖️ *Retirement Benefits*
 
 When you retire, you can:
 • Receive monthly pension payments
@@ -231,10 +1957,9 @@ When you retire, you can:
 
 Benefit amounts depend on contributions and investment performance over time.
 
-Need help calculating your potential benefits? Type "calculate" or "menu"."""
-            
-        elif any(word in message_text for word in ['d', 'tax']):
-            response = """💸 *Tax Advantages*
+Need help calculating your potential benefits? Type "calculate" or "menu".""",
+    
+    'tax_advantages': """💸 *Tax Advantages*
 
 Pension contributions offer significant tax benefits:
 • Income tax relief on contributions
@@ -245,20 +1970,17 @@ Pension contributions offer significant tax benefits:
 
 These benefits can significantly boost your retirement savings!
 
-Want to know your specific tax savings? Type "calculate" or "menu"."""
-            
-        else:
-            response = """Please choose one of the options:
+Want to know your specific tax savings? Type "calculate" or "menu".""",
+    
+    'pension_info_help': """Please choose one of the options:
 A) Contribution rates
 B) Investment options  
 C) Retirement benefits
 D) Tax advantages
 
-Or type "menu" to return to main options."""
+Or type "menu" to return to main options.""",
     
-    elif session.step == 'balance_verification':
-        session.data['verification'] = message_text
-        response = """🔍 Thank you for providing your details. 
+    'balance_received': """🔍 Thank you for providing your details. 
 
 *For security reasons, account balance checks require manual verification by our team.*
 
@@ -266,12 +1988,9 @@ I've recorded your request and someone will contact you within 2 business hours
 
 Is there anything else I can help you with today?
 
-Type "menu" for main options."""
-        session.step = 'main_menu'
+Type "menu" for main options.""",
     
-    elif session.step == 'schedule_consultation':
-        session.data['consultation'] = message_text
-        response = f"""✅ Perfect! I've noted your consultation preferences:
+    'consultation_received': """✅ Perfect! I've noted your consultation preferences:
 
 "{message_text}"
 
@@ -283,47 +2002,17 @@ Our team will contact you within 24 hours to confirm your appointment slot. We'l
 
 You'll receive a confirmation SMS and email shortly.
 
-Anything else I can help with? Type "menu" for main options."""
-        session.step = 'main_menu'
-    
-    elif session.step == 'contribution_help':
-        response = handle_contribution_query(message_text)
-    
-    elif session.step == 'agent_selection':
-        response = await handle_agent_selection(from_number, message_text, contact_name)
-    
-    elif session.step == 'with_agent':
-        response = await handle_agent_conversation(from_number, message_text, contact_name)
+Anything else I can help with? Type "menu" for main options.""",
     
-    elif session.step == 'complaint_form':
-        response = await handle_complaint_form(from_number, message_text, session)
-    
-    elif session.step == 'feedback_form':
-        response = await handle_feedback_form(from_number, message_text, session)
-    
-    else:
-        session.step = 'main_menu'
-        response = """Let me help you with your pension needs. Please choose:
+    'fallback_menu': """Let me help you with your pension needs. Please choose:
 
 1️⃣ General pension information
 2️⃣ Check account balance
 3️⃣ Schedule a consultation  
 4️⃣ Contribution inquiries
-5️⃣ Speak with an agent"""
-    
-    # Always offer menu option
-    if 'menu' not in response:
-        response += '\n\n💡 Type "menu" anytime to see all options.'
+5️⃣ Speak with an agent""",
     
-    # Log interaction for Power BI
-    await log_interaction(from_number, message_text, response, session.step)
-    
-    await send_message(from_number, response)
-
-# Handle contribution-related queries
-def handle_contribution_query(message_text: str) -> str:
-    if any(word in message_text for word in ['rate', 'how much']):
-        return """💰 *Current Contribution Information*
+    'contribution_rates_info': """💰 *Current Contribution Information*
 
 Standard rates:
 • Employee minimum: 5% of salary
@@ -335,10 +2024,9 @@ The more you contribute now, the better your retirement income will be!
 
 Need help calculating your ideal contribution? Type "calculate".
 Want to increase contributions? Type "increase".
-Type "menu" for main options."""
-        
-    elif any(word in message_text for word in ['increase', 'more']):
-        return """📈 *Increase Your Contributions*
+Type "menu" for main options.""",
+    
+    'contribution_increase': """📈 *Increase Your Contributions*
 
 Great decision! Increasing contributions can significantly boost your retirement fund.
 
@@ -350,10 +2038,9 @@ To increase your contributions:
 
 I'll arrange for an advisor to call you within 24 hours to discuss this.
 
-Type "menu" for other options."""
-        
-    elif any(word in message_text for word in ['history', 'past']):
-        return """📊 *Contribution History*
+Type "menu" for other options.""",
+    
+    'contribution_history': """📊 *Contribution History*
 
 For detailed contribution history, our team will need to access your secure account.
 
@@ -365,10 +2052,9 @@ We can provide:
 
 An advisor will contact you within 2 business hours with your complete contribution history.
 
-Type "menu" for other options."""
-        
-    else:
-        return """I can help with various contribution topics:
+Type "menu" for other options.""",
+    
+    'contribution_help_topics': """I can help with various contribution topics:
 
 • Current rates and recommendations
 • Increasing your contributions
@@ -377,27 +2063,191 @@ Type "menu" for other options."""
 • Tax benefits
 
 What specific aspect would you like to know about?"""
+}
+
+# Conversation flow: step -> intent -> transition. A transition can reply with
+# a RESPONSES template or run a named action, store the raw message in
+# session.data ("capture") and move the session to another step ("next").
+# The "default" transition applies when no intent matches.
+CONVERSATION_FLOW = {
+    'welcome': {
+        'default': {'response': 'welcome', 'next': 'main_menu'}
+    },
+    'main_menu': {
+        'pension_info': {'response': 'pension_info', 'next': 'pension_info'},
+        'balance': {'response': 'balance_verification', 'next': 'balance_verification'},
+        'consultation': {'response': 'schedule_consultation', 'next': 'schedule_consultation'},
+        'contributions': {'response': 'contribution_help', 'next': 'contribution_help'},
+        'agent': {'action': 'agent_request', 'next': 'agent_selection'},
+        'default': {'response': 'main_menu_help'}
+    },
+    'pension_info': {
+        'contribution_rates': {'response': 'contribution_rates'},
+        'investment': {'response': 'investment_options'},
+        'retirement_benefits': {'response': 'retirement_benefits'},
+        'tax': {'response': 'tax_advantages'},
+        'default': {'response': 'pension_info_help'}
+    },
+    'balance_verification': {
+        'default': {'capture': 'verification', 'response': 'balance_received', 'next': 'main_menu'}
+    },
+    'schedule_consultation': {
+        'default': {'capture': 'consultation', 'response': 'consultation_received', 'next': 'main_menu'}
+    },
+    'contribution_help': {
+        'rates': {'response': 'contribution_rates_info'},
+        'increase': {'response': 'contribution_increase'},
+        'history': {'response': 'contribution_history'},
+        'default': {'response': 'contribution_help_topics'}
+    }
+}
+
+class ConversationFlow:
+    """Compiled, swappable view of the keyword, transition and response tables.
+    
+    Building validates the tables up front, so a bad reload is rejected and
+    the previous flow stays active.
+    """
+    
+    def __init__(self, keywords: Dict, transitions: Dict, responses: Dict):
+        self.classifier = IntentClassifier(keywords)
+        self.transitions = transitions
+        # Static replies are returned as-is; only templates with fields get formatted
+        self.responses = {
+            key: (sys.intern(text), '{' in text) for key, text in responses.items()
+        }
+        self.dispatch = {step: handle_flow_step for step in transitions}
+        self.dispatch.update(STEP_HANDLERS)
+        self.validate()
+    
+    def validate(self):
+        for key, (text, has_fields) in self.responses.items():
+            if has_fields:
+                try:
+                    text.format_map({'contact_name': '', 'message_text': ''})
+                except (KeyError, IndexError, ValueError) as e:
+                    raise ValueError(f"Response '{key}' has an invalid template field: {e}")
+        for step, transitions in self.transitions.items():
+            if 'default' not in transitions:
+                raise ValueError(f"Step '{step}' has no default transition")
+            for intent, transition in transitions.items():
+                if intent != 'default' and intent not in self.classifier.intents.get(step, []):
+                    raise ValueError(f"Step '{step}' has no keywords for intent '{intent}'")
+                if 'response' in transition and transition['response'] not in self.responses:
+                    raise ValueError(f"Unknown response '{transition['response']}' in step '{step}'")
+                if 'action' in transition and transition['action'] not in FLOW_ACTIONS:
+                    raise ValueError(f"Unknown action '{transition['action']}' in step '{step}'")
+                if 'next' in transition and transition['next'] not in self.dispatch:
+                    raise ValueError(f"Unknown next step '{transition['next']}' in step '{step}'")
+    
+    def render(self, key: str, **fields) -> str:
+        text, has_fields = self.responses[key]
+        return text.format_map(fields) if has_fields else text
+
+async def handle_flow_step(from_number: str, message_text: str, contact_name: str, session: UserSession) -> str:
+    transitions = conversation_flow.transitions[session.step]
+    intent = conversation_flow.classifier.classify(session.step, message_text)
+    transition = transitions.get(intent) or transitions['default']
+    
+    if 'capture' in transition:
+        session.data[transition['capture']] = message_text
+    if 'action' in transition:
+        response = await FLOW_ACTIONS[transition['action']](from_number, message_text, contact_name, session)
+    else:
+        response = conversation_flow.render(
+            transition['response'], contact_name=contact_name, message_text=message_text
+        )
+    if 'next' in transition:
+        session.step = transition['next']
+    return response
+
+async def handle_unknown_step(from_number: str, message_text: str, contact_name: str, session: UserSession) -> str:
+    session.step = 'main_menu'
+    return conversation_flow.render('fallback_menu')
+
+def load_conversation_flow(path: Optional[str] = None) -> ConversationFlow:
+    # A flow file only needs the entries it changes; they are merged over the defaults
+    keywords = dict(INTENT_KEYWORDS)
+    transitions = dict(CONVERSATION_FLOW)
+    responses = dict(RESPONSES)
+    if path:
+        with open(path, encoding='utf-8') as f:
+            overrides = json.load(f)
+        keywords.update({step: [tuple(entry) for entry in intents]
+                         for step, intents in overrides.get('keywords', {}).items()})
+        transitions.update(overrides.get('flow', {}))
+        responses.update(overrides.get('responses', {}))
+    return ConversationFlow(keywords, transitions, responses)
+
+async def conversation_flow_watcher():
+    global conversation_flow, conversation_flow_mtime
+    while True:
+        await asyncio.sleep(CONVERSATION_FLOW_RELOAD_INTERVAL)
+        try:
+            mtime = os.path.getmtime(CONVERSATION_FLOW_FILE)
+            if mtime == conversation_flow_mtime:
+                continue
+            # Remember the attempt so a broken file is not re-parsed every tick
+            conversation_flow_mtime = mtime
+            conversation_flow = load_conversation_flow(CONVERSATION_FLOW_FILE)
+            logger.info(f"Reloaded conversation flow from {CONVERSATION_FLOW_FILE}")
+        except Exception as e:
+            logger.error(f"Failed to reload conversation flow, keeping current one: {e}")
+
+# Handle incoming messages
+async def handle_message(message: Dict, contact: Dict, received_at: Optional[float] = None):
+    started_at = time.monotonic()
+    if received_at is None:
+        received_at = started_at
+    from_number = message.get('from')
+    message_text = message.get('text', {}).get('body', '').lower().strip()
+    contact_name = contact.get('profile', {}).get('name', 'there')
+    
+    # Initialize user session if new
+    session = await session_store.load(from_number)
+    if session is None:
+        session = UserSession(name=contact_name)
+    
+    # Main conversation flow
+    step = session.step
+    handler = conversation_flow.dispatch.get(step, handle_unknown_step)
+    try:
+        response = await handler(from_number, message_text, contact_name, session)
+    except BaseException:
+        # Nothing to save, but the user's next message must not wait out the lock
+        await session_store.unlock(from_number)
+        raise
+    
+    # Always offer menu option
+    if 'menu' not in response:
+        response += '\n\n💡 Type "menu" anytime to see all options.'
+    
+    await session_store.save(from_number, session)
+    handled_at = time.monotonic()
+    next_step = session.step
+    
+    def on_sent(sent_at: float, sent: bool):
+        latency_metrics.observe(step, received_at, started_at, handled_at, sent_at)
+        # Log interaction for Power BI
+        log_interaction(from_number, message_text, response, next_step, round((sent_at - received_at) * 1000))
+    
+    await send_message(from_number, response, on_sent)
 
 # Agent Management System
-async def handle_agent_request(from_number: str, contact_name: str, message_text: str) -> str:
+async def handle_agent_request(from_number: str, contact_name: str, message_text: str, session: UserSession) -> str:
     ticket_id = generate_ticket_id()
     
     # Create initial ticket
-    ticket = {
-        'id': ticket_id,
-        'customer_id': from_number,
-        'customer_name': contact_name,
-        'status': 'new',
-        'priority': 'normal',
-        'created_at': datetime.now().isoformat(),
-        'initial_message': message_text,
-        'category': 'general',
-        'assigned_agent': None,
-        'messages': []
-    }
+    ticket = Ticket(
+        id=ticket_id,
+        customer_id=from_number,
+        customer_name=contact_name,
+        initial_message=message_text,
+        created_at=time.time()
+    )
     
-    agents_data['tickets'][ticket_id] = ticket
-    user_sessions[from_number].ticket_id = ticket_id
+    add_ticket(ticket)
+    session.ticket_id = ticket_id
     
     return f"""👥 *Connect with an Agent*
 
@@ -416,33 +2266,65 @@ Please select the type of assistance you need:
 
 Please reply with a number (1-6) or describe your specific need."""
 
-async def handle_agent_selection(from_number: str, message_text: str, contact_name: str) -> str:
-    session = user_sessions[from_number]
-    ticket = agents_data['tickets'][session.ticket_id]
+def session_ticket(session: UserSession) -> Optional[Ticket]:
+    # Tickets are held by the process that created them. With a shared session
+    # store the user's next message can reach a worker that has never seen it.
+    ticket = agents_data['tickets'].get(session.ticket_id)
+    if ticket is None:
+        logger.warning(f"Ticket {session.ticket_id} is not held by this worker")
+    elif ticket.status not in OPEN_TICKET_STATUSES:
+        # Closed while the customer was away, e.g. after the chat went idle
+        return None
+    return ticket
+
+def lost_ticket_reply(session: UserSession) -> str:
+    ticket_id = session.ticket_id
+    session.step = 'main_menu'
+    session.ticket_id = None
+    return f"""⚠️ *We couldn't resume ticket {ticket_id}*
+
+Please reply with 5 to connect with an agent again, or type "menu" to see all options."""
+
+async def handle_agent_selection(from_number: str, message_text: str, contact_name: str, session: UserSession) -> str:
+    ticket = session_ticket(session)
+    if ticket is None:
+        return lost_ticket_reply(session)
+    
+    if ticket.status == 'assigned' and ticket.assigned_agent:
+        # An agent picked the ticket up from the queue since the last message
+        session.step = 'with_agent'
+        return await handle_agent_conversation(from_number, message_text, contact_name, session)
+    if message_text in QUEUE_EXIT_COMMANDS:
+        return await cancel_agent_request(ticket, session)
+    if ticket.status == 'queued':
+        # Details sent while waiting are kept for the agent who picks the ticket up
+        add_ticket_message(ticket, TicketMessage(sender='customer', message=message_text, timestamp=time.time()))
+        return await format_queue_status(ticket)
     
     category = 'general'
     priority = 'normal'
     department_message = ''
     
-    if any(word in message_text for word in ['1', 'account']):
+    intent = conversation_flow.classifier.classify('agent_selection', message_text)
+    if intent == 'account_issues':
         category = 'account_issues'
         priority = 'high'
         department_message = 'Account Services Team'
-    elif any(word in message_text for word in ['2', 'complaint']):
+    elif intent == 'complaints':
         category = 'complaints'
         priority = 'high'
         department_message = 'Customer Relations Team'
         session.step = 'complaint_form'
         return await handle_complaint_form(from_number, 'start', session)
-    elif any(word in message_text for word in ['3', 'technical']):
+    elif intent == 'technical':
         category = 'technical'
         priority = 'normal'
         department_message = 'Technical Support Team'
-    elif any(word in message_text for word in ['4', 'planning']):
+    elif intent == 'pension_planning':
         category = 'pension_planning'
         priority = 'normal'
         department_message = 'Pension Advisory Team'
-    elif any(word in message_text for word in ['5', 'contribution']):
+    elif intent == 'contributions':
         category = 'contributions'
         priority = 'normal'
         department_message = 'Contributions Team'
@@ -452,23 +2334,25 @@ async def handle_agent_selection(from_number: str, message_text: str, contact_na
         department_message = 'General Support Team'
     
     # Update ticket
-    ticket['category'] = category
-    ticket['priority'] = priority
-    ticket['department'] = department_message
-    ticket['status'] = 'assigned'
+    update_ticket(ticket, category=category, priority=priority, department=department_message)
     
     # Try to assign available agent
-    agent = await assign_agent(category, ticket['id'])
+    agent = await assign_agent(ticket)
     
     if agent:
-        ticket['assigned_agent'] = agent['id']
-        ticket['agent_name'] = agent['name']
+        update_ticket(
+            ticket,
+            status='assigned',
+            assigned_agent=agent['id'],
+            agent_name=agent['name'],
+            assigned_at=time.time()
+        )
         session.step = 'with_agent'
         
         return f"""✅ *Connected to {department_message}*
 
 👤 **Agent:** {agent['name']}
-🎫 **Ticket ID:** {ticket['id']}
+🎫 **Ticket ID:** {ticket.id}
 ⏱️ **Status:** Connected
 📞 **Response Time:** Immediate
 
@@ -477,14 +2361,17 @@ Your agent is ready to help! Please describe your issue in detail, and {agent['n
 🔄 Type "end" to close this conversation
 📋 Type "summary" for ticket details"""
     else:
-        ticket['status'] = 'queued'
-        queue_position = await get_queue_position(category)
-        estimated_wait = await get_estimated_wait(category)
-        
-        return f"""⏳ *Queued for {department_message}*
+        update_ticket(ticket, status='queued')
+        return await format_queue_status(ticket)
+
+async def format_queue_status(ticket: Ticket) -> str:
+    queue_position = await get_queue_position(ticket)
+    estimated_wait = await get_estimated_wait(ticket.category)
+    
+    return f"""⏳ *Queued for {ticket.department}*
 
-🎫 **Ticket ID:** {ticket['id']}
-📊 **Priority:** {priority.upper()}
+🎫 **Ticket ID:** {ticket.id}
+📊 **Priority:** {ticket.priority.upper()}
 👥 **Queue Position:** {queue_position}
 ⏰ **Estimated Wait:** {estimated_wait}
 
@@ -495,38 +2382,53 @@ In the meantime, you can:
 • Upload relevant documents (if needed)
 • Type "urgent" if this requires immediate attention
 
-💡 Type "callback" to request a phone call instead"""
+💡 Type "callback" to request a phone call instead
+❌ Type "cancel" to leave the queue"""
+
+QUEUE_EXIT_COMMANDS = ('cancel', 'exit', 'end', 'menu')
+
+async def cancel_agent_request(ticket: Ticket, session: UserSession) -> str:
+    queued = ticket.status == 'queued'
+    await close_ticket(ticket, 'cancelled')
+    session.step = 'main_menu'
+    session.ticket_id = None
+    
+    return f"""❌ *Request Cancelled*
+
+🎫 **Ticket ID:** {ticket.id}
+📋 **Status:** Cancelled{' - you have left the queue' if queued else ''}
+
+Reply with a number (1-5) to choose another option, or type "menu" to see them all."""
 
-async def handle_agent_conversation(from_number: str, message_text: str, contact_name: str) -> str:
-    session = user_sessions[from_number]
-    ticket = agents_data['tickets'][session.ticket_id]
+async def handle_agent_conversation(from_number: str, message_text: str, contact_name: str, session: UserSession) -> str:
+    ticket = session_ticket(session)
+    if ticket is None:
+        return lost_ticket_reply(session)
     
     if message_text.lower() == 'end':
-        return await end_agent_session(from_number, ticket)
+        return await end_agent_session(from_number, ticket, session)
     
     if message_text.lower() == 'summary':
         return await get_ticket_summary(ticket)
     
     # Log customer message
-    customer_message = {
-        'sender': 'customer',
-        'message': message_text,
-        'timestamp': datetime.now().isoformat()
-    }
-    ticket['messages'].append(customer_message)
+    add_ticket_message(ticket, TicketMessage(
+        sender='customer',
+        message=message_text,
+        timestamp=time.time()
+    ))
     
     # Simulate agent response
     agent_response = await generate_agent_response(message_text, ticket)
     
-    agent_message = {
-        'sender': 'agent',
-        'agent_id': ticket['assigned_agent'],
-        'message': agent_response,
-        'timestamp': datetime.now().isoformat()
-    }
-    ticket['messages'].append(agent_message)
+    add_ticket_message(ticket, TicketMessage(
+        sender='agent',
+        agent_id=ticket.assigned_agent,
+        message=agent_response,
+        timestamp=time.time()
+    ))
     
-    return f"""👤 **{ticket['agent_name']}:** {agent_response}
+    return f"""👤 **{ticket.agent_name}:** {agent_response}
 
 ---
 🔄 Type "end" to close | 📋 "summary" for details"""
@@ -584,21 +2486,19 @@ The more details you provide, the better we can resolve this for you."""
         
         # Generate complaint ticket
         complaint_id = generate_complaint_id()
-        complaint_ticket = {
-            'id': complaint_id,
-            'customer_id': from_number,
-            'type': complaint['type'],
-            'date_time': complaint['date_time'],
-            'details': complaint['details'],
-            'severity': 'medium',
-            'status': 'open',
-            'created_at': datetime.now().isoformat(),
-            'assigned_to': 'complaints_team',
-            'follow_up_date': (datetime.now() + timedelta(hours=48)).isoformat()
-        }
+        now = time.time()
+        complaint_ticket = ComplaintTicket(
+            id=complaint_id,
+            customer_id=from_number,
+            type=complaint['type'],
+            date_time=complaint['date_time'],
+            details=complaint['details'],
+            created_at=now,
+            follow_up_date=now + timedelta(hours=48).total_seconds()
+        )
         
         # Store complaint
-        collections_data['tickets'].append(complaint_ticket)
+        add_complaint(complaint_ticket)
         
         return f"""✅ **Complaint Registered Successfully**
 
@@ -628,40 +2528,407 @@ Thank you for bringing this to our attention. We're committed to resolving this
         return 'Thank you for your complaint. Type "menu" to return to main options.'
 
 async def handle_feedback_form(from_number: str, message_text: str, session: UserSession) -> str:
+    # Options are listed best first, so "1" (excellent) is a rating of 5
+    choice = message_text.strip()
+    ticket = agents_data['tickets'].get(session.ticket_id)
+    if choice in ('1', '2', '3', '4', '5') and ticket is not None and ticket.rating is None:
+        update_ticket(ticket, rating=6 - int(choice), rated_at=time.time())
+        conversation_analytics.observe_rating(ticket.rating, ticket.rated_at)
+    
     return "Thank you for your feedback! We value your input and will use it to improve our services."
 
+# Steps with custom logic; every other step is driven by CONVERSATION_FLOW
+STEP_HANDLERS = {
+    'agent_selection': handle_agent_selection,
+    'with_agent': handle_agent_conversation,
+    'complaint_form': lambda from_number, message_text, contact_name, session:
+        handle_complaint_form(from_number, message_text, session),
+    'feedback_form': lambda from_number, message_text, contact_name, session:
+        handle_feedback_form(from_number, message_text, session)
+}
+
+# Actions that flow transitions can trigger
+FLOW_ACTIONS = {
+    'agent_request': lambda from_number, message_text, contact_name, session:
+        handle_agent_request(from_number, contact_name, message_text, session)
+}
+
+conversation_flow_mtime = os.path.getmtime(CONVERSATION_FLOW_FILE) if CONVERSATION_FLOW_FILE else None
+conversation_flow = load_conversation_flow(CONVERSATION_FLOW_FILE)
+
 # Agent assignment logic
-async def assign_agent(category: str, ticket_id: str) -> Optional[Dict]:
-    available_agents = {
-        'account_issues': [
-            {'id': 'AG001', 'name': 'Sarah Mitchell', 'speciality': 'Account Services'},
-            {'id': 'AG002', 'name': 'David Chen', 'speciality': 'Payment Issues'}
-        ],
-        'complaints': [
-            {'id': 'AG003', 'name': 'Emma Johnson', 'speciality': 'Customer Relations'},
-            {'id': 'AG004', 'name': 'Michael Brown', 'speciality': 'Complaint Resolution'}
-        ],
-        'technical': [
-            {'id': 'AG005', 'name': 'Alex Kumar', 'speciality': 'Technical Support'},
-            {'id': 'AG006', 'name': 'Lisa Wang', 'speciality': 'System Issues'}
-        ],
-        'pension_planning': [
-            {'id': 'AG007', 'name': 'Robert Taylor', 'speciality': 'Pension Advisor'},
-            {'id': 'AG008', 'name': 'Jennifer Davis', 'speciality': 'Retirement Planning'}
-        ],
-        'contributions': [
-            {'id': 'AG009', 'name': 'Mark Wilson', 'speciality': 'Contributions Specialist'},
-            {'id': 'AG010', 'name': 'Anna Garcia', 'speciality': 'Payment Processing'}
-        ],
-        'general': [
-            {'id': 'AG011', 'name': 'Tom Anderson', 'speciality': 'General Support'}
-        ]
-    }
+AGENT_ROSTER = {
+    'account_issues': [
+        {'id': 'AG001', 'name': 'Sarah Mitchell', 'speciality': 'Account Services'},
+        {'id': 'AG002', 'name': 'David Chen', 'speciality': 'Payment Issues'}
+    ],
+    'complaints': [
+        {'id': 'AG003', 'name': 'Emma Johnson', 'speciality': 'Customer Relations'},
+        {'id': 'AG004', 'name': 'Michael Brown', 'speciality': 'Complaint Resolution'}
+    ],
+    'technical': [
+        {'id': 'AG005', 'name': 'Alex Kumar', 'speciality': 'Technical Support'},
+        {'id': 'AG006', 'name': 'Lisa Wang', 'speciality': 'System Issues'}
+    ],
+    'pension_planning': [
+        {'id': 'AG007', 'name': 'Robert Taylor', 'speciality': 'Pension Advisor'},
+        {'id': 'AG008', 'name': 'Jennifer Davis', 'speciality': 'Retirement Planning'}
+    ],
+    'contributions': [
+        {'id': 'AG009', 'name': 'Mark Wilson', 'speciality': 'Contributions Specialist'},
+        {'id': 'AG010', 'name': 'Anna Garcia', 'speciality': 'Payment Processing'}
+    ],
+    'general': [
+        {'id': 'AG011', 'name': 'Tom Anderson', 'speciality': 'General Support'}
+    ]
+}
+
+class AgentRouter:
+    """Routes tickets to agents with spare capacity, queueing the rest.
+    
+    Each category keeps a heap of agents keyed by current load (least loaded,
+    then least recently changed, first), invalidated lazily, and a sorted list
+    of waiting tickets keyed by priority and arrival. A ticket's queue position
+    is a binary search; queueing and dequeueing shift the list, a memmove that
+    stays in the microseconds at tens of thousands of waiting tickets.
+    """
+    
+    PRIORITY_RANK = {'urgent': 0, 'high': 1, 'normal': 2, 'low': 3}
+    
+    def __init__(self, roster: Dict[str, List[Dict]], capacity: int = AGENT_CAPACITY):
+        self.roster = roster
+        self.capacity = capacity
+        self.reset()
+    
+    def reset(self):
+        self.agents: Dict[str, Dict] = {}
+        self.free_agents: Dict[str, list] = {}
+        self.ticket_queues: Dict[str, list] = {}
+        self.queued: Dict[str, tuple] = {}
+        self.queue_sizes: Dict[str, int] = {}
+        self.counter = itertools.count()
+        agents_data['available'].clear()
+        agents_data['busy'].clear()
+        for category, agents in self.roster.items():
+            self.free_agents[category] = []
+            self.ticket_queues[category] = []
+            self.queue_sizes[category] = 0
+            for agent in agents:
+                self.agents[agent['id']] = dict(agent, category=category)
+                agents_data['busy'][agent['id']] = set()
+                self.update_availability(agent['id'])
+    
+    def route_category(self, category: str) -> str:
+        return category if category in self.free_agents else 'general'
+    
+    def update_availability(self, agent_id: str):
+        load = len(agents_data['busy'][agent_id])
+        agents_data['available'][agent_id] = self.capacity - load
+        if load < self.capacity:
+            category = self.agents[agent_id]['category']
+            heapq.heappush(self.free_agents[category], (load, next(self.counter), agent_id))
+    
+    def pop_free_agent(self, category: str) -> Optional[str]:
+        heap = self.free_agents[category]
+        while heap:
+            load, _, agent_id = heapq.heappop(heap)
+            # Entries left behind by earlier load changes are stale
+            if load == len(agents_data['busy'][agent_id]) and load < self.capacity:
+                return agent_id
+        return None
+    
+    def occupy(self, agent_id: str, ticket_id: str):
+        agents_data['busy'][agent_id].add(ticket_id)
+        self.update_availability(agent_id)
+    
+    def enqueue(self, ticket: Ticket):
+        category = self.route_category(ticket.category)
+        entry = (self.PRIORITY_RANK.get(ticket.priority, 2), ticket.created_at, next(self.counter), ticket.id, category)
+        bisect.insort(self.ticket_queues[category], entry)
+        self.queued[ticket.id] = entry
+        self.queue_sizes[category] += 1
+    
+    def dequeue(self, category: str) -> Optional[Ticket]:
+        queue = self.ticket_queues[category]
+        while queue:
+            ticket_id = queue.pop(0)[3]
+            del self.queued[ticket_id]
+            self.queue_sizes[category] -= 1
+            ticket = agents_data['tickets'].get(ticket_id)
+            if ticket is not None and ticket.status == 'queued':
+                return ticket
+        return None
+    
+    def assign(self, ticket: Ticket) -> Optional[Dict]:
+        agent_id = self.pop_free_agent(self.route_category(ticket.category))
+        if agent_id is None:
+            self.enqueue(ticket)
+            return None
+        self.occupy(agent_id, ticket.id)
+        return self.agents[agent_id]
+    
+    def release(self, ticket: Ticket) -> Optional[tuple]:
+        """Frees the ticket's slot and returns (next_ticket, agent) if a queued ticket takes it."""
+        entry = self.queued.pop(ticket.id, None)
+        if entry is not None:
+            queue = self.ticket_queues[entry[4]]
+            del queue[bisect.bisect_left(queue, entry)]
+            self.queue_sizes[entry[4]] -= 1
+            return None
+        busy = agents_data['busy'].get(ticket.assigned_agent)
+        if busy is None or ticket.id not in busy:
+            return None
+        busy.discard(ticket.id)
+        
+        agent = self.agents[ticket.assigned_agent]
+        next_ticket = self.dequeue(agent['category'])
+        if next_ticket is None:
+            self.update_availability(agent['id'])
+            return None
+        self.occupy(agent['id'], next_ticket.id)
+        return next_ticket, agent
+    
+    def queue_position(self, ticket_id: str) -> int:
+        entry = self.queued.get(ticket_id)
+        if entry is None:
+            return 0
+        return bisect.bisect_left(self.ticket_queues[entry[4]], entry) + 1
+    
+    def queue_depth(self, category: str) -> int:
+        return self.queue_sizes.get(self.route_category(category), 0)
+    
+    def rebuild(self, tickets):
+        # Restores agent load and queues from replayed tickets
+        self.reset()
+        for ticket in sorted(tickets, key=lambda t: t.created_at):
+            if ticket.status == 'assigned' and ticket.assigned_agent in self.agents:
+                agents_data['busy'][ticket.assigned_agent].add(ticket.id)
+            elif ticket.status == 'queued':
+                self.enqueue(ticket)
+        for agent_id in self.agents:
+            self.update_availability(agent_id)
+
+agent_router = AgentRouter(AGENT_ROSTER)
+
+class WaitTimeEstimator:
+    """Per-category exponentially weighted average of ticket service time.
+    
+    Updated once per resolved ticket; the wait estimate combines it with the
+    live queue depth and the category's agent slots, so nothing scans tickets.
+    """
+    
+    def __init__(self, alpha: float = WAIT_EWMA_ALPHA):
+        self.alpha = alpha
+        self.service_seconds: Dict[str, float] = {}
+        self.samples: Dict[str, int] = {}
+    
+    def observe(self, category: str, seconds: float):
+        category = agent_router.route_category(category)
+        previous = self.service_seconds.get(category)
+        if previous is None:
+            self.service_seconds[category] = seconds
+        else:
+            self.service_seconds[category] = previous + self.alpha * (seconds - previous)
+        self.samples[category] = self.samples.get(category, 0) + 1
+    
+    def agent_slots(self, category: str) -> int:
+        return len(agent_router.roster.get(agent_router.route_category(category), [])) * agent_router.capacity
+    
+    def estimate_seconds(self, category: str, queue_depth: int) -> Optional[float]:
+        service = self.service_seconds.get(agent_router.route_category(category))
+        if service is None:
+            return None
+        return service * queue_depth / max(1, self.agent_slots(category))
+    
+    def rebuild(self, tickets):
+        self.service_seconds.clear()
+        self.samples.clear()
+        resolved = [t for t in tickets if t.status == 'resolved' and t.assigned_at and t.closed_at]
+        for ticket in sorted(resolved, key=lambda t: t.closed_at):
+            self.observe(ticket.category, ticket.closed_at - ticket.assigned_at)
+    
+    def metrics(self) -> Dict:
+        categories = {}
+        for category in agent_router.roster:
+            depth = agent_router.queue_depth(category)
+            service = self.service_seconds.get(category)
+            estimate = self.estimate_seconds(category, depth)
+            categories[category] = {
+                "ewma_service_seconds": round(service, 1) if service is not None else None,
+                "samples": self.samples.get(category, 0),
+                "queue_depth": depth,
+                "agent_slots": self.agent_slots(category),
+                "free_slots": sum(agents_data['available'][agent['id']] for agent in agent_router.roster[category]),
+                "service_rate_per_minute": round(self.agent_slots(category) * 60 / service, 3) if service else None,
+                "estimated_wait_seconds": round(estimate, 1) if estimate is not None else None
+            }
+        return categories
+
+wait_estimator = WaitTimeEstimator()
+
+class AgentMetrics:
+    """Per-agent ticket metrics rolled up into hourly and daily buckets.
+    
+    Assignments, first replies, resolutions and ratings are counted in the
+    hour and day they happened, so a report for any period sums at most two
+    days of hourly buckets plus whole days instead of rescanning tickets.
+    """
+    
+    FIELDS = ('handled', 'responded', 'response_seconds', 'resolved', 'resolution_seconds', 'rated', 'rating_total')
+    
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        self.hourly: Dict[int, Dict[str, List[float]]] = {}
+        self.daily: Dict[int, Dict[str, List[float]]] = {}
+    
+    def add(self, agent_id: str, timestamp: float, **values):
+        hour = int(timestamp // 3600)
+        for buckets, index in ((self.hourly, hour), (self.daily, hour // 24)):
+            row = buckets.setdefault(index, {}).setdefault(agent_id, [0] * len(self.FIELDS))
+            for name, value in values.items():
+                row[self.FIELDS.index(name)] += value
+    
+    def observe_update(self, ticket: Ticket, fields: Dict):
+        if ticket.assigned_agent is None:
+            return
+        if 'assigned_at' in fields and ticket.assigned_at is not None:
+            self.add(ticket.assigned_agent, ticket.assigned_at, handled=1)
+        if fields.get('status') == 'resolved' and ticket.closed_at is not None and ticket.assigned_at is not None:
+            self.add(ticket.assigned_agent, ticket.closed_at, resolved=1,
+                     resolution_seconds=ticket.closed_at - ticket.assigned_at)
+        if 'rating' in fields and ticket.rating is not None and ticket.rated_at is not None:
+            self.add(ticket.assigned_agent, ticket.rated_at, rated=1, rating_total=ticket.rating)
+    
+    def observe_first_response(self, ticket: Ticket):
+        # Only the agent's first reply counts towards response time
+        seconds = first_response_seconds(ticket)
+        if ticket.assigned_agent is not None and seconds is not None:
+            self.add(ticket.assigned_agent, ticket.first_response_at, responded=1, response_seconds=seconds)
+    
+    def rebuild(self, tickets):
+        self.reset()
+        for ticket in tickets:
+            if ticket.assigned_agent is None:
+                continue
+            self.observe_update(ticket, {'assigned_at': ticket.assigned_at, 'status': ticket.status, 'rating': ticket.rating})
+            self.observe_first_response(ticket)
+    
+    def totals(self, start: float, end: float) -> Dict[str, List[float]]:
+        totals: Dict[str, List[float]] = {}
+        
+        def merge(bucket: Optional[Dict[str, List[float]]]):
+            for agent_id, row in (bucket or {}).items():
+                total = totals.setdefault(agent_id, [0] * len(self.FIELDS))
+                for i, value in enumerate(row):
+                    total[i] += value
+        
+        # Partial hours at either edge are included whole
+        hour, end_hour = int(start // 3600), -int(-end // 3600)
+        while hour < end_hour and hour % 24:
+            merge(self.hourly.get(hour))
+            hour += 1
+        while hour + 24 <= end_hour:
+            merge(self.daily.get(hour // 24))
+            hour += 24
+        while hour < end_hour:
+            merge(self.hourly.get(hour))
+            hour += 1
+        return totals
+    
+    def report(self, start: float, end: float) -> List[Dict]:
+        totals = self.totals(start, end)
+        performance = []
+        for category, agents in agent_router.roster.items():
+            for agent in agents:
+                row = dict(zip(self.FIELDS, totals.get(agent['id'], [0] * len(self.FIELDS))))
+                performance.append({
+                    "agentId": agent['id'],
+                    "agentName": agent['name'],
+                    "ticketsHandled": row['handled'],
+                    "ticketsResolved": row['resolved'],
+                    "avgResponseTime": round(row['response_seconds'] / row['responded'] / 60, 1) if row['responded'] else None,  # minutes
+                    "avgResolutionTime": round(row['resolution_seconds'] / row['resolved'] / 3600, 2) if row['resolved'] else None,  # hours
+                    "customerRating": round(row['rating_total'] / row['rated'], 1) if row['rated'] else None,  # 1.0-5.0
+                    "resolutionRate": round(row['resolved'] * 100 / row['handled'], 1) if row['handled'] else None,  # %
+                    "category": category
+                })
+        return performance
+
+agent_metrics = AgentMetrics()
+
+async def assign_agent(ticket: Ticket) -> Optional[Dict]:
+    return agent_router.assign(ticket)
+
+async def connect_queued_ticket(ticket: Ticket, agent: Dict):
+    update_ticket(
+        ticket,
+        status='assigned',
+        assigned_agent=agent['id'],
+        agent_name=agent['name'],
+        assigned_at=time.time()
+    )
     
-    agents = available_agents.get(category, available_agents['general'])
-    return random.choice(agents)
+    await send_message(ticket.customer_id, f"""✅ *Connected to {ticket.department}*
 
-async def generate_agent_response(customer_message: str, ticket: Dict) -> str:
+👤 **Agent:** {agent['name']}
+🎫 **Ticket ID:** {ticket.id}
+
+{agent['name']} is now available and ready to help. Please describe your issue in detail.
+
+🔄 Type "end" to close this conversation
+📋 Type "summary" for ticket details""")
+
+async def close_ticket(ticket: Ticket, status: str):
+    """Closes an open ticket the agent never resolved and hands its slot or queue place on."""
+    update_ticket(ticket, status=status, closed_at=time.time())
+    spill_transcript(ticket, 0)
+    promoted = agent_router.release(ticket)
+    if promoted:
+        await connect_queued_ticket(*promoted)
+
+def ticket_last_activity(ticket: Ticket) -> float:
+    last = ticket.messages[-1].timestamp if ticket.messages else ticket.created_at
+    return max(last, ticket.assigned_at or 0)
+
+async def expire_idle_tickets(now: Optional[float] = None) -> int:
+    """Closes agent chats idle past AGENT_IDLE_TIMEOUT and waiting tickets whose
+    customer has been silent past SESSION_TTL, since their session (and with it
+    any way back to the ticket) is gone."""
+    now = time.time() if now is None else now
+    idle = []
+    for ticket in ticket_index.find_tickets(status=OPEN_TICKET_STATUSES):
+        timeout = AGENT_IDLE_TIMEOUT if ticket.status == 'assigned' else SESSION_TTL
+        if timeout and now - ticket_last_activity(ticket) > timeout:
+            idle.append((ticket, ticket.status))
+    # Drop abandoned waiting tickets before freed slots are handed to the queue
+    idle.sort(key=lambda entry: entry[1] == 'assigned')
+    expired = 0
+    for ticket, status in idle:
+        if ticket.status != status:
+            continue  # Connected to an agent freed earlier in this sweep
+        await close_ticket(ticket, 'expired')
+        expired += 1
+        if status == 'assigned':
+            await send_message(ticket.customer_id, f"""⌛ *Conversation Closed*
+
+🎫 Ticket {ticket.id} with {ticket.agent_name} was closed after {round(AGENT_IDLE_TIMEOUT / 60)} minutes without messages.
+
+Reply with 5 to connect with an agent again, or type "menu" to see all options.""")
+    return expired
+
+async def agent_ticket_sweeper():
+    while True:
+        await asyncio.sleep(AGENT_IDLE_SWEEP_INTERVAL)
+        try:
+            expired = await expire_idle_tickets()
+            if expired:
+                logger.info(f"Expired {expired} idle tickets")
+        except Exception as e:
+            logger.error(f"Idle ticket sweep failed: {e}")
+
+async def generate_agent_response(customer_message: str, ticket: Ticket) -> str:
     responses = {
         'account_issues': [
             "I can see you're having account issues. Let me check your account details right away.",
@@ -680,19 +2947,27 @@ async def generate_agent_response(customer_message: str, ticket: Dict) -> str:
         ]
     }
     
-    category_responses = responses.get(ticket['category'], responses['account_issues'])
+    category_responses = responses.get(ticket.category, responses['account_issues'])
     return random.choice(category_responses)
 
-async def end_agent_session(from_number: str, ticket: Dict) -> str:
-    session = user_sessions[from_number]
-    ticket['status'] = 'resolved'
-    ticket['closed_at'] = datetime.now().isoformat()
+async def end_agent_session(from_number: str, ticket: Ticket, session: UserSession) -> str:
+    update_ticket(ticket, status='resolved', closed_at=time.time())
     session.step = 'feedback_form'
+    # Resolved tickets keep no transcript in memory
+    spill_transcript(ticket, 0)
+    
+    if ticket.assigned_at is not None:
+        wait_estimator.observe(ticket.category, ticket.closed_at - ticket.assigned_at)
+    
+    # Hand the freed slot to the next queued ticket in the agent's category
+    promoted = agent_router.release(ticket)
+    if promoted:
+        await connect_queued_ticket(*promoted)
     
     return f"""✅ *Session Ended*
 
-🎫 **Ticket ID:** {ticket['id']}
-👤 **Agent:** {ticket['agent_name']}
+🎫 **Ticket ID:** {ticket.id}
+👤 **Agent:** {ticket.agent_name}
 ⏰ **Duration:** {calculate_session_duration(ticket)}
 📋 **Status:** Resolved
 
@@ -709,182 +2984,546 @@ Reply with a number or type "skip" to return to main menu.
 
 Thank you for contacting us today! 😊"""
 
-async def get_ticket_summary(ticket: Dict) -> str:
+async def get_ticket_summary(ticket: Ticket) -> str:
     latest_message = ""
-    if ticket['messages']:
-        latest_message = ticket['messages'][-1]['message'][:100] + "..."
+    latest = await latest_ticket_message(ticket)
+    if latest:
+        latest_message = latest.message[:100] + "..."
     
     return f"""📋 *Ticket Summary*
 
-🎫 **ID:** {ticket['id']}
-👤 **Agent:** {ticket.get('agent_name', 'Unassigned')}
-📅 **Created:** {format_date(ticket['created_at'])}
-📊 **Status:** {ticket['status'].upper()}
-🏷️ **Category:** {ticket['category'].replace('_', ' ').upper()}
-💬 **Messages:** {len(ticket.get('messages', []))}
+🎫 **ID:** {ticket.id}
+👤 **Agent:** {ticket.agent_name or 'Unassigned'}
+📅 **Created:** {format_date(ticket.created_at)}
+📊 **Status:** {ticket.status.upper()}
+🏷️ **Category:** {ticket.category.replace('_', ' ').upper()}
+💬 **Messages:** {ticket.message_count}
 
 **Latest Update:** {latest_message}
 
 Type anything to continue conversation or "end" to close."""
 
+# Conversation analytics
+def parse_duration(value: str) -> float:
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    value = value.strip().lower()
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+ISSUE_LABELS = {
+    'account_inquiry': 'Account Balance',
+    'contributions': 'Contribution Questions',
+    'complaint': 'Complaints',
+    'booking': 'Consultation Booking',
+    'agent_request': 'Agent Requests',
+    'general_inquiry': 'General Inquiry'
+}
+
+RATING_LABELS = {5: 'excellent', 4: 'good', 3: 'average', 2: 'poor', 1: 'veryPoor'}
+
+class RollingHistogram:
+    """Counts per key over a sliding time window.
+    
+    Counts land in fixed-width buckets and running totals for the whole
+    window are kept alongside; buckets that slide out are subtracted, so
+    reading the totals costs the same however much history has been seen.
+    """
+    
+    def __init__(self, window: float, buckets: int = ANALYTICS_WINDOW_BUCKETS):
+        self.window = window
+        self.bucket_count = buckets
+        self.width = window / buckets
+        self.buckets = deque()  # (bucket index, counts), oldest first
+        self.totals: Dict[Any, int] = {}
+    
+    def add(self, key, timestamp: float, amount: int = 1):
+        index = int(timestamp // self.width)
+        if self.buckets and index < self.buckets[-1][0]:
+            # Late sample: only kept if its bucket is still inside the window
+            if index <= self.buckets[-1][0] - self.bucket_count:
+                return
+            position = next(i for i, (bucket, _) in enumerate(self.buckets) if bucket >= index)
+            if self.buckets[position][0] != index:
+                self.buckets.insert(position, (index, {}))
+            counts = self.buckets[position][1]
+        else:
+            if not self.buckets or self.buckets[-1][0] != index:
+                # Drop what the new bucket pushes out, whether or not anyone reads the totals
+                self.expire(timestamp)
+                self.buckets.append((index, {}))
+            counts = self.buckets[-1][1]
+        counts[key] = counts.get(key, 0) + amount
+        self.totals[key] = self.totals.get(key, 0) + amount
+    
+    def expire(self, now: float):
+        oldest = int(now // self.width) - self.bucket_count + 1
+        while self.buckets and self.buckets[0][0] < oldest:
+            _, counts = self.buckets.popleft()
+            for key, amount in counts.items():
+                remaining = self.totals[key] - amount
+                if remaining:
+                    self.totals[key] = remaining
+                else:
+                    del self.totals[key]
+    
+    def counts(self, now: float) -> Dict[Any, int]:
+        self.expire(now)
+        return self.totals
+
+class ConversationAnalytics:
+    """Message type, hour-of-day and rating histograms for each rolling window.
+    
+    Interactions and feedback are folded in as they happen; the endpoint
+    only formats the current totals.
+    """
+    
+    def __init__(self, windows: str = ANALYTICS_WINDOWS, idle_timeout: float = ANALYTICS_CONVERSATION_IDLE):
+        self.windows = {name.strip(): RollingHistogram(parse_duration(name)) for name in windows.split(',') if name.strip()}
+        self.idle_timeout = idle_timeout
+        self.last_seen: OrderedDict = OrderedDict()  # user_id -> last interaction, least recent first
+    
+    def reset(self):
+        for name, histogram in self.windows.items():
+            self.windows[name] = RollingHistogram(histogram.window, histogram.bucket_count)
+        self.last_seen.clear()
+    
+    def add(self, key, timestamp: float):
+        for histogram in self.windows.values():
+            histogram.add(key, timestamp)
+    
+    def observe_interaction(self, interaction: Interaction):
+        timestamp = interaction.timestamp
+        previous = self.last_seen.pop(interaction.user_id, None)
+        if previous is None or timestamp - previous > self.idle_timeout:
+            self.add('conversations', timestamp)
+        self.last_seen[interaction.user_id] = timestamp
+        # Users idle past the timeout start a new conversation anyway
+        while self.last_seen:
+            user_id, seen = next(iter(self.last_seen.items()))
+            if timestamp - seen <= self.idle_timeout:
+                break
+            del self.last_seen[user_id]
+        
+        self.add('interactions', timestamp)
+        self.add(('type', interaction.message_type), timestamp)
+        self.add(('hour', time.localtime(timestamp).tm_hour), timestamp)
+    
+    def observe_rating(self, rating: int, timestamp: float):
+        self.add(('rating', rating), timestamp)
+    
+    def observe_ratings(self, tickets):
+        rated = [ticket for ticket in tickets if ticket.rating is not None and ticket.rated_at is not None]
+        for ticket in sorted(rated, key=lambda t: t.rated_at):
+            self.observe_rating(ticket.rating, ticket.rated_at)
+    
+    def state(self) -> Dict:
+        """Histogram buckets and open conversations, for the event log snapshot.
+        
+        Buckets are saved by their midpoint time so a restore re-buckets them
+        correctly even if the bucket width has been reconfigured since.
+        """
+        return {
+            'windows': {
+                name: [((index + 0.5) * histogram.width, list(counts.items())) for index, counts in histogram.buckets]
+                for name, histogram in self.windows.items()
+            },
+            'last_seen': list(self.last_seen.items())
+        }
+    
+    def restore(self, state: Dict):
+        self.reset()
+        for name, buckets in state['windows'].items():
+            histogram = self.windows.get(name)
+            if histogram is None:
+                continue  # Window no longer configured
+            for timestamp, counts in buckets:
+                for key, amount in counts:
+                    # JSON turns tuple keys into lists
+                    histogram.add(tuple(key) if isinstance(key, list) else key, timestamp, amount)
+        self.last_seen.update(state['last_seen'])
+    
+    def report(self, window: str, peak_hours: int = 4) -> Dict:
+        counts = self.windows[window].counts(time.time())
+        interactions = counts.get('interactions', 0)
+        conversations = counts.get('conversations', 0)
+        
+        # Ties are broken by name so the order does not depend on which keys expired and came back
+        issues = sorted(((key[1], count) for key, count in counts.items() if isinstance(key, tuple) and key[0] == 'type'),
+                        key=lambda item: (-item[1], item[0]))
+        hours = sorted(((key[1], count) for key, count in counts.items() if isinstance(key, tuple) and key[0] == 'hour'),
+                       key=lambda item: (-item[1], item[0]))[:peak_hours]
+        ratings = {rating: counts.get(('rating', rating), 0) for rating in RATING_LABELS}
+        responses = sum(ratings.values())
+        
+        return {
+            "window": window,
+            "totalConversations": conversations,
+            "totalInteractions": interactions,
+            "avgConversationLength": round(interactions / conversations, 1) if conversations else 0,  # messages
+            "commonIssues": [
+                {
+                    "issue": ISSUE_LABELS.get(message_type, message_type.replace('_', ' ').title()),
+                    "count": count,
+                    "percentage": f"{round(count * 100 / interactions)}%"
+                }
+                for message_type, count in issues
+            ],
+            "peakHours": [
+                {"hour": f"{hour:02d}:00", "interactions": count}
+                for hour, count in sorted(hours)
+            ],
+            "customerSatisfaction": {
+                "average": round(sum(rating * count for rating, count in ratings.items()) / responses, 1) if responses else None,
+                "responses": responses,
+                "distribution": {label: ratings[rating] for rating, label in RATING_LABELS.items()}
+            }
+        }
+
+conversation_analytics = ConversationAnalytics()
+
 # Power BI Data Collection Functions
-async def log_interaction(user_id: str, user_message: str, bot_response: str, conversation_step: str):
-    interaction = {
-        'timestamp': datetime.now().isoformat(),
-        'user_id': user_id,
-        'user_message': user_message,
-        'bot_response': bot_response[:200],  # Truncate for storage
-        'conversation_step': conversation_step,
-        'message_type': detect_message_type(user_message),
-        'response_time': random.randint(500, 2500),  # Simulated response time
-        'session_id': generate_session_id()
-    }
+def log_interaction(user_id: str, user_message: str, bot_response: str, conversation_step: str, response_time: int):
+    interaction = Interaction(
+        timestamp=time.time(),
+        user_id=user_id,
+        user_message=user_message,
+        bot_response=bot_response[:200],  # Truncate for storage
+        conversation_step=conversation_step,
+        message_type=detect_message_type(user_message),
+        response_time=response_time,  # ms from webhook receipt until the reply was sent
+        session_id=generate_session_id()
+    )
     
+    # Ring buffer overwrites the oldest entry once INTERACTION_LOG_CAPACITY is reached
     collections_data['customer_interactions'].append(interaction)
-    
-    # Keep only last 1000 interactions to manage memory
-    if len(collections_data['customer_interactions']) > 1000:
-        collections_data['customer_interactions'].pop(0)
+    conversation_analytics.observe_interaction(interaction)
+    record_event('interaction', asdict(interaction))
 
 def detect_message_type(message: str) -> str:
-    lower_message = message.lower()
-    if any(word in lower_message for word in ['balance', 'account']):
-        return 'account_inquiry'
-    if any(word in lower_message for word in ['complaint', 'problem']):
-        return 'complaint'
-    if any(word in lower_message for word in ['consultation', 'appointment']):
-        return 'booking'
-    if any(word in lower_message for word in ['contribution', 'payment']):
-        return 'contributions'
-    if any(word in lower_message for word in ['agent', 'human']):
-        return 'agent_request'
-    return 'general_inquiry'
+    return conversation_flow.classifier.classify('message_type', message.lower()) or 'general_inquiry'
 
 # Power BI API Endpoints
 @app.get("/api/powerbi/interactions")
-async def get_interactions():
-    return {
-        "data": collections_data['customer_interactions'],
+async def get_interactions(since: int = -1):
+    log = collections_data['customer_interactions']
+    interactions = log.since(since)
+    # Records are already JSON-ready, so skip FastAPI's jsonable_encoder pass
+    return APIResponse({
+        "data": [interaction.to_dict() for interaction in interactions],
         "lastUpdated": datetime.now().isoformat(),
-        "totalRecords": len(collections_data['customer_interactions'])
-    }
+        "totalRecords": len(interactions),
+        "nextCursor": log.next_seq - 1
+    })
 
 @app.get("/api/powerbi/tickets")
-async def get_tickets():
+async def get_tickets(limit: int = POWERBI_PAGE_SIZE, cursor: Optional[str] = None, since: Optional[str] = None):
+    limit = max(1, min(limit, POWERBI_MAX_PAGE_SIZE))
+    try:
+        start = int(cursor) if cursor else 0
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    since_timestamp = parse_timestamp(since)
+    ticket_ids, next_position = ticket_aggregates.page(start, limit, since_timestamp)
+    
     ticket_array = []
-    for ticket in agents_data['tickets'].values():
-        ticket_data = dict(ticket)
-        ticket_data['response_time_minutes'] = random.randint(5, 30) if ticket_data.get('messages') else None
-        ticket_data['resolution_time_hours'] = random.randint(1, 48) if ticket_data['status'] == 'resolved' else None
-        ticket_data['customer_satisfaction'] = random.randint(1, 5) if ticket_data['status'] == 'resolved' else None
+    for ticket_id in ticket_ids:
+        ticket = agents_data['tickets'][ticket_id]
+        response_seconds = first_response_seconds(ticket)
+        ticket_data = ticket.to_dict()
+        ticket_data['response_time_minutes'] = round(response_seconds / 60, 1) if response_seconds is not None else None
+        ticket_data['resolution_time_hours'] = (
+            round((ticket.closed_at - ticket.created_at) / 3600, 2)
+            if ticket.status == 'resolved' and ticket.closed_at is not None else None
+        )
+        ticket_data['customer_satisfaction'] = ticket.rating
         ticket_array.append(ticket_data)
     
-    return {
+    return APIResponse({
         "data": ticket_array,
-        "summary": {
-            "total": len(ticket_array),
-            "open": len([t for t in ticket_array if t['status'] == 'open']),
-            "resolved": len([t for t in ticket_array if t['status'] == 'resolved']),
-            "avgResolutionTime": 24  # hours
-        }
+        "summary": ticket_aggregates.summary(),
+        "nextCursor": str(next_position) if next_position is not None else None
+    })
+
+def parse_timestamp(value: Optional[str], name: str = 'since') -> Optional[float]:
+    # Accepts an ISO datetime (as served by the API) or epoch seconds
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid '{name}' value")
+
+# Streaming exports
+INTERACTION_EXPORT_FIELDS = [
+    'seq', 'timestamp', 'user_id', 'user_message', 'bot_response', 'conversation_step',
+    'message_type', 'response_time', 'session_id'
+]
+TICKET_EXPORT_FIELDS = [
+    'id', 'customer_id', 'customer_name', 'status', 'priority', 'created_at', 'initial_message',
+    'category', 'department', 'assigned_agent', 'agent_name', 'assigned_at', 'closed_at', 'rating',
+    'rated_at', 'messages'
+]
+
+def select_export_fields(fields: Optional[str], available: List[str]) -> List[str]:
+    if not fields:
+        return available
+    selected = [name.strip() for name in fields.split(',') if name.strip()]
+    unknown = [name for name in selected if name not in available]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return selected
+
+async def interaction_export_rows(since: Optional[float], until: Optional[float]):
+    for interaction in collections_data['customer_interactions'].between(since, until):
+        yield interaction.to_dict()
+
+async def ticket_export_rows(since: Optional[float], until: Optional[float], transcript: bool):
+    # A chunk of tickets at a time, so archived transcripts are read off the event loop in batches
+    ticket_ids = ticket_aggregates.between(since, until)
+    while batch := [agents_data['tickets'][ticket_id] for ticket_id in itertools.islice(ticket_ids, EXPORT_CHUNK_ROWS)]:
+        transcripts = await load_transcripts(batch) if transcript else {}
+        for ticket in batch:
+            yield ticket.to_dict(transcripts.get(ticket.id))
+
+async def stream_export(rows, fields: List[str], export_format: str, compress: bool):
+    """Encodes rows lazily as NDJSON or CSV, optionally gzipped, a chunk at a time."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if export_format == 'csv' else None
+    if writer:
+        writer.writerow(fields)
+    
+    def drain() -> bytes:
+        data = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
+    
+    pending = 0
+    async for row in rows:
+        if writer:
+            writer.writerow([
+                json_dumps(value) if isinstance(value, (list, dict)) else value
+                for value in (row.get(name) for name in fields)
+            ])
+        else:
+            buffer.write(json_dumps({name: row.get(name) for name in fields}))
+            buffer.write('\n')
+        pending += 1
+        if pending >= EXPORT_CHUNK_ROWS:
+            pending = 0
+            chunk = drain()
+            if chunk:
+                yield chunk
+            # Let other requests run between chunks
+            await asyncio.sleep(0)
+    
+    chunk = drain()
+    if compressor:
+        chunk += compressor.flush()
+    if chunk:
+        yield chunk
+
+def export_response(request: Request, rows, fields: List[str], export_format: str, name: str) -> StreamingResponse:
+    if export_format not in ('ndjson', 'csv'):
+        raise HTTPException(status_code=400, detail="format must be 'ndjson' or 'csv'")
+    compress = 'gzip' in request.headers.get('accept-encoding', '')
+    media_type = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    headers = {'Content-Disposition': f'attachment; filename="{name}.{export_format}"'}
+    if compress:
+        headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = 'Accept-Encoding'
+    return StreamingResponse(stream_export(rows, fields, export_format, compress), media_type=media_type, headers=headers)
+
+@app.get("/api/powerbi/interactions/export")
+async def export_interactions(request: Request, format: str = 'ndjson', since: Optional[str] = None,
+                              until: Optional[str] = None, fields: Optional[str] = None):
+    selected = select_export_fields(fields, INTERACTION_EXPORT_FIELDS)
+    rows = interaction_export_rows(parse_timestamp(since), parse_timestamp(until, 'until'))
+    return export_response(request, rows, selected, format, 'interactions')
+
+@app.get("/api/powerbi/tickets/export")
+async def export_tickets(request: Request, format: str = 'ndjson', since: Optional[str] = None,
+                         until: Optional[str] = None, fields: Optional[str] = None):
+    selected = select_export_fields(fields, TICKET_EXPORT_FIELDS)
+    # Archived transcripts are only read when the export includes messages
+    rows = ticket_export_rows(parse_timestamp(since), parse_timestamp(until, 'until'), 'messages' in selected)
+    return export_response(request, rows, selected, format, 'tickets')
+
+REPORT_PERIOD_PATTERN = re.compile(r'^last_(\d+)_(hours|days)$')
+
+# Ticket queries
+def query_values(value: Optional[str], aliases: Optional[Dict[str, tuple]] = None) -> Optional[List[str]]:
+    # Comma-separated filter values, with aliases such as status=open expanded
+    if not value:
+        return None
+    values = []
+    for item in value.split(','):
+        item = item.strip()
+        values.extend((aliases or {}).get(item, (item,)))
+    return values
+
+def query_response(records: List, limit: int) -> APIResponse:
+    limit = max(1, min(limit, POWERBI_MAX_PAGE_SIZE))
+    return APIResponse({
+        "data": [record.to_dict() for record in records[:limit]],
+        "total": len(records),
+        "limit": limit
+    })
+
+@app.get("/api/tickets")
+async def find_tickets(customer_id: Optional[str] = None, status: Optional[str] = None, agent: Optional[str] = None,
+                       category: Optional[str] = None, limit: int = POWERBI_PAGE_SIZE):
+    filters = {
+        'customer_id': query_values(customer_id),
+        'status': query_values(status, {'open': OPEN_TICKET_STATUSES}),
+        'assigned_agent': query_values(agent),
+        'category': query_values(category)
     }
+    filters = {name: values for name, values in filters.items() if values}
+    if not filters:
+        raise HTTPException(status_code=400, detail="Filter by at least one of customer_id, status, agent or category")
+    return query_response(ticket_index.find_tickets(**filters), limit)
+
+@app.get("/api/complaints")
+async def find_complaints(customer_id: Optional[str] = None, status: Optional[str] = None, limit: int = POWERBI_PAGE_SIZE):
+    filters = {'customer_id': query_values(customer_id), 'status': query_values(status)}
+    filters = {name: values for name, values in filters.items() if values}
+    if not filters:
+        raise HTTPException(status_code=400, detail="Filter by at least one of customer_id or status")
+    return query_response(ticket_index.find_complaints(**filters), limit)
 
 @app.get("/api/powerbi/agent-performance")
-async def get_agent_performance():
-    agent_performance = [
-        {
-            "agentId": "AG001",
-            "agentName": "Sarah Mitchell",
-            "ticketsHandled": random.randint(10, 60),
-            "avgResponseTime": random.randint(2, 7),  # minutes
-            "customerRating": round(random.uniform(3.0, 5.0), 1),  # 3.0-5.0
-            "resolutionRate": round(random.uniform(80, 100), 1),  # 80-100%
-            "category": "account_issues"
-        },
-        {
-            "agentId": "AG003",
-            "agentName": "Emma Johnson",
-            "ticketsHandled": random.randint(15, 60),
-            "avgResponseTime": random.randint(1, 5),
-            "customerRating": round(random.uniform(3.0, 5.0), 1),
-            "resolutionRate": round(random.uniform(85, 100), 1),
-            "category": "complaints"
-        }
-    ]
+async def get_agent_performance(reportPeriod: str = 'last_30_days', since: Optional[str] = None, until: Optional[str] = None):
+    end = parse_timestamp(until, 'until') or time.time()
+    start = parse_timestamp(since)
+    if start is not None:
+        reportPeriod = 'custom'
+    else:
+        match = REPORT_PERIOD_PATTERN.match(reportPeriod)
+        if not match:
+            raise HTTPException(status_code=400, detail="reportPeriod must look like 'last_30_days' or 'last_12_hours'")
+        start = end - int(match.group(1)) * (3600 if match.group(2) == 'hours' else 86400)
     
     return {
-        "data": agent_performance,
-        "reportPeriod": "last_30_days",
+        "data": agent_metrics.report(start, end),
+        "reportPeriod": reportPeriod,
+        "periodStart": to_iso(start),
+        "periodEnd": to_iso(end),
         "generatedAt": datetime.now().isoformat()
     }
 
 @app.get("/api/powerbi/conversation-analytics")
-async def get_conversation_analytics():
-    analytics = {
-        "totalConversations": len(collections_data['customer_interactions']),
-        "avgConversationLength": 8.5,  # messages
-        "commonIssues": [
-            {"issue": "Account Balance", "count": 45, "percentage": "32%"},
-            {"issue": "Contribution Questions", "count": 28, "percentage": "20%"},
-            {"issue": "Technical Support", "count": 21, "percentage": "15%"},
-            {"issue": "Complaints", "count": 18, "percentage": "13%"},
-            {"issue": "Pension Planning", "count": 15, "percentage": "11%"},
-            {"issue": "General Inquiry", "count": 13, "percentage": "9%"}
-        ],
-        "peakHours": [
-            {"hour": "09:00", "interactions": 25},
-            {"hour": "11:00", "interactions": 30},
-            {"hour": "14:00", "interactions": 35},
-            {"hour": "16:00", "interactions": 28}
-        ],
-        "customerSatisfaction": {
-            "average": 4.2,
-            "distribution": {
-                "excellent": 45,
-                "good": 32,
-                "average": 18,
-                "poor": 3,
-                "veryPoor": 2
-            }
-        }
-    }
-    
+async def get_conversation_analytics(window: str = ANALYTICS_DEFAULT_WINDOW):
+    if window not in conversation_analytics.windows:
+        raise HTTPException(status_code=400, detail=f"Unknown window, expected one of: {', '.join(conversation_analytics.windows)}")
+    analytics = conversation_analytics.report(window)
+    analytics["generatedAt"] = datetime.now().isoformat()
     return analytics
 
 # Utility functions
+CROCKFORD_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+
+class IdGenerator:
+    """Unique, time-ordered ids without any coordination between processes.
+    
+    Each id packs a 42-bit millisecond timestamp, an 8-bit node id, the
+    22-bit process id and an 8-bit per-millisecond sequence into 80 bits,
+    written as 16 Crockford base32 characters (no I, L, O or U). Ids sort by
+    creation time, the pid keeps workers on a node apart and ID_NODE_ID keeps
+    nodes apart. Without a node id, node and pid are replaced by 30 random
+    bits per process, since replicas often share pids (pid 1 in containers).
+    After 256 ids in one millisecond the generator moves on to the next
+    millisecond instead of waiting.
+    """
+    
+    EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+    # Two base32 characters per lookup
+    PAIRS = [a + b for a in CROCKFORD_ALPHABET for b in CROCKFORD_ALPHABET]
+    # Live generators, reset together by the one fork hook registered below
+    instances: 'weakref.WeakSet[IdGenerator]' = weakref.WeakSet()
+    
+    def __init__(self, node_id: Optional[int] = ID_NODE_ID):
+        if node_id is not None and not 0 <= node_id <= 0xFF:
+            raise ValueError("ID_NODE_ID must be between 0 and 255")
+        self.node_id = node_id
+        self.reset()
+        IdGenerator.instances.add(self)
+    
+    @classmethod
+    def reset_all(cls):
+        for generator in list(cls.instances):
+            generator.reset()
+    
+    def reset(self):
+        if self.node_id is None:
+            self.process_bits = secrets.randbits(30) << 8
+        else:
+            self.process_bits = (self.node_id << 22 | (os.getpid() & 0x3FFFFF)) << 8
+        self.last_ms = 0
+        self.sequence = 0
+    
+    def next_value(self) -> int:
+        now = time.time_ns() // 1000000 - self.EPOCH_MS
+        if now > self.last_ms:
+            self.last_ms = now
+            self.sequence = 0
+        else:
+            # Same millisecond, or the clock went back: keep counting from the last one
+            self.sequence += 1
+            if self.sequence > 0xFF:
+                self.last_ms += 1
+                self.sequence = 0
+        return self.last_ms << 38 | self.process_bits | self.sequence
+    
+    def generate(self, prefix: str) -> str:
+        value = self.next_value()
+        pairs = self.PAIRS
+        return (prefix + pairs[value >> 70 & 0x3FF] + pairs[value >> 60 & 0x3FF] + pairs[value >> 50 & 0x3FF]
+                + pairs[value >> 40 & 0x3FF] + pairs[value >> 30 & 0x3FF] + pairs[value >> 20 & 0x3FF]
+                + pairs[value >> 10 & 0x3FF] + pairs[value & 0x3FF])
+
+# Forked workers must not keep the parent's pid or sequence
+os.register_at_fork(after_in_child=IdGenerator.reset_all)
+
+id_generator = IdGenerator()
+
 def generate_ticket_id() -> str:
-    timestamp = str(int(datetime.now().timestamp()))[-6:]
-    random_part = ''.join(random.choices(string.ascii_uppercase, k=3))
-    return f"TK{timestamp}{random_part}"
+    return id_generator.generate('TK')
 
 def generate_complaint_id() -> str:
-    timestamp = str(int(datetime.now().timestamp()))[-6:]
-    random_part = ''.join(random.choices(string.ascii_uppercase, k=3))
-    return f"CP{timestamp}{random_part}"
+    return id_generator.generate('CP')
 
 def generate_session_id() -> str:
-    timestamp = str(int(datetime.now().timestamp()))
-    random_part = ''.join(random.choices(string.ascii_lowercase + string.digits, k=5))
-    return f"SS{timestamp}{random_part}"
+    return id_generator.generate('SS')
 
-def format_date(iso_string: str) -> str:
-    dt = datetime.fromisoformat(iso_string.replace('Z', '+00:00'))
-    return dt.strftime('%d/%m/%Y %H:%M')
+def format_date(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp).strftime('%d/%m/%Y %H:%M')
 
-def calculate_session_duration(ticket: Dict) -> str:
-    if 'closed_at' not in ticket:
+def calculate_session_duration(ticket: Ticket) -> str:
+    if ticket.closed_at is None:
         return 'Ongoing'
     
-    start = datetime.fromisoformat(ticket['created_at'])
-    end = datetime.fromisoformat(ticket['closed_at'])
-    duration = end - start
-    minutes = int(duration.total_seconds() / 60)
+    minutes = int((ticket.closed_at - ticket.created_at) / 60)
     return f"{minutes} minutes"
 
-async def get_queue_position(category: str) -> int:
-    return random.randint(1, 6)
+async def get_queue_position(ticket: Ticket) -> int:
+    return agent_router.queue_position(ticket.id)
 
 async def get_estimated_wait(category: str) -> str:
+    seconds = wait_estimator.estimate_seconds(category, agent_router.queue_depth(category))
+    if seconds is not None:
+        minutes = seconds / 60
+        if minutes < 1:
+            return 'Less than 1 minute'
+        return f"{max(1, int(minutes * 0.75))}-{int(minutes * 1.25) + 1} minutes"
+    
+    # No resolved tickets observed yet for this category
     wait_times = {
         'account_issues': '5-10 minutes',
         'complaints': '2-5 minutes',
@@ -896,12 +3535,15 @@ async def get_estimated_wait(category: str) -> str:
     return wait_times.get(category, '5-10 minutes')
 
 # Send message to WhatsApp
-async def send_message(to: str, message: str):
+async def send_message(to: str, message: str, on_sent: Optional[Callable[[float, bool], None]] = None):
+    # on_sent gets the monotonic time at which the reply was sent (or given up on) and whether it was sent
     if not WHATSAPP_TOKEN or not PHONE_NUMBER_ID:
         logger.warning("WhatsApp credentials not configured")
+        if on_sent is not None:
+            on_sent(time.monotonic(), False)
         return
     
-    url = f"https://graph.facebook.com/v18.0/{PHONE_NUMBER_ID}/messages"
+    url = f"{GRAPH_API_URL}/{PHONE_NUMBER_ID}/messages"
     
     payload = {
         "messaging_product": "whatsapp",
@@ -909,20 +3551,545 @@ async def send_message(to: str, message: str):
         "text": {"body": message}
     }
     
-    headers = {
-        "Authorization": f"Bearer {WHATSAPP_TOKEN}",
-        "Content-Type": "application/json"
+    headers = graph_api_headers()
+    
+    if http_client is not None and outbound_dispatcher.running:
+        # Returns once queued; the reply goes out after this recipient's earlier ones
+        await outbound_dispatcher.submit(to, url, payload, headers, on_sent)
+        return
+    
+    if http_client is None:
+        # Startup has not run (e.g. handler called directly); fall back to a one-off client
+        async with create_http_client() as client:
+            outcome, _ = await post_message(client, url, payload, headers, to)
+    else:
+        outcome, _ = await post_message(http_client, url, payload, headers, to)
+    if on_sent is not None:
+        on_sent(time.monotonic(), outcome == 'sent')
+
+def graph_api_headers() -> Dict:
+    return {
+        "Authorization": f"Bearer {WHATSAPP_TOKEN}"
     }
+
+async def post_message(client: httpx.AsyncClient, url: str, payload: Dict, headers: Dict, to: str) -> tuple:
+    """Makes one send attempt and returns (outcome, retry_after).
     
+    outcome is 'sent', 'throttled' (429), 'unavailable' (timeout, transport
+    error or 5xx; worth retrying) or 'failed' (rejected, not worth retrying).
+    """
+    http_stats["requests"] += 1
+    http_stats["in_flight"] += 1
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, json=payload, headers=headers)
-            response.raise_for_status()
-            logger.info(f"Message sent successfully to {to}")
+        response = await client.post(url, json=payload, headers=headers)
+        if response.status_code == 429 or response.status_code >= 500:
+            http_stats["errors"] += 1
+            logger.warning(f"Graph API returned {response.status_code} sending to {to}")
+            outcome = 'throttled' if response.status_code == 429 else 'unavailable'
+            return outcome, parse_retry_after(response.headers.get('retry-after'))
+        response.raise_for_status()
+        logger.info(f"Message sent successfully to {to}")
+        return 'sent', None
+    except (httpx.TimeoutException, httpx.TransportError) as e:
+        http_stats["errors"] += 1
+        logger.error(f"Error sending WhatsApp message: {e!r}")
+        return 'unavailable', None
     except httpx.HTTPError as e:
+        http_stats["errors"] += 1
         logger.error(f"Error sending WhatsApp message: {e}")
+        return 'failed', None
     except Exception as e:
+        http_stats["errors"] += 1
         logger.error(f"Unexpected error sending message: {e}")
+        return 'failed', None
+    finally:
+        http_stats["in_flight"] -= 1
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    # Retry-After is either delta seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def retry_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    # Full jitter keeps retries from many senders from arriving in lockstep
+    delay = random.uniform(0, min(SEND_RETRY_MAX_DELAY, SEND_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+    return max(delay, retry_after or 0.0)
+
+async def wait_event(event: asyncio.Event, timeout: Optional[float]) -> bool:
+    # asyncio.wait_for on 3.11 can swallow a cancel that lands as the event is
+    # set, which left background loops running through shutdown
+    try:
+        async with asyncio.timeout(timeout):
+            await event.wait()
+        return True
+    except TimeoutError:
+        return False
+
+class CircuitBreaker:
+    """Stops sends after repeated Graph API failures.
+    
+    closed: sends flow. open: sends are refused until reset_timeout passes.
+    half_open: one probe is let through; success closes the breaker, failure
+    opens it again.
+    """
+    
+    STATES = ('closed', 'half_open', 'open')
+    
+    def __init__(self, threshold: int = SEND_BREAKER_THRESHOLD, reset_timeout: float = SEND_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.closed = asyncio.Event()
+        self.closed.set()
+        self.stats = {"opened": 0}
+    
+    def probe_due(self) -> bool:
+        return self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout
+    
+    def allow(self) -> bool:
+        if self.state == 'closed':
+            return True
+        if self.probe_due():
+            self.state = 'half_open'
+        if self.state == 'half_open' and not self.probing:
+            self.probing = True
+            return True
+        return False
+    
+    def record_success(self):
+        self.failures = 0
+        self.probing = False
+        if self.state != 'closed':
+            logger.info("Graph API recovered, closing send circuit breaker")
+            self.state = 'closed'
+            self.closed.set()
+    
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.threshold):
+            if self.state == 'closed':
+                logger.warning(f"Opening send circuit breaker after {self.failures} consecutive failures")
+                self.stats["opened"] += 1
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+            self.closed.clear()
+
+send_breaker = CircuitBreaker()
+
+class DeadLetterQueue:
+    """Undeliverable replies, one JSON object per line, kept until Graph API recovers.
+    
+    A replay moves the file aside, resubmits its entries and deletes the moved
+    file once all of them have been sent, dead-lettered again or put back. A file left
+    behind by a crash mid-replay is merged back on open, so entries are
+    delivered at least once. Each worker keeps its own file, so one never
+    picks up a replay another is still delivering.
+    """
+    
+    def __init__(self, path: str = DEAD_LETTER_FILE):
+        self.path = path
+        self.replay_path = path + '.replay'
+        self.depth = 0
+        self.stats = {
+            "dead_lettered": 0,
+            "replayed": 0
+        }
+    
+    def open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        if os.path.exists(self.replay_path):
+            with open(self.replay_path, 'rb') as source, open(self.path, 'ab') as target:
+                target.write(source.read())
+            os.remove(self.replay_path)
+        self.depth = len(self.read(self.path))
+    
+    def read(self, path: str) -> List[Dict]:
+        entries = []
+        if not os.path.exists(path):
+            return entries
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # Torn final line from a crash mid-write
+                    continue
+        return entries
+    
+    def append(self, entry: Dict):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, separators=(',', ':'), ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.depth += 1
+        self.stats["dead_lettered"] += 1
+    
+    def take(self) -> List[Dict]:
+        if os.path.exists(self.replay_path):
+            return []  # The previous replay is still being delivered
+        if not os.path.exists(self.path):
+            self.depth = 0
+            return []
+        os.replace(self.path, self.replay_path)
+        self.depth = 0
+        return self.read(self.replay_path)
+    
+    def put_back(self, entries: List[Dict]):
+        # Entries a replay did not get to, e.g. because its probe failed
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps(entry, separators=(',', ':'), ensure_ascii=False) + '\n' for entry in entries)
+            f.flush()
+            os.fsync(f.fileno())
+        self.depth += len(entries)
+    
+    def finish_replay(self):
+        if os.path.exists(self.replay_path):
+            os.remove(self.replay_path)
+
+# Replaced on startup by this worker's own file
+dead_letters = DeadLetterQueue()
+
+async def replay_dead_letters(entries: List[Dict]):
+    # Returns once every entry has been sent or dead-lettered again
+    remaining = len(entries)
+    finished = asyncio.Event()
+    
+    def on_sent(sent_at: float, sent: bool):
+        nonlocal remaining
+        if sent:
+            dead_letters.stats["replayed"] += 1
+        remaining -= 1
+        if not remaining:
+            finished.set()
+    
+    for entry in entries:
+        await outbound_dispatcher.submit(entry['to'], entry['url'], entry['payload'], graph_api_headers(), on_sent)
+    await finished.wait()
+
+async def dead_letter_replayer():
+    # Replays when the breaker closes, or sends one entry as its probe once the reset timeout has passed
+    while True:
+        await wait_event(send_breaker.closed, send_breaker.reset_timeout)
+        if not dead_letters.depth or not (send_breaker.state == 'closed' or send_breaker.probe_due()):
+            await asyncio.sleep(1)
+            continue
+        probing = send_breaker.state != 'closed'
+        try:
+            entries = await asyncio.to_thread(dead_letters.take)
+        except OSError as e:
+            logger.error(f"Could not read dead letters: {e}")
+            await asyncio.sleep(send_breaker.reset_timeout)
+            continue
+        if not entries:
+            await asyncio.sleep(1)
+            continue
+        if probing:
+            await replay_dead_letters(entries[:1])
+            entries = entries[1:]
+            if entries and send_breaker.state != 'closed':
+                # The probe failed (it is dead-lettered again); the rest waits for the next one
+                try:
+                    await asyncio.to_thread(dead_letters.put_back, entries)
+                except OSError as e:
+                    # Left in the replay file, which is merged back on the next start
+                    logger.error(f"Could not put back dead letters: {e}")
+                    continue
+                entries = []
+        if entries:
+            logger.info(f"Replaying {len(entries)} dead-lettered replies")
+            await replay_dead_letters(entries)
+        await asyncio.to_thread(dead_letters.finish_replay)
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+    
+    def delay(self, now: float) -> float:
+        # Seconds until a token is available; 0 means send now
+        if self.rate <= 0:
+            return 0.0
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    
+    def take(self):
+        if self.rate > 0:
+            self.tokens -= 1
+    
+    def full(self, now: float) -> bool:
+        return self.rate <= 0 or self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+class OutboundDispatcher:
+    """Schedules Graph API sends under global and per-recipient rate limits.
+    
+    Replies wait in a FIFO per recipient and only one message per recipient
+    is in flight, so a customer's replies arrive in order. Recipients with
+    work sit in a heap keyed by when their bucket next has a token; the
+    scheduler starts sends from it while the global bucket and the
+    concurrency limit allow.
+    """
+    
+    def __init__(self, rate: float = OUTBOUND_RATE, burst: int = OUTBOUND_BURST,
+                 recipient_rate: float = OUTBOUND_RECIPIENT_RATE, recipient_burst: int = OUTBOUND_RECIPIENT_BURST,
+                 concurrency: int = OUTBOUND_CONCURRENCY, max_pending: int = OUTBOUND_QUEUE_MAX_SIZE):
+        self.bucket = TokenBucket(rate, burst)
+        self.recipient_rate = recipient_rate
+        self.recipient_burst = recipient_burst
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.pending: Dict[str, deque] = {}  # recipient -> queued (url, payload, headers, on_sent, attempts)
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.ready: List[tuple] = []  # heap of (ready_at, order, recipient)
+        self.order = itertools.count()
+        self.depth = 0
+        self.in_flight = 0
+        self.running = False
+        self.wakeup = asyncio.Event()
+        self.room = asyncio.Event()
+        self.slots = asyncio.Semaphore(concurrency)
+        self.sends = set()
+        self.stats = {
+            "submitted": 0,
+            "sent": 0,
+            "failed": 0,
+            "retries": 0,
+            "dead_lettered": 0,
+            "throttled": 0,
+            "max_depth": 0
+        }
+    
+    async def submit(self, to: str, url: str, payload: Dict, headers: Dict,
+                     on_sent: Optional[Callable[[float, bool], None]] = None):
+        while self.depth >= self.max_pending:
+            # Back-pressure: the caller waits for room instead of dropping the reply
+            await self.room.wait()
+        queue = self.pending.get(to)
+        if queue is None:
+            queue = self.pending[to] = deque()
+            heapq.heappush(self.ready, (time.monotonic(), next(self.order), to))
+            self.wakeup.set()
+        queue.append((url, payload, headers, on_sent, 0))
+        self.depth += 1
+        self.stats["submitted"] += 1
+        self.stats["max_depth"] = max(self.stats["max_depth"], self.depth)
+    
+    def start(self) -> asyncio.Task:
+        # Marked running straight away so replies sent before the task first runs are queued too
+        self.running = True
+        return asyncio.create_task(self.run())
+    
+    async def run(self):
+        try:
+            while True:
+                await self.slots.acquire()
+                to = await self.next_recipient()
+                item = self.pending[to].popleft()
+                self.in_flight += 1
+                task = asyncio.create_task(self.deliver(to, *item))
+                self.sends.add(task)
+                task.add_done_callback(self.sends.discard)
+        finally:
+            self.running = False
+    
+    async def next_recipient(self) -> str:
+        while True:
+            now = time.monotonic()
+            wait = None
+            if self.ready:
+                ready_at, _, to = self.ready[0]
+                wait = max(ready_at - now, self.bucket.delay(now))
+                if wait <= 0:
+                    heapq.heappop(self.ready)
+                    recipient_wait = self.recipient_bucket(to).delay(now)
+                    if recipient_wait > 0:
+                        # Recipient is over its own limit; requeue it for when it has a token
+                        self.stats["throttled"] += 1
+                        heapq.heappush(self.ready, (now + recipient_wait, next(self.order), to))
+                        continue
+                    self.bucket.take()
+                    self.buckets[to].take()
+                    return to
+            else:
+                self.prune_buckets(now)
+            self.wakeup.clear()
+            await wait_event(self.wakeup, wait)
+    
+    def recipient_bucket(self, to: str) -> TokenBucket:
+        bucket = self.buckets.get(to)
+        if bucket is None:
+            bucket = self.buckets[to] = TokenBucket(self.recipient_rate, self.recipient_burst)
+        return bucket
+    
+    def prune_buckets(self, now: float):
+        # Forget recipients that are idle and back to a full bucket
+        for to in [to for to, bucket in self.buckets.items() if to not in self.pending and bucket.full(now)]:
+            del self.buckets[to]
+    
+    async def deliver(self, to: str, url: str, payload: Dict, headers: Dict,
+                      on_sent: Optional[Callable[[float, bool], None]], attempts: int):
+        retry_in = None
+        sent = False
+        try:
+            if not send_breaker.allow():
+                await self.dead_letter(to, url, payload, attempts, 'circuit open')
+                return
+            outcome, retry_after = await post_message(http_client, url, payload, headers, to)
+            if outcome == 'unavailable':
+                send_breaker.record_failure()
+            else:
+                # Any answer from Graph API, even a rejection, means it is reachable
+                send_breaker.record_success()
+            
+            if outcome == 'sent':
+                sent = True
+                self.stats["sent"] += 1
+            elif outcome == 'failed':
+                self.stats["failed"] += 1
+            elif attempts + 1 > SEND_RETRY_ATTEMPTS:
+                await self.dead_letter(to, url, payload, attempts + 1, outcome)
+            else:
+                attempts += 1
+                retry_in = retry_delay(attempts, retry_after)
+                self.stats["retries"] += 1
+        finally:
+            self.in_flight -= 1
+            self.slots.release()
+            if retry_in is not None:
+                # Back at the head of the recipient's queue so later replies keep waiting behind it
+                self.pending[to].appendleft((url, payload, headers, on_sent, attempts))
+                heapq.heappush(self.ready, (time.monotonic() + retry_in, next(self.order), to))
+                self.wakeup.set()
+                return
+            self.depth -= 1
+            self.room.set()
+            self.room.clear()
+            if self.pending[to]:
+                heapq.heappush(self.ready, (time.monotonic(), next(self.order), to))
+                self.wakeup.set()
+            else:
+                del self.pending[to]
+            if on_sent is not None:
+                try:
+                    on_sent(time.monotonic(), sent)
+                except Exception as e:
+                    logger.exception(f"Post-send callback for {to} failed: {e}")
+    
+    async def dead_letter(self, to: str, url: str, payload: Dict, attempts: int, reason: str):
+        # Headers are not stored so the access token never lands on disk
+        self.stats["dead_lettered"] += 1
+        entry = {
+            'to': to,
+            'url': url,
+            'payload': payload,
+            'attempts': attempts,
+            'reason': reason,
+            'failed_at': time.time()
+        }
+        try:
+            await asyncio.to_thread(dead_letters.append, entry)
+        except OSError as e:
+            logger.error(f"Could not dead-letter reply to {to}: {e}")
+    
+    async def dead_letter_pending(self):
+        # Used on shutdown so queued and retrying replies survive a restart
+        for to, queue in self.pending.items():
+            for url, payload, _, on_sent, attempts in queue:
+                await self.dead_letter(to, url, payload, attempts, 'shutdown')
+                if on_sent is not None:
+                    # As in deliver(), so latency and the interaction log still see the reply
+                    try:
+                        on_sent(time.monotonic(), False)
+                    except Exception as e:
+                        logger.exception(f"Post-send callback for {to} failed: {e}")
+            self.depth -= len(queue)
+            queue.clear()
+    
+    async def drain(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while self.running and self.depth and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        return not self.depth
+    
+    def get_stats(self) -> Dict:
+        stats = dict(self.stats)
+        stats["depth"] = self.depth
+        stats["in_flight"] = self.in_flight
+        stats["recipients"] = len(self.pending)
+        stats["rate"] = self.bucket.rate
+        stats["recipient_rate"] = self.recipient_rate
+        stats["concurrency"] = self.concurrency
+        return stats
+
+outbound_dispatcher = OutboundDispatcher()
+
+# Internal metrics
+@app.get("/internal/metrics/queues")
+async def get_queue_metrics():
+    return {
+        "categories": wait_estimator.metrics(),
+        "ewmaAlpha": wait_estimator.alpha,
+        "generatedAt": datetime.now().isoformat()
+    }
+
+@app.get("/metrics")
+async def get_prometheus_metrics():
+    lines = latency_metrics.render('pensionbot_message_latency_seconds')
+    lines += [
+        "# HELP pensionbot_messages_total Webhook messages by outcome.",
+        "# TYPE pensionbot_messages_total counter"
+    ]
+    for outcome in ('enqueued', 'processed', 'failed', 'rejected', 'dropped', 'duplicates'):
+        lines.append(f'pensionbot_messages_total{{outcome="{outcome}"}} {queue_stats[outcome]}')
+    lines += [
+        "# HELP pensionbot_status_updates_total Delivery status webhooks acknowledged without parsing.",
+        "# TYPE pensionbot_status_updates_total counter",
+        f"pensionbot_status_updates_total {queue_stats['status_updates']}",
+        "# HELP pensionbot_queue_depth Messages waiting for a worker.",
+        "# TYPE pensionbot_queue_depth gauge",
+        f"pensionbot_queue_depth {get_queue_depth()}",
+        "# HELP pensionbot_outbound_requests_total Graph API requests by result.",
+        "# TYPE pensionbot_outbound_requests_total counter",
+        f'pensionbot_outbound_requests_total{{result="ok"}} {http_stats["requests"] - http_stats["errors"]}',
+        f'pensionbot_outbound_requests_total{{result="error"}} {http_stats["errors"]}',
+        "# HELP pensionbot_outbound_queue_depth Replies waiting for a send slot or rate limit token.",
+        "# TYPE pensionbot_outbound_queue_depth gauge",
+        f"pensionbot_outbound_queue_depth {outbound_dispatcher.depth}",
+        "# HELP pensionbot_outbound_throttled_total Times a recipient was held back by its own rate limit.",
+        "# TYPE pensionbot_outbound_throttled_total counter",
+        f'pensionbot_outbound_throttled_total {outbound_dispatcher.stats["throttled"]}',
+        "# HELP pensionbot_outbound_retries_total Send attempts retried after a timeout, 5xx or 429.",
+        "# TYPE pensionbot_outbound_retries_total counter",
+        f'pensionbot_outbound_retries_total {outbound_dispatcher.stats["retries"]}',
+        "# HELP pensionbot_send_breaker_state Send circuit breaker state (0 closed, 1 half open, 2 open).",
+        "# TYPE pensionbot_send_breaker_state gauge",
+        f"pensionbot_send_breaker_state {CircuitBreaker.STATES.index(send_breaker.state)}",
+        "# HELP pensionbot_send_breaker_opened_total Times the send circuit breaker opened.",
+        "# TYPE pensionbot_send_breaker_opened_total counter",
+        f'pensionbot_send_breaker_opened_total {send_breaker.stats["opened"]}',
+        "# HELP pensionbot_dead_letter_depth Replies waiting in the dead-letter file.",
+        "# TYPE pensionbot_dead_letter_depth gauge",
+        f"pensionbot_dead_letter_depth {dead_letters.depth}",
+        "# HELP pensionbot_dead_letters_total Replies dead-lettered and replayed.",
+        "# TYPE pensionbot_dead_letters_total counter",
+        f'pensionbot_dead_letters_total{{action="dead_lettered"}} {dead_letters.stats["dead_lettered"]}',
+        f'pensionbot_dead_letters_total{{action="replayed"}} {dead_letters.stats["replayed"]}'
+    ]
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
 
 # Health check endpoint
 @app.get("/")
@@ -936,9 +4103,18 @@ async def detailed_health():
         "service": "WhatsApp Pension Bot",
         "version": "6.0",
         "timestamp": datetime.now().isoformat(),
-        "active_sessions": len(user_sessions),
+        "active_sessions": await session_store.count(),
+        "session_store": SESSION_STORE,
+        "session_evictions": session_store.stats,
         "total_tickets": len(agents_data['tickets']),
-        "total_interactions": len(collections_data['customer_interactions'])
+        "total_interactions": len(collections_data['customer_interactions']),
+        "http_pool": get_pool_stats(),
+        "message_queue": get_queue_stats(),
+        "outbound": outbound_dispatcher.get_stats(),
+        "send_breaker": send_breaker.state,
+        "dead_letters": {"depth": dead_letters.depth, **dead_letters.stats},
+        "event_log": get_event_log_stats(),
+        "transcript_archive": get_transcript_archive_stats()
     }
 
 if __name__ == "__main__":
@@ -0,0 +1,17 @@
+import os
+import sys
+import shutil
+import tempfile
+
+# The bot is a single module at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Configuration is read on import, so point the data directory somewhere
+# disposable and leave the Graph API credentials unset before any test imports it
+DATA_DIR = tempfile.mkdtemp(prefix='pensionbot-test-')
+os.environ['EVENT_LOG_DIR'] = DATA_DIR
+os.environ['WHATSAPP_TOKEN'] = ''
+os.environ['PHONE_NUMBER_ID'] = ''
+
+def pytest_unconfigure(config):
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
@@ -0,0 +1,126 @@
+import asyncio
+import itertools
+import time
+
+import pytest
+
+import python_whatsapp_pension_bot as bot
+
+numbers = itertools.count(27820000000)
+
+@pytest.fixture(autouse=True)
+def router(monkeypatch):
+    # Every test starts with no open tickets and all agents free; replies are kept per recipient
+    for ticket in bot.ticket_index.find_tickets(status=bot.OPEN_TICKET_STATUSES):
+        bot.update_ticket(ticket, status='resolved', closed_at=time.time())
+    bot.agent_router.reset()
+    sent = {}
+    async def send_message(to, message, on_sent=None):
+        sent.setdefault(to, []).append(message)
+    monkeypatch.setattr(bot, 'send_message', send_message)
+    return sent
+
+def say(number, text):
+    asyncio.run(bot.handle_message({'from': number, 'text': {'body': text}}, {'profile': {'name': 'Test'}}))
+
+def session(number):
+    return asyncio.run(bot.session_store.load(number))
+
+def request_general_agent():
+    number = str(next(numbers))
+    say(number, 'hi')
+    say(number, '5')
+    say(number, '6')
+    return number, bot.agents_data['tickets'][session(number).ticket_id]
+
+def fill_general_agent():
+    return [request_general_agent() for _ in range(bot.AGENT_CAPACITY)]
+
+@pytest.mark.parametrize('command', bot.QUEUE_EXIT_COMMANDS)
+def test_queued_customer_can_leave(router, command):
+    fill_general_agent()
+    number, ticket = request_general_agent()
+    assert ticket.status == 'queued'
+    
+    say(number, command)
+    assert ticket.status == 'cancelled'
+    assert ticket.closed_at is not None
+    assert session(number).step == 'main_menu'
+    assert session(number).ticket_id is None
+    assert 'Request Cancelled' in router[number][-1]
+    assert bot.agent_router.queue_depth('general') == 0
+
+def test_queued_details_are_kept_for_the_agent():
+    fill_general_agent()
+    number, ticket = request_general_agent()
+    say(number, 'my statement shows the wrong employer')
+    assert ticket.status == 'queued'
+    assert ticket.messages[-1].message == 'my statement shows the wrong employer'
+
+def test_cancel_before_choosing_a_team():
+    number = str(next(numbers))
+    say(number, 'hi')
+    say(number, '5')
+    ticket = bot.agents_data['tickets'][session(number).ticket_id]
+    say(number, 'cancel')
+    assert ticket.status == 'cancelled'
+    assert session(number).step == 'main_menu'
+
+def test_idle_chat_expires_and_promotes_the_queue(router):
+    (idle_number, idle), *_ = fill_general_agent()
+    waiting_number, waiting = request_general_agent()
+    assert waiting.status == 'queued'
+    
+    expired = asyncio.run(bot.expire_idle_tickets(time.time() + bot.AGENT_IDLE_TIMEOUT + 1))
+    # The other chats went idle too, but the promoted ticket has only just been assigned
+    assert expired == bot.AGENT_CAPACITY
+    assert idle.status == 'expired'
+    assert 'Conversation Closed' in router[idle_number][-1]
+    assert waiting.status == 'assigned'
+    assert 'Connected to' in router[waiting_number][-1]
+    
+    # The customer's next message finds the chat closed
+    say(idle_number, 'hello?')
+    assert session(idle_number).step == 'main_menu'
+    assert "couldn't resume" in router[idle_number][-1]
+
+def test_active_chat_is_kept():
+    number, ticket = request_general_agent()
+    say(number, 'still here')
+    assert asyncio.run(bot.expire_idle_tickets(time.time() + bot.AGENT_IDLE_TIMEOUT / 2)) == 0
+    assert ticket.status == 'assigned'
+
+def test_waiting_ticket_expires_with_the_session(router, monkeypatch):
+    # Keep the agents busy throughout
+    monkeypatch.setattr(bot, 'AGENT_IDLE_TIMEOUT', 0)
+    fill_general_agent()
+    number, ticket = request_general_agent()
+    
+    # Waiting customers are quiet by design, so the chat timeout does not apply
+    assert asyncio.run(bot.expire_idle_tickets(time.time() + 1801)) == 0
+    assert ticket.status == 'queued'
+    
+    assert asyncio.run(bot.expire_idle_tickets(time.time() + bot.SESSION_TTL + 1)) == 1
+    assert ticket.status == 'expired'
+    assert bot.agent_router.queue_depth('general') == 0
+    # Abandoned tickets are closed without messaging the customer
+    assert 'Conversation Closed' not in router[number][-1]
+
+def test_queue_position_follows_cancellations():
+    fill_general_agent()
+    waiting = [request_general_agent() for _ in range(3)]
+    assert [bot.agent_router.queue_position(ticket.id) for _, ticket in waiting] == [1, 2, 3]
+    
+    say(waiting[1][0], 'cancel')
+    assert bot.agent_router.queue_position(waiting[1][1].id) == 0
+    assert [bot.agent_router.queue_position(ticket.id) for _, ticket in (waiting[0], waiting[2])] == [1, 2]
+
+def test_urgent_tickets_wait_ahead():
+    fill_general_agent()
+    _, normal = request_general_agent()
+    urgent = bot.Ticket(id=bot.generate_ticket_id(), customer_id='27830000002', customer_name='Test',
+                        initial_message='help', created_at=time.time(), priority='urgent', status='queued')
+    bot.store_ticket(urgent)
+    bot.agent_router.enqueue(urgent)
+    assert bot.agent_router.queue_position(urgent.id) == 1
+    assert bot.agent_router.queue_position(normal.id) == 2
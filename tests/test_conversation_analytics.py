@@ -0,0 +1,134 @@
+import json
+import random
+import time
+from collections import Counter
+
+import pytest
+
+import python_whatsapp_pension_bot as bot
+
+DAY = 86400
+MESSAGE_TYPES = ['account_inquiry', 'contributions', 'complaint', 'booking', 'agent_request', 'general_inquiry']
+
+def interaction_stream(count, start, span, users=200, seed=7):
+    """Synthetic interactions spread uniformly over [start, start + span), in time order."""
+    rng = random.Random(seed)
+    timestamps = sorted(start + rng.random() * span for _ in range(count))
+    return [
+        bot.Interaction(
+            timestamp=timestamp,
+            user_id=f'user-{rng.randrange(users)}',
+            user_message='hi',
+            bot_response='hello',
+            conversation_step='main_menu',
+            message_type=rng.choice(MESSAGE_TYPES),
+            response_time=rng.randrange(10, 500),
+            session_id=f'session-{i}'
+        )
+        for i, timestamp in enumerate(timestamps)
+    ]
+
+def expected_counts(interactions, histogram, now, idle_timeout):
+    # Recounts the stream from scratch over the buckets a window covers
+    oldest = int(now // histogram.width) - histogram.bucket_count + 1
+    counts = Counter()
+    last_seen = {}
+    for interaction in interactions:
+        previous = last_seen.get(interaction.user_id)
+        last_seen[interaction.user_id] = interaction.timestamp
+        if int(interaction.timestamp // histogram.width) < oldest:
+            continue
+        if previous is None or interaction.timestamp - previous > idle_timeout:
+            counts['conversations'] += 1
+        counts['interactions'] += 1
+        counts[('type', interaction.message_type)] += 1
+        counts[('hour', time.localtime(interaction.timestamp).tm_hour)] += 1
+    return dict(counts)
+
+@pytest.fixture
+def now():
+    return time.time()
+
+@pytest.fixture
+def analytics():
+    return bot.ConversationAnalytics('1h,24h,7d', idle_timeout=1800)
+
+@pytest.mark.parametrize('count,span', [(0, DAY), (1, DAY), (5000, 3 * DAY), (20000, 10 * DAY)])
+def test_windows_match_a_full_recount(analytics, now, count, span):
+    interactions = interaction_stream(count, now - span, span)
+    for interaction in interactions:
+        analytics.observe_interaction(interaction)
+    for histogram in analytics.windows.values():
+        assert histogram.counts(now) == expected_counts(interactions, histogram, now, analytics.idle_timeout)
+
+def test_idle_gap_starts_a_new_conversation(analytics, now):
+    for offset in (0, 60, 120, 120 + 1801, 120 + 1801 + 30):
+        analytics.observe_interaction(interaction_stream(1, now - 3600 + offset, 0, users=1)[0])
+    report = analytics.report('24h')
+    assert report['totalConversations'] == 2
+    assert report['totalInteractions'] == 5
+    assert report['avgConversationLength'] == 2.5
+
+def test_old_samples_leave_the_window(analytics, now):
+    for interaction in interaction_stream(100, now - 2 * DAY, 3600):
+        analytics.observe_interaction(interaction)
+    assert analytics.report('24h')['totalInteractions'] == 0
+    assert analytics.report('7d')['totalInteractions'] == 100
+
+def test_report_percentages_and_ratings(analytics, now):
+    interactions = interaction_stream(1000, now - 3000, 1800)
+    for interaction in interactions:
+        analytics.observe_interaction(interaction)
+    for rating, count in ((5, 3), (4, 1), (1, 1)):
+        for _ in range(count):
+            analytics.observe_rating(rating, now - 60)
+    report = analytics.report('1h')
+    types = Counter(interaction.message_type for interaction in interactions)
+    assert {issue['count'] for issue in report['commonIssues']} == set(types.values())
+    assert sum(issue['count'] for issue in report['commonIssues']) == 1000
+    assert report['customerSatisfaction']['responses'] == 5
+    assert report['customerSatisfaction']['average'] == 4.0
+    assert report['customerSatisfaction']['distribution']['veryPoor'] == 1
+
+def test_state_survives_a_json_round_trip(analytics, now):
+    for interaction in interaction_stream(5000, now - 3 * DAY, 3 * DAY):
+        analytics.observe_interaction(interaction)
+    analytics.observe_rating(4, now - 60)
+    restored = bot.ConversationAnalytics('1h,24h,7d', idle_timeout=1800)
+    restored.restore(json.loads(json.dumps(analytics.state())))
+    for window in analytics.windows:
+        assert restored.report(window) == analytics.report(window)
+    assert restored.last_seen == analytics.last_seen
+
+def test_replay_counts_more_than_the_interaction_log_holds(monkeypatch, now):
+    # A restart must not shrink the windows to whatever the ring buffer still holds
+    monkeypatch.setitem(bot.collections_data, 'customer_interactions', bot.InteractionLog(capacity=100))
+    monkeypatch.setattr(bot, 'conversation_analytics', bot.ConversationAnalytics('1h,24h,7d', idle_timeout=1800))
+    live = bot.ConversationAnalytics('1h,24h,7d', idle_timeout=1800)
+    before, after = interaction_stream(3000, now - 2 * DAY, DAY, seed=1), interaction_stream(2000, now - DAY, DAY, seed=2)
+    
+    # What the snapshot was taken from
+    for interaction in before:
+        bot.collections_data['customer_interactions'].append(interaction)
+        live.observe_interaction(interaction)
+    snapshot = json.loads(json.dumps(bot.build_snapshot(([], [], bot.collections_data['customer_interactions'].since(), live.state()))))
+    # Events logged after it
+    for interaction in after:
+        live.observe_interaction(interaction)
+    
+    monkeypatch.setitem(bot.collections_data, 'customer_interactions', bot.InteractionLog(capacity=100))
+    bot.restore_snapshot(snapshot)
+    for interaction in after:
+        bot.apply_event('interaction', bot.asdict(interaction))
+    
+    for window in live.windows:
+        assert bot.conversation_analytics.report(window) == live.report(window)
+    assert bot.conversation_analytics.report('7d')['totalInteractions'] == 5000
+
+def test_unread_windows_stay_bounded(analytics, now):
+    # Weeks of traffic with nobody asking for a report
+    for interaction in interaction_stream(20000, now - 28 * DAY, 28 * DAY):
+        analytics.observe_interaction(interaction)
+    for histogram in analytics.windows.values():
+        assert len(histogram.buckets) <= histogram.bucket_count
+    assert analytics.report('7d')['totalInteractions'] < 20000
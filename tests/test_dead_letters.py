@@ -0,0 +1,130 @@
+import asyncio
+import os
+
+import python_whatsapp_pension_bot as bot
+
+def entry(to):
+    return {'to': to, 'url': 'http://graph.test/messages', 'payload': {'to': to}, 'attempts': 4,
+            'reason': 'unavailable', 'failed_at': 0.0}
+
+def queue(tmp_path, slot):
+    path = tmp_path / f'worker-{slot}' / 'dead_letters.ndjson'
+    dead_letters = bot.DeadLetterQueue(str(path))
+    dead_letters.open()
+    return dead_letters
+
+def test_replay_takes_everything_once(tmp_path):
+    dead_letters = queue(tmp_path, 0)
+    dead_letters.append(entry('1'))
+    dead_letters.append(entry('2'))
+    assert dead_letters.depth == 2
+    
+    assert [item['to'] for item in dead_letters.take()] == ['1', '2']
+    assert dead_letters.depth == 0
+    # Nothing more until the replay has finished, even if new failures arrive meanwhile
+    dead_letters.append(entry('3'))
+    assert dead_letters.take() == []
+    dead_letters.finish_replay()
+    assert [item['to'] for item in dead_letters.take()] == ['3']
+
+def test_interrupted_replay_is_merged_back_on_open(tmp_path):
+    dead_letters = queue(tmp_path, 0)
+    dead_letters.append(entry('1'))
+    dead_letters.take()
+    dead_letters.append(entry('2'))
+    
+    restarted = queue(tmp_path, 0)
+    assert restarted.depth == 2
+    assert not os.path.exists(restarted.replay_path)
+    assert sorted(item['to'] for item in restarted.take()) == ['1', '2']
+
+def test_workers_never_touch_each_others_replay(tmp_path):
+    first = queue(tmp_path, 0)
+    first.append(entry('1'))
+    assert len(first.take()) == 1
+    
+    # A second worker starting mid-replay must not merge (and so resend) it
+    second = queue(tmp_path, 1)
+    assert second.depth == 0
+    assert second.take() == []
+    assert os.path.exists(first.replay_path)
+
+def test_missing_file_resets_depth(tmp_path):
+    dead_letters = queue(tmp_path, 0)
+    dead_letters.depth = 3
+    assert dead_letters.take() == []
+    assert dead_letters.depth == 0
+
+def test_replayer_stops_when_cancelled_as_the_breaker_closes():
+    async def scenario():
+        bot.send_breaker.closed.clear()
+        replayer = asyncio.create_task(bot.dead_letter_replayer())
+        await asyncio.sleep(0)
+        # The cancel lands while the breaker's wakeup is still being delivered
+        bot.send_breaker.closed.set()
+        replayer.cancel()
+        await asyncio.wait_for(asyncio.gather(replayer, return_exceptions=True), 3)
+        return replayer
+    assert asyncio.run(scenario()).cancelled()
+
+class Dispatcher:
+    # Stands in for the outbound dispatcher; every send succeeds or fails as told
+    def __init__(self, dead_letters, succeed):
+        self.dead_letters = dead_letters
+        self.succeed = succeed
+        self.submitted = []
+    
+    async def submit(self, to, url, payload, headers, on_sent=None):
+        self.submitted.append(to)
+        if self.succeed:
+            bot.send_breaker.record_success()
+        else:
+            bot.send_breaker.record_failure()
+            self.dead_letters.append(entry(to))
+        on_sent(0.0, self.succeed)
+
+def replay_after_outage(monkeypatch, tmp_path, succeed):
+    async def scenario():
+        dead_letters = queue(tmp_path, 0)
+        for to in ('1', '2', '3'):
+            dead_letters.append(entry(to))
+        breaker = bot.CircuitBreaker(threshold=1, reset_timeout=0.2)
+        breaker.record_failure()
+        dispatcher = Dispatcher(dead_letters, succeed)
+        monkeypatch.setattr(bot, 'dead_letters', dead_letters)
+        monkeypatch.setattr(bot, 'send_breaker', breaker)
+        monkeypatch.setattr(bot, 'outbound_dispatcher', dispatcher)
+        replayer = asyncio.create_task(bot.dead_letter_replayer())
+        while not dispatcher.submitted or os.path.exists(dead_letters.replay_path):
+            await asyncio.sleep(0.01)
+        replayer.cancel()
+        await asyncio.gather(replayer, return_exceptions=True)
+        return dispatcher.submitted, dead_letters
+    return asyncio.run(scenario())
+
+def test_failed_probe_puts_the_rest_back(monkeypatch, tmp_path):
+    submitted, dead_letters = replay_after_outage(monkeypatch, tmp_path, succeed=False)
+    assert submitted == ['1']
+    assert sorted(item['to'] for item in dead_letters.take()) == ['1', '2', '3']
+    assert dead_letters.stats['replayed'] == 0
+
+def test_successful_probe_replays_the_rest(monkeypatch, tmp_path):
+    submitted, dead_letters = replay_after_outage(monkeypatch, tmp_path, succeed=True)
+    assert submitted == ['1', '2', '3']
+    assert dead_letters.depth == 0
+    assert dead_letters.stats['replayed'] == 3
+
+def test_shutdown_dead_letters_queued_replies_and_calls_back(monkeypatch, tmp_path):
+    dead_letters = queue(tmp_path, 0)
+    monkeypatch.setattr(bot, 'dead_letters', dead_letters)
+    calls = []
+    async def scenario():
+        dispatcher = bot.OutboundDispatcher()
+        for to in ('1', '2'):
+            await dispatcher.submit(to, 'http://graph.test/messages', {'to': to}, {},
+                                    lambda sent_at, sent, to=to: calls.append((to, sent)))
+        await dispatcher.dead_letter_pending()
+        return dispatcher
+    assert asyncio.run(scenario()).depth == 0
+    assert calls == [('1', False), ('2', False)]
+    assert [item['reason'] for item in dead_letters.take()] == ['shutdown', 'shutdown']
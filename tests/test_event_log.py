@@ -0,0 +1,76 @@
+import asyncio
+import os
+
+import pytest
+
+import python_whatsapp_pension_bot as bot
+
+@pytest.fixture(autouse=True)
+def state(monkeypatch):
+    # Replay applies events to the bot's globals, so each test starts from empty ones
+    monkeypatch.setitem(bot.agents_data, 'tickets', {})
+    monkeypatch.setitem(bot.collections_data, 'tickets', [])
+    monkeypatch.setitem(bot.collections_data, 'customer_interactions', bot.InteractionLog(capacity=100))
+    monkeypatch.setattr(bot, 'conversation_analytics', bot.ConversationAnalytics())
+
+def interaction(index):
+    return {'timestamp': 1700000000.0 + index, 'user_id': f'user-{index}', 'user_message': 'hi',
+            'bot_response': 'hello', 'conversation_step': 'main_menu', 'message_type': 'general_inquiry',
+            'response_time': 120, 'session_id': f'session-{index}'}
+
+def write(directory, indexes, snapshot_after=None):
+    async def scenario():
+        event_log = bot.EventLog(str(directory))
+        assert event_log.open()
+        event_log.replay()
+        for index in indexes:
+            # As log_interaction does: the interaction is applied, then recorded
+            bot.apply_event('interaction', interaction(index))
+            event_log.append('interaction', interaction(index))
+            if index == snapshot_after:
+                await event_log.snapshot()
+        await event_log.flush()
+        event_log.close()
+    asyncio.run(scenario())
+
+def restart(directory, monkeypatch):
+    monkeypatch.setitem(bot.collections_data, 'customer_interactions', bot.InteractionLog(capacity=100))
+    monkeypatch.setattr(bot, 'conversation_analytics', bot.ConversationAnalytics())
+    event_log = bot.EventLog(str(directory))
+    assert event_log.open()
+    event_log.replay()
+    event_log.close()
+    return event_log
+
+def user_ids():
+    return [item.user_id for item in bot.collections_data['customer_interactions'].since()]
+
+def test_replay_restores_events_in_order(tmp_path, monkeypatch):
+    write(tmp_path, range(5))
+    event_log = restart(tmp_path, monkeypatch)
+    assert user_ids() == [f'user-{index}' for index in range(5)]
+    assert event_log.last_seq == 5
+    assert event_log.stats['replayed'] == 5
+
+def test_events_in_the_snapshot_are_not_applied_twice(tmp_path, monkeypatch):
+    write(tmp_path, range(5), snapshot_after=2)
+    event_log = restart(tmp_path, monkeypatch)
+    assert user_ids() == [f'user-{index}' for index in range(5)]
+    assert event_log.last_seq == 5
+    assert event_log.stats['replayed'] == 2
+
+def test_truncated_tail_is_dropped_and_logging_resumes(tmp_path, monkeypatch):
+    write(tmp_path, range(3))
+    path = tmp_path / 'events.ndjson'
+    # A crash halfway through writing the last line
+    os.truncate(path, os.path.getsize(path) - 20)
+    
+    event_log = restart(tmp_path, monkeypatch)
+    assert user_ids() == ['user-0', 'user-1']
+    assert event_log.last_seq == 2
+    
+    # Events logged after recovery follow on from the last intact one and survive the next restart
+    write(tmp_path, [3])
+    event_log = restart(tmp_path, monkeypatch)
+    assert user_ids() == ['user-0', 'user-1', 'user-3']
+    assert event_log.last_seq == 3
@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+import python_whatsapp_pension_bot as bot
+
+def test_ids_are_unique_and_increasing():
+    generator = bot.IdGenerator(0)
+    ids = [generator.generate('TK') for _ in range(100000)]
+    assert len(set(ids)) == len(ids)
+    assert ids == sorted(ids)
+    assert all(len(value) == 18 and value.startswith('TK') for value in ids)
+
+def test_configured_node_ids_keep_same_pid_replicas_apart(monkeypatch):
+    monkeypatch.setattr(os, 'getpid', lambda: 1)
+    first, second = bot.IdGenerator(1), bot.IdGenerator(2)
+    assert first.process_bits != second.process_bits
+
+def test_unset_node_id_does_not_rely_on_the_pid(monkeypatch):
+    # Replicas in separate containers often all run as pid 1
+    monkeypatch.setattr(os, 'getpid', lambda: 1)
+    generators = [bot.IdGenerator(None) for _ in range(100)]
+    assert len({generator.process_bits for generator in generators}) == 100
+
+@pytest.mark.parametrize('node_id', [-1, 256])
+def test_node_id_range(node_id):
+    with pytest.raises(ValueError):
+        bot.IdGenerator(node_id)
+
+def test_forked_child_gets_new_process_bits():
+    generator = bot.IdGenerator(None)
+    reader, writer = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.write(writer, str(generator.process_bits).encode())
+        os._exit(0)
+    os.close(writer)
+    child_bits = int(os.read(reader, 64))
+    os.close(reader)
+    os.waitpid(pid, 0)
+    assert child_bits != generator.process_bits
+
+def test_generators_are_not_kept_alive_for_the_fork_hook():
+    generator = bot.IdGenerator(None)
+    assert generator in bot.IdGenerator.instances
+    count = len(bot.IdGenerator.instances)
+    del generator
+    assert len(bot.IdGenerator.instances) == count - 1
@@ -0,0 +1,64 @@
+import pytest
+
+import python_whatsapp_pension_bot as bot
+
+classify = bot.IntentClassifier(bot.INTENT_KEYWORDS).classify
+
+# Every keyword of the current menus, on its own and inside a sentence
+MENU_KEYWORDS = [
+    (step, intent, keyword)
+    for step, intents in bot.INTENT_KEYWORDS.items()
+    for intent, keywords in intents
+    for keyword in keywords
+]
+
+@pytest.mark.parametrize('step,intent,keyword', MENU_KEYWORDS)
+def test_keyword_alone(step, intent, keyword):
+    assert classify(step, keyword) == intent
+
+@pytest.mark.parametrize('step,intent,keyword', [entry for entry in MENU_KEYWORDS if len(entry[2]) > 1])
+def test_keyword_in_sentence(step, intent, keyword):
+    assert classify(step, f'i would like to know about {keyword} please') == intent
+
+@pytest.mark.parametrize('step,intent,keyword', [entry for entry in MENU_KEYWORDS if len(entry[2]) == 1])
+def test_option_as_first_word(step, intent, keyword):
+    assert classify(step, f'{keyword} please') == intent
+    assert classify(step, f'{keyword}.') == intent
+
+@pytest.mark.parametrize('step,message,intent', [
+    # Single-character options are ignored anywhere but the start
+    ('pension_info', 'what about a tax break', 'tax'),
+    ('pension_info', 'is there a limit', None),
+    ('main_menu', 'i have a question', None),
+    ('main_menu', 'i want option 1', None),
+    # Word keywords win over an option in front of them
+    ('pension_info', 'a tax question', 'tax'),
+    ('main_menu', '1 balance', 'balance'),
+    # Whole words only
+    ('main_menu', '10', None),
+    ('main_menu', 'accountant', None),
+    ('contribution_help', 'moreover', None),
+    # Plurals of word keywords
+    ('main_menu', 'my accounts', 'balance'),
+    ('main_menu', 'appointments', 'consultation'),
+    ('contribution_help', 'rates', 'rates'),
+    # Phrases need every word, in order
+    ('pension_info', 'tell me the contribution rates', 'contribution_rates'),
+    ('pension_info', 'rates of contribution', None),
+    ('contribution_help', 'how much should i pay', 'rates'),
+    ('contribution_help', 'much how', None),
+    # The first intent in the table wins when several match
+    ('main_menu', 'agent about my balance', 'balance'),
+    ('message_type', 'problem with my account', 'account_inquiry'),
+    ('agent_selection', 'complaint about a contribution', 'complaints'),
+    # Keycap emoji options
+    ('main_menu', '5️⃣', 'agent'),
+])
+def test_messages(step, message, intent):
+    assert classify(step, message) == intent
+
+def test_unknown_step():
+    assert classify('with_agent', 'balance') is None
+
+def test_empty_message():
+    assert classify('main_menu', '') is None
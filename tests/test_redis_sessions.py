@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+import python_whatsapp_pension_bot as bot
+
+fakeredis = pytest.importorskip('fakeredis')
+
+def workers(count, **options):
+    # Stores of separate workers, all talking to the same server
+    server = fakeredis.FakeServer()
+    return [bot.RedisSessionStore('', client=fakeredis.FakeAsyncRedis(server=server), **options) for _ in range(count)]
+
+async def handle(store, user_id):
+    session = await store.load(user_id) or bot.UserSession()
+    count = session.data.get('messages', 0)
+    # Other workers run while this one waits on the Graph API or the handler
+    await asyncio.sleep(0.001)
+    session.data['messages'] = count + 1
+    await store.save(user_id, session)
+
+def test_workers_take_turns_on_a_user():
+    async def scenario():
+        stores = workers(3)
+        await asyncio.gather(*(handle(stores[index % 3], '27820000001') for index in range(30)))
+        return await stores[0].load('27820000001')
+    assert asyncio.run(scenario()).data['messages'] == 30
+
+def test_unlock_frees_the_user_without_saving():
+    async def scenario():
+        first, second = workers(2)
+        await first.save('27820000002', bot.UserSession(step='main_menu'))
+        await first.load('27820000002')
+        await first.unlock('27820000002')
+        return await asyncio.wait_for(second.load('27820000002'), 1)
+    assert asyncio.run(scenario()).step == 'main_menu'
+
+def test_update_under_an_expired_lock_is_dropped():
+    async def scenario():
+        slow, fast = workers(2, lock_timeout=0.2)
+        await slow.load('27820000003')
+        await asyncio.sleep(0.3)
+        # The lock expired, so the other worker got in first
+        await fast.load('27820000003')
+        await fast.save('27820000003', bot.UserSession(step='fast'))
+        await slow.save('27820000003', bot.UserSession(step='slow'))
+        return await fast.load('27820000003')
+    assert asyncio.run(scenario()).step == 'fast'
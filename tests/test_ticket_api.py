@@ -0,0 +1,80 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+import python_whatsapp_pension_bot as bot
+
+class ArchiveOnDisk:
+    """Stands in for the transcript archive, which must never be read on the event loop."""
+    
+    file = object()
+    
+    def check_thread(self, ticket_id):
+        if threading.current_thread() is threading.main_thread():
+            raise AssertionError(f"read the archived transcript of {ticket_id} on the event loop")
+    
+    def load(self, ticket_id):
+        self.check_thread(ticket_id)
+        return [bot.TicketMessage(sender='customer', message=f'archived {i}', timestamp=0.0) for i in range(40)]
+    
+    def message(self, ticket_id, position):
+        self.check_thread(ticket_id)
+        return bot.TicketMessage(sender='customer', message=f'archived {position}', timestamp=0.0)
+
+@pytest.fixture
+def archived_ticket(monkeypatch):
+    monkeypatch.setattr(bot, 'transcript_archive', ArchiveOnDisk())
+    ticket = bot.Ticket(
+        id=bot.generate_ticket_id(),
+        customer_id='27830000001',
+        customer_name='Test',
+        initial_message='help',
+        created_at=time.time(),
+        archived_messages=40,
+        messages=[bot.TicketMessage(sender='customer', message='latest', timestamp=time.time())]
+    )
+    bot.store_ticket(ticket)
+    return ticket
+
+def body(response):
+    return json.loads(response.body)
+
+def test_powerbi_page_lists_only_the_tail(archived_ticket):
+    page = body(asyncio.run(bot.get_tickets(limit=bot.POWERBI_MAX_PAGE_SIZE)))
+    row = next(row for row in page['data'] if row['id'] == archived_ticket.id)
+    assert row['message_count'] == 41
+    assert [message['message'] for message in row['messages']] == ['latest']
+
+def test_ticket_query_lists_only_the_tail(archived_ticket):
+    found = body(asyncio.run(bot.find_tickets(customer_id=archived_ticket.customer_id)))
+    row = next(row for row in found['data'] if row['id'] == archived_ticket.id)
+    assert row['message_count'] == 41
+    assert len(row['messages']) == 1
+
+def export(fields):
+    async def collect():
+        response = await bot.export_tickets(FakeRequest(), fields=fields)
+        return b''.join([chunk async for chunk in response.body_iterator])
+    return [json.loads(line) for line in asyncio.run(collect()).splitlines()]
+
+class FakeRequest:
+    headers = {}
+
+def test_export_reads_the_full_transcript_off_the_event_loop(archived_ticket):
+    row = next(row for row in export('id,messages') if row['id'] == archived_ticket.id)
+    assert len(row['messages']) == 41
+    assert row['messages'][0]['message'] == 'archived 0'
+    assert row['messages'][-1]['message'] == 'latest'
+
+def test_export_without_messages_skips_the_archive(archived_ticket, monkeypatch):
+    monkeypatch.setattr(bot, 'load_transcripts', None)
+    assert any(row['id'] == archived_ticket.id for row in export('id,status'))
+
+def test_summary_reads_only_the_last_archived_message(archived_ticket):
+    archived_ticket.messages.clear()
+    summary = asyncio.run(bot.get_ticket_summary(archived_ticket))
+    assert 'archived 39' in summary
+    assert '**Messages:** 40' in summary